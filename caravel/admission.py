@@ -0,0 +1,158 @@
+"""Admission control for the queries sent to the databases and Druid clusters
+
+Databases and Druid clusters can cap how many queries Caravel runs on them
+at once. Queries past the cap wait in line, first come first served within
+a web server process, and give up with ``QueryQueueTimeout`` once they have
+waited for QUERY_QUEUE_WAIT_BUDGET seconds.
+
+The cap holds across processes through slots stored in the cache: running
+a query takes one of the ``limit`` slots of its database with an atomic
+``add``, and frees it when done. Slots expire after QUERY_SLOT_TIMEOUT
+seconds, so that a process that dies doesn't hold on to them. Without a
+cache shared across processes, the cap applies to each process.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from caravel import app, cache
+
+config = app.config
+
+
+class QueryQueueTimeout(Exception):
+
+    """Raised when a query waited too long for its turn"""
+
+
+class _Queue(object):
+
+    """The queries of a database waiting, or running, in this process"""
+
+    def __init__(self):
+        self.waiting = collections.deque()
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self):
+        return {
+            'queued': len(self.waiting),
+            'running': self.running,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+            'wait_avg': (
+                self.wait_total / self.admitted if self.admitted else 0.0),
+        }
+
+
+class AdmissionController(object):
+
+    """Keeps a queue per database and Druid cluster, in each process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queues = collections.defaultdict(_Queue)
+
+    @staticmethod
+    def slot_key(scope, i):
+        return 'slot_{}_{}_{}'.format(scope[0], scope[1], i)
+
+    def _take_slot(self, scope, limit, token):
+        """Takes one of the shared slots, returns its key"""
+        for i in range(limit):
+            key = self.slot_key(scope, i)
+            if cache.add(key, token, timeout=config.get('QUERY_SLOT_TIMEOUT')):
+                return key
+
+    @staticmethod
+    def _free_slot(slot, token):
+        """Frees a slot, unless it expired and another query took it since"""
+        if cache.get(slot) == token:
+            cache.delete(slot)
+
+    @contextmanager
+    def admit(self, scope, limit, name=None):
+        """Holds a slot for the duration of the block
+
+        ``scope`` identifies what's queried, like ``('database', 3)``,
+        ``limit`` is its maximum number of concurrent queries, no limit
+        when empty. The slots are taken from the cache outside of the lock,
+        which only guards the queues.
+        """
+        if not limit:
+            yield
+            return
+        budget = config.get('QUERY_QUEUE_WAIT_BUDGET')
+        poll_interval = config.get('QUERY_QUEUE_POLL_INTERVAL')
+        token = uuid.uuid4().hex
+        start = time.time()
+        with self._cond:
+            queue = self._queues[scope]
+            queue.waiting.append(token)
+
+        def is_up():
+            return queue.waiting[0] == token and queue.running < limit
+
+        try:
+            while True:
+                with self._cond:
+                    up = is_up()
+                slot = self._take_slot(scope, limit, token) if up else None
+                with self._cond:
+                    if slot and is_up():
+                        waited = time.time() - start
+                        queue.running += 1
+                        queue.admitted += 1
+                        queue.wait_total += waited
+                        queue.wait_max = max(queue.wait_max, waited)
+                        break
+                    remaining = start + budget - time.time()
+                    # Unless it just became our turn, wait for a query to
+                    # finish, or for the next poll of the shared slots
+                    if remaining > 0 and (up or not is_up()):
+                        self._cond.wait(min(remaining, poll_interval))
+                if slot:
+                    # Our turn went by in the meantime
+                    self._free_slot(slot, token)
+                if remaining <= 0:
+                    with self._cond:
+                        queue.rejected += 1
+                    raise QueryQueueTimeout(
+                        "Too many queries are running on [{}], gave up "
+                        "waiting for one of its {} slots after {} "
+                        "seconds, please try again later".format(
+                            name or scope[1], limit, budget))
+        finally:
+            with self._cond:
+                queue.waiting.remove(token)
+                # The next in line may be up
+                self._cond.notify_all()
+        try:
+            yield
+        finally:
+            self._free_slot(slot, token)
+            with self._cond:
+                queue.running -= 1
+                self._cond.notify_all()
+
+    def stats(self, scope):
+        """Queue depth and wait times for a database or cluster"""
+        with self._lock:
+            queue = self._queues.get(scope)
+            return queue.stats() if queue else {}
+
+
+controller = AdmissionController()
@@ -225,12 +225,17 @@ var px = (function () {
         };
         return Mustache.render(s, context);
       },
-      jsonEndpoint: function () {
+      jsonEndpoint: function (options) {
         var parser = document.createElement('a');
         parser.href = data.json_endpoint;
         var endpoint = parser.pathname + this.querystring();
         endpoint += "&json=true";
         endpoint += "&force=" + this.force;
+        // Columnar payloads are lighter, visualizations use
+        // utils.columnarToRecords when they need rows
+        if (options && options.columnar) {
+          endpoint += "&columnar=true";
+        }
         return endpoint;
       },
       done: function (data) {
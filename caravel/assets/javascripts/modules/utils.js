@@ -74,7 +74,26 @@ function showModal(options) {
   $(options.modalSelector).modal("show");
 }
 
+/**
+ * Turns a columnar payload, of the form {columns: [...], data: {column: [values]}},
+ * into an array of row objects
+ */
+function columnarToRecords(payload) {
+  var columns = payload.columns;
+  var length = columns.length ? payload.data[columns[0]].length : 0;
+  var records = [];
+  for (var i = 0; i < length; i++) {
+    var row = {};
+    for (var j = 0; j < columns.length; j++) {
+      row[columns[j]] = payload.data[columns[j]][i];
+    }
+    records.push(row);
+  }
+  return records;
+}
+
 module.exports = {
   wrapSvgText: wrapSvgText,
-  showModal: showModal
+  showModal: showModal,
+  columnarToRecords: columnarToRecords
 };
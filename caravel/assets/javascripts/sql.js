@@ -39,8 +39,43 @@ $(document).ready(function () {
     $("select").select2({
       dropdownAutoWidth: true
     });
+    // Tables are searched by prefix in the database's catalog as you type
+    $("#dbtable").select2({
+      dropdownAutoWidth: true,
+      placeholder: "Search tables",
+      ajax: {
+        url: '/caravel/catalog/' + database_id + '/',
+        dataType: 'json',
+        quietMillis: 250,
+        data: function (term) {
+          return { q: term, schema: '' };
+        },
+        results: function (data) {
+          if (!data.last_refreshed) {
+            return {
+              results: [{
+                id: '',
+                text: 'Listing the tables, try again in a moment',
+                disabled: true
+              }]
+            };
+          }
+          return {
+            results: data.tables.map(function (tbl) {
+              return { id: tbl.name, text: tbl.name };
+            })
+          };
+        }
+      },
+      initSelection: function (element, callback) {
+        callback({ id: element.val(), text: element.val() });
+      }
+    });
 
     function showTableMetadata() {
+      if (!$("#dbtable").val()) {
+        return;
+      }
       $(".metadata").load(
         '/caravel/table/' + database_id + '/' + $("#dbtable").val() + '/');
     }
@@ -55,6 +90,9 @@ $(document).ready(function () {
     $(".sqlcontent").show();
 
     function selectStarOnClick() {
+      if (!$("#dbtable").val()) {
+        return;
+      }
       $.ajax('/caravel/select_star/' + database_id + '/' + $("#dbtable").val() + '/')
       .done(function (msg) {
         editor.setValue(msg);
@@ -70,13 +108,122 @@ $(document).ready(function () {
       editor.setValue(getParam('sql'));
       $("#run").click();
     });
+    // The query running in the background, if any
+    var query = null;
+
+    function showError(msg) {
+      $('#loading').hide(0);
+      $('#cancel').hide(0);
+      $('#results').show(0);
+      $('#results').html($('<div class="alert alert-danger"></div>').text(msg));
+    }
+
+    function errorMessage(xhr) {
+      try {
+        return JSON.parse(xhr.responseText).error;
+      } catch (e) {
+        return xhr.responseText;
+      }
+    }
+
+    function showPage(summary, page, rows) {
+      $('#loading').hide(0);
+      $('#cancel').hide(0);
+      $('#results').show(0);
+      var table = $(
+        '<table class="dataframe table table-striped table-bordered ' +
+        'table-condensed sql_results"></table>');
+      var pager = $('<div class="pager"></div>');
+      var first = page * summary.page_size;
+      pager.text(
+        'Rows ' + (summary.rows ? first + 1 : 0) + ' to ' +
+        (first + rows.length) + ' of ' + summary.rows +
+        (summary.limit_reached ? ' (limit reached)' : ''));
+      if (page > 0) {
+        $('<button class="btn btn-default btn-xs">Previous</button>')
+          .click(function () { fetchPage(summary, page - 1); })
+          .prependTo(pager);
+      }
+      if (page < summary.pages - 1) {
+        $('<button class="btn btn-default btn-xs">Next</button>')
+          .click(function () { fetchPage(summary, page + 1); })
+          .appendTo(pager);
+      }
+      $('#results').empty().append(pager).append(table);
+      table.DataTable({
+        data: rows,
+        columns: summary.columns.map(function (col) {
+          return { title: col };
+        }),
+        paging: false,
+        searching: true,
+        aaSorting: []
+      });
+    }
+
+    function fetchPage(summary, page) {
+      $.getJSON(
+        '/caravel/sql_json/' + summary.query_id + '/page/' + page + '/')
+      .done(function (data) {
+        showPage(summary, page, data.data);
+      })
+      .fail(function (xhr) {
+        showError(errorMessage(xhr));
+      });
+    }
+
+    function pollQuery(queryId) {
+      if (query !== queryId) {
+        return;
+      }
+      $.getJSON('/caravel/job/' + queryId + '/')
+      .done(function (job) {
+        if (query !== queryId) {
+          return;
+        }
+        if (job.status === 'success') {
+          query = null;
+          if (job.payload.pages) {
+            fetchPage(job.payload, 0);
+          } else {
+            showPage(job.payload, 0, []);
+          }
+        } else if (job.status === 'failed') {
+          query = null;
+          showError(job.error);
+        } else if (job.status === 'cancelled') {
+          query = null;
+          showError('The query was cancelled');
+        } else {
+          setTimeout(function () { pollQuery(queryId); }, 1000);
+        }
+      })
+      .fail(function (xhr) {
+        query = null;
+        showError(errorMessage(xhr));
+      });
+    }
+
+    $("#cancel").click(function () {
+      if (query) {
+        $.post('/caravel/sql_json/' + query + '/cancel/');
+      }
+    });
+    // No one is left to look at the results
+    $(window).on('unload', function () {
+      if (query && navigator.sendBeacon) {
+        navigator.sendBeacon('/caravel/sql_json/' + query + '/cancel/');
+      }
+    });
+
     $("#run").click(function () {
       $('#results').hide(0);
       $('#loading').show(0);
       history.pushState({}, document.title, '?sql=' + encodeURIComponent(editor.getValue()));
       $.ajax({
         type: "POST",
-        url: '/caravel/runsql/',
+        url: '/caravel/sql_json/',
+        dataType: 'json',
         data: {
           data: JSON.stringify({
             database_id: $('#database_id').val(),
@@ -84,20 +231,17 @@ $(document).ready(function () {
           })
         },
         success: function (data) {
-          $('#loading').hide(0);
-          $('#results').show(0);
-          $('#results').html(data);
-
-          $('table.sql_results').DataTable({
-            paging: false,
-            searching: true,
-            aaSorting: []
-          });
+          if (data.query_id && data.status) {
+            // Running in the background
+            query = data.query_id;
+            $('#cancel').show(0);
+            pollQuery(query);
+          } else {
+            showPage(data, 0, data.data);
+          }
         },
-        error: function (err, err2) {
-          $('#loading').hide(0);
-          $('#results').show(0);
-          $('#results').html(err.responseText);
+        error: function (xhr) {
+          showError(errorMessage(xhr));
         }
       });
     });
@@ -1,5 +1,6 @@
 // JS
 var d3 = window.d3 || require('d3');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 
 // CSS
 require('./directed_force.css');
@@ -11,7 +12,7 @@ function directedForceVis(slice) {
   var render = function () {
     var width = slice.width();
     var height = slice.height() - 25;
-    d3.json(slice.jsonEndpoint(), function (error, json) {
+    d3.json(slice.jsonEndpoint({ columnar: true }), function (error, json) {
       var link_length = json.form_data.link_length || 200;
       var charge = json.form_data.charge || -500;
 
@@ -19,7 +20,7 @@ function directedForceVis(slice) {
         slice.error(error.responseText);
         return '';
       }
-      var links = json.data;
+      var links = columnarToRecords(json.data);
       var nodes = {};
       // Compute the distinct nodes from the links.
       links.forEach(function (link) {
@@ -1,6 +1,7 @@
 // JS
 var $ = window.$ || require('jquery');
 var px = window.px || require('../javascripts/modules/caravel.js');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 var d3 = require('d3');
 
 d3.tip = require('d3-tip'); //using window.d3 doesn't capture events properly bc of multiple instances
@@ -20,14 +21,14 @@ function heatmapVis(slice) {
       left: 35
     };
 
-    d3.json(slice.jsonEndpoint(), function (error, payload) {
+    d3.json(slice.jsonEndpoint({ columnar: true }), function (error, payload) {
       var matrix = {};
       if (error) {
         slice.error(error.responseText);
         return '';
       }
       var fd = payload.form_data;
-      var data = payload.data;
+      var data = columnarToRecords(payload.data);
 
       // Dynamically adjusts  based on max x / y category lengths
       function adjustMargins(data, margins) {
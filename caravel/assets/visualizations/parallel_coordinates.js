@@ -1,6 +1,7 @@
 // JS
 var $  = window.$ || require('jquery');
 var d3 = window.d3 || require('d3');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 d3.parcoords = require('../vendor/parallel_coordinates/d3.parcoords.js');
 d3.divgrid = require('../vendor/parallel_coordinates/divgrid.js');
 
@@ -12,9 +13,9 @@ function parallelCoordVis(slice) {
 
   function refresh() {
     $('#code').attr('rows', '15');
-    $.getJSON(slice.jsonEndpoint(), function (payload) {
+    $.getJSON(slice.jsonEndpoint({ columnar: true }), function (payload) {
         var fd = payload.form_data;
-        var data = payload.data;
+        var data = columnarToRecords(payload.data);
 
         var cols = fd.metrics;
         if (fd.include_series) {
@@ -2,6 +2,7 @@
 require('./sankey.css');
 // JS
 var px = window.px || require('../javascripts/modules/caravel.js');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 var d3 = window.d3 || require('d3');
 d3.sankey = require('d3-sankey').sankey;
 
@@ -38,12 +39,12 @@ function sankeyVis(slice) {
 
     var path = sankey.link();
 
-    d3.json(slice.jsonEndpoint(), function (error, json) {
+    d3.json(slice.jsonEndpoint({ columnar: true }), function (error, json) {
       if (error !== null) {
         slice.error(error.responseText);
         return '';
       }
-      var links = json.data;
+      var links = columnarToRecords(json.data);
       var nodes = {};
       // Compute the distinct nodes from the links.
       links.forEach(function (link) {
@@ -2,6 +2,7 @@ var $ = window.$ = require('jquery');
 var jQuery = window.jQuery = $;
 var d3 = require('d3');
 var px = window.px || require('../javascripts/modules/caravel.js');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 
 require('./table.css');
 require('datatables.net-bs');
@@ -13,7 +14,7 @@ function tableVis(slice) {
   var timestampFormatter;
 
   function refresh() {
-    $.getJSON(slice.jsonEndpoint(), onSuccess).fail(onError);
+    $.getJSON(slice.jsonEndpoint({ columnar: true }), onSuccess).fail(onError);
 
     function onError(xhr) {
       slice.error(xhr.responseText);
@@ -21,19 +22,13 @@ function tableVis(slice) {
 
     function onSuccess(json) {
       var data = json.data;
+      var records = columnarToRecords(data);
       var form_data = json.form_data;
       var metrics = json.form_data.metrics;
 
-      function col(c) {
-        var arr = [];
-        for (var i = 0; i < data.records.length; i++) {
-          arr.push(data.records[i][c]);
-        }
-        return arr;
-      }
       var maxes = {};
       for (var i = 0; i < metrics.length; i++) {
-        maxes[metrics[i]] = d3.max(col(metrics[i]));
+        maxes[metrics[i]] = d3.max(data.data[metrics[i]]);
       }
 
       if (json.form_data.table_timestamp_format === 'smart_date') {
@@ -58,7 +53,7 @@ function tableVis(slice) {
 
       table.append('tbody')
         .selectAll('tr')
-        .data(data.records).enter()
+        .data(records).enter()
         .append('tr')
         .selectAll('td')
         .data(function (row, i) {
@@ -1,4 +1,5 @@
 var px = window.px || require('../javascripts/modules/caravel.js');
+var columnarToRecords = require('../javascripts/modules/utils.js').columnarToRecords;
 var d3 = window.d3 || require('d3');
 var cloudLayout = require('d3-cloud');
 
@@ -6,12 +7,12 @@ function wordCloudChart(slice) {
   var chart = d3.select(slice.selector);
 
   function refresh() {
-    d3.json(slice.jsonEndpoint(), function (error, json) {
+    d3.json(slice.jsonEndpoint({ columnar: true }), function (error, json) {
       if (error !== null) {
         slice.error(error.responseText);
         return '';
       }
-      var data = json.data;
+      var data = columnarToRecords(json.data);
       var range = [
         json.form_data.size_from,
         json.form_data.size_to
@@ -0,0 +1,106 @@
+"""Helpers built on top of the Caravel cache"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from caravel import app, cache
+
+config = app.config
+
+
+class _Call(object):
+
+    """A computation in flight, that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.shared = False
+        self.error = None
+
+
+class SingleFlight(object):
+
+    """Coalesces concurrent computations of the same cache key
+
+    Within a process, the first caller for a key computes the value while
+    the other callers wait for it. Across processes, the computing caller
+    holds a lock stored in the cache and the other processes poll the cache
+    for the value until the lock goes away.
+
+    The function passed to ``do`` is expected to put its result in the
+    cache under ``key``, which is how other processes get to see it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @property
+    def lock_timeout(self):
+        return config.get('CACHE_LOCK_TIMEOUT')
+
+    @property
+    def poll_interval(self):
+        return config.get('CACHE_LOCK_POLL_INTERVAL')
+
+    def do(self, key, func):
+        """Returns ``(value, shared)``
+
+        ``shared`` is True when the value was computed by another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait(self.lock_timeout)
+            if not call.done.is_set():
+                logging.warning(
+                    "Gave up waiting for [{}], computing it".format(key))
+                return func(), False
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value, call.shared = self._do_locked(key, func)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, call.shared
+
+    def _do_locked(self, key, func):
+        lock_key = 'lock_' + key
+        deadline = time.time() + self.lock_timeout
+        while not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            value = cache.get(key)
+            if value is not None:
+                return value, True
+            if time.time() > deadline:
+                logging.warning(
+                    "Gave up waiting on lock [{}], computing it".format(key))
+                return func(), False
+            time.sleep(self.poll_interval)
+        try:
+            # The previous lock holder may have just finished
+            value = cache.get(key)
+            if value is not None:
+                return value, True
+            return func(), False
+        finally:
+            cache.delete(lock_key)
+
+
+single_flight = SingleFlight()
@@ -21,12 +21,73 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Caravel specifix config
 # ---------------------------------------------------------
 ROW_LIMIT = 50000
+# CSV exports are streamed from the database, CSV_EXPORT_CHUNK_SIZE rows at a
+# time. CSV_EXPORT_ROW_LIMIT, when set, replaces the row limit of the slice
+# for exports, which can then be larger than what is practical to display
+CSV_EXPORT_ROW_LIMIT = None
+CSV_EXPORT_CHUNK_SIZE = 10000
 WEBSERVER_THREADS = 8
 
 CARAVEL_WEBSERVER_PORT = 8088
 CARAVEL_WEBSERVER_TIMEOUT = 60
 
 CUSTOM_SECURITY_MANAGER = None
+
+# Connection pooling for the databases registered in Caravel. One engine
+# (and one pool) is kept per database and per worker process. Values
+# set in a database's ``engine_params`` take precedence over these.
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 10
+DATABASE_POOL_TIMEOUT = 30
+DATABASE_POOL_RECYCLE = 3600
+# Issue a lightweight ping when checking out a connection so that stale
+# connections are transparently replaced
+DATABASE_POOL_PRE_PING = True
+
+# Queries running for longer than DATABASE_STATEMENT_TIMEOUT seconds are
+# cancelled, through the database's own setting where there is one
+# (statement_timeout on Postgres and Redshift, max_execution_time on MySQL,
+# max_statement_time on MariaDB, query_max_run_time on Presto), by Caravel
+# otherwise. It can be set per database. None means no timeout.
+DATABASE_STATEMENT_TIMEOUT = None
+
+# Maximum number of queries running at once on a database, or a Druid
+# cluster, across all the web server processes. It can be set per database
+# and per cluster. The queries past the limit wait in line, for at most
+# QUERY_QUEUE_WAIT_BUDGET seconds, after which they fail. The limit holds
+# across processes through the cache, where a running query holds its slot
+# for at most QUERY_SLOT_TIMEOUT seconds, and waiting queries check for a
+# free slot every QUERY_QUEUE_POLL_INTERVAL seconds. None means no limit.
+DATABASE_MAX_CONCURRENT_QUERIES = None
+DRUID_MAX_CONCURRENT_QUERIES = None
+QUERY_QUEUE_WAIT_BUDGET = 30
+QUERY_SLOT_TIMEOUT = 600
+QUERY_QUEUE_POLL_INTERVAL = 0.2
+
+# Number of threads, per web server process, running the queries submitted
+# in the background (``async=true`` on the json endpoints). Background jobs
+# report back through the cache, so they require a CACHE_CONFIG shared
+# across processes, otherwise requests are served synchronously.
+ASYNC_WORKER_THREADS = 4
+# How long (in seconds) the status and results of a background job are kept
+ASYNC_JOB_TIMEOUT = 3600
+
+# Number of threads, per web server process, shared by the charts that need
+# several queries (time series with a time shift for instance) to run them
+# concurrently. This bounds how many queries a process sends at once.
+QUERY_WORKER_THREADS = 8
+
+# The SQL editor runs queries in the background, as jobs, when a cache shared
+# across processes is configured. Their results are stored in the cache
+# and served SQL_EDITOR_PAGE_SIZE rows at a time. SQL_EDITOR_ROW_LIMIT caps
+# the number of rows of a result set, it can be set per database.
+SQL_EDITOR_ROW_LIMIT = 10000
+SQL_EDITOR_PAGE_SIZE = 1000
+
+# The encoder for the json payloads, see caravel/json_encoders.py. 'auto'
+# picks orjson when it is installed and falls back on the ujson bundled in
+# pandas. Can also be set to a function of the same signature.
+JSON_ENCODER = 'auto'
 # ---------------------------------------------------------
 
 # Your App secret key
@@ -132,6 +193,62 @@ IMG_UPLOAD_URL = '/static/uploads/'
 CACHE_DEFAULT_TIMEOUT = None
 CACHE_CONFIG = {'CACHE_TYPE': 'null'}
 
+# Concurrent requests for the same payload are coalesced so that only one of
+# them hits the database. Across processes this relies on a lock stored in
+# the cache, held for at most CACHE_LOCK_TIMEOUT seconds, while the other
+# processes check the cache for the result every CACHE_LOCK_POLL_INTERVAL
+CACHE_LOCK_TIMEOUT = 120
+CACHE_LOCK_POLL_INTERVAL = 0.5
+
+# Result sets are cached on their own, keyed on the query that produced them,
+# so that slices asking for the same data, whatever their visualization type
+# and display options, share a single trip to the database
+CACHE_QUERY_RESULTS = True
+
+# Time series slices cache their result sets per time bucket as well. Buckets
+# that ended more than CACHE_TIME_BUCKETS_GRACE_PERIOD seconds ago are
+# considered final, only the buckets that are still open or missing from the
+# cache get queried. Queries spanning more than CACHE_TIME_BUCKETS_MAX buckets
+# are cached as a whole.
+CACHE_TIME_BUCKETS = True
+CACHE_TIME_BUCKETS_GRACE_PERIOD = 0
+CACHE_TIME_BUCKETS_MAX = 1000
+
+# Relative time ranges ("7 days ago" to "now") resolve to new bounds on every
+# request, which defeats the cache. Snapping rounds the bounds down to a
+# boundary, either a duration ("5 minutes", "1 hour") or "granularity" to use
+# the time grain of the query. Slices and datasources can override this.
+DEFAULT_TIME_SNAP = None
+
+# Queries on tables with rollups (pre-aggregated copies, declared by admins
+# and refreshed with ``caravel refresh_rollups``) are routed to the smallest
+# rollup holding everything they need. Set to False to always read the
+# tables themselves.
+ROLLUP_ROUTING = True
+
+# Tables with a cube grain are held in memory by each web server process,
+# as columnar cubes answering the queries they cover, see caravel/cubes.py.
+# Cubes are reloaded in the background every CUBE_REFRESH_INTERVAL seconds,
+# tables aggregating to more than CUBE_MAX_ROWS rows aren't loaded.
+CUBE_REFRESH_INTERVAL = 60 * 60
+CUBE_MAX_ROWS = 10 ** 7
+
+# Tables reflected from the databases (columns and their types, for the
+# SQL editor and when fetching a table's metadata) are kept by each web
+# server process for REFLECTION_CACHE_TIMEOUT seconds, see
+# caravel/reflection.py. Saving a table in its edit view drops it from the
+# cache. Set to 0 to keep them until then.
+REFLECTION_CACHE_TIMEOUT = 60 * 10
+
+# The SQL editor searches the tables of a database in a catalog kept in the
+# metadata database, rather than listing them all from the database on
+# every page load. Catalogs older than CATALOG_REFRESH_INTERVAL seconds are
+# refreshed in the background when the editor opens, or can be refreshed
+# with ``caravel refresh_catalog``. Searches return at most
+# CATALOG_SEARCH_LIMIT tables.
+CATALOG_REFRESH_INTERVAL = 60 * 60 * 24
+CATALOG_SEARCH_LIMIT = 100
+
 
 # ---------------------------------------------------
 # List of viz_types not allowed in your environment
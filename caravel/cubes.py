@@ -0,0 +1,586 @@
+"""In-memory columnar cubes, answering queries on small and medium tables
+
+A table with a ``cube_grain`` is loaded, aggregated by its groupable and
+filterable columns at that time grain, into a cube held by each web server
+process. Dimensions are dictionary encoded: a column holds the smallest
+integer codes that fit its distinct values, which are kept once. The
+timestamps are encoded the same way, their distinct values being sorted
+so that time bounds translate to a range of codes.
+
+Queries grouping by and filtering on dimensions with ``in`` and ``not in``
+filters, for sum, count, min and max metrics, at the cube's time grain or a
+coarser one, are then answered by group bys over the codes, without going
+to the database. Cubes are loaded in the background on first use, and
+reloaded every ``CUBE_REFRESH_INTERVAL`` seconds.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from six import text_type
+
+from caravel import app, db, jobs, utils
+
+config = app.config
+
+# How the metrics re-aggregate the values of a cube's cells, by metric type
+AGGREGATIONS = {
+    'sum': 'sum',
+    'count': 'count',
+    'min': 'min',
+    'max': 'max',
+}
+
+# Calendar grains that databases all truncate to the same buckets, which
+# cubes can derive from their own grain
+FLOORED_GRAINS = ('second', 'minute', 'hour', 'day', 'month', 'year')
+
+
+def int_dtype(low, high):
+    """Returns the smallest integer dtype holding values from low to high"""
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def encode(values):
+    """Dictionary encodes values, returns their codes and sorted categories
+
+    Nulls get a category of their own, the last one.
+    """
+    codes, categories = pd.factorize(values, sort=True)
+    categories = np.asarray(categories)
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(categories), codes)
+        categories = np.append(
+            categories.astype(object), np.array([None], dtype=object))
+    return codes.astype(int_dtype(0, len(categories))), categories
+
+
+def group_ids(codes, sizes):
+    """Numbers the distinct combinations of codes
+
+    ``codes`` are arrays of codes, each ranging up to the matching size in
+    ``sizes``. Returns the group of each row and, for each array, the codes
+    of the groups, which are ordered like their codes.
+    """
+    rows = len(codes[0])
+    ids = np.zeros(rows, dtype=np.int64)
+    combinations = 1
+    renumbered = False
+    for code, size in zip(codes, sizes):
+        if combinations * size >= 2 ** 62:
+            # Renumbers the combinations seen so far before they overflow
+            ids = np.unique(ids, return_inverse=True)[1].ravel()
+            combinations = int(ids.max()) + 1 if rows else 1
+            renumbered = True
+        ids = ids * size + code
+        combinations *= size
+    if not renumbered and combinations <= 4 * rows + 1024:
+        # Few enough combinations to number the ones seen without sorting
+        seen = np.bincount(ids, minlength=combinations) > 0
+        groups = (np.cumsum(seen) - 1)[ids]
+        keys = np.unravel_index(np.flatnonzero(seen), sizes)
+        return groups, list(keys)
+    _, first, groups = np.unique(ids, return_index=True, return_inverse=True)
+    return groups.ravel(), [code[first] for code in codes]
+
+
+def aggregate(values, how, groups, n_groups):
+    """Aggregates values by group, the way their metric type does
+
+    Like SQL aggregates, null values are ignored, and groups holding
+    nothing else sum up to null, or count zero.
+    """
+    if values.dtype.kind == 'f':
+        nulls = np.isnan(values)
+    else:
+        nulls = np.zeros(len(values), dtype=bool)
+    if how in ('sum', 'count'):
+        result = np.bincount(
+            groups, weights=np.where(nulls, 0, values), minlength=n_groups)
+    elif len(values):
+        order = np.argsort(groups, kind='mergesort')
+        # Only the groups with rows get reduced, the others are left null
+        present = np.unique(groups)
+        starts = np.searchsorted(groups[order], present)
+        reduce_ = np.fmin if how == 'min' else np.fmax
+        result = np.full(n_groups, np.nan)
+        result[present] = reduce_.reduceat(
+            values[order].astype(np.float64), starts)
+    else:
+        result = np.zeros(n_groups)
+    if how != 'count':
+        counts = np.bincount(
+            groups, weights=(~nulls).astype(np.float64), minlength=n_groups)
+        result = np.where(counts == 0, np.nan, result)
+    if values.dtype.kind in 'iu' and not np.isnan(result).any():
+        result = result.astype(np.int64)
+    return result
+
+
+def is_raw_grain(grains, time_grain):
+    """Whether the time grain leaves the timestamps as they are"""
+    if not time_grain:
+        return True
+    grain = grains.get(time_grain)
+    return bool(grain) and grain.function == '{col}'
+
+
+def floored_grains(database):
+    """The grains cubes can derive on this database"""
+    if database.sqlalchemy_uri.startswith('sqlite'):
+        # Its month grain lands on the last day of the previous month
+        return tuple(g for g in FLOORED_GRAINS if g != 'month')
+    return FLOORED_GRAINS
+
+
+def fingerprint(table):
+    """Identifies the definition of the table a cube is loaded from"""
+    s = json.dumps([
+        table.database.sqlalchemy_uri, table.schema, table.table_name,
+        table.cube_grain, table.main_dttm_col,
+        sorted(
+            (c.column_name, c.expression, c.groupby, c.filterable)
+            for c in table.columns),
+        sorted(
+            (m.metric_name, m.expression, m.metric_type)
+            for m in table.metrics),
+    ], default=text_type)
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+class Cube(object):
+
+    """A table aggregated by its dimensions at a time grain, in memory"""
+
+    def __init__(
+            self, table_name, database, granularity, grain, dimensions,
+            time_codes, timestamps, measures, aggregations, fingerprint=None,
+            loaded_on=None, load_duration=None):
+        self.table_name = table_name
+        # The database's time grains, by name, and the ones the cube derives
+        self.grains = database.grains_dict()
+        self.floored_grains = floored_grains(database)
+        self.granularity = granularity
+        self.grain = grain
+        # Column name -> (codes, categories)
+        self.dimensions = dimensions
+        self.time_codes = time_codes
+        self.timestamps = timestamps
+        # Metric name -> values
+        self.measures = measures
+        self.aggregations = aggregations
+        self.fingerprint = fingerprint
+        self.loaded_on = loaded_on or datetime.now()
+        self.load_duration = load_duration
+        self._buckets = {}
+
+    def __repr__(self):
+        return "<Cube {} by {}>".format(self.table_name, self.grain)
+
+    @classmethod
+    def validate(cls, table):
+        """Raises if the table can't be held in a cube"""
+        database = table.database
+        if not database.grains():
+            raise Exception("[{}] has no time grains".format(database))
+        if not table.main_dttm_col:
+            raise Exception(
+                "Cubes need a main datetime column, [{}] has none".format(
+                    table.table_name))
+        grains = database.grains_dict()
+        if (
+                not is_raw_grain(grains, table.cube_grain) and
+                table.cube_grain not in floored_grains(database)):
+            raise Exception(
+                "Cubes need the raw time column or one of these time "
+                "grains: {}".format(", ".join(floored_grains(database))))
+        if table.cube_grain not in grains:
+            raise Exception("[{}] has no [{}] time grain".format(
+                database, table.cube_grain))
+
+    @classmethod
+    def load(cls, table):
+        """Loads a table's cube, out of an aggregate query at its grain"""
+        cls.validate(table)
+        start = datetime.now()
+        granularity = table.main_dttm_col
+        dimensions = [
+            c.column_name for c in table.columns
+            if (c.groupby or c.filterable) and c.column_name != granularity]
+        aggregations = {
+            m.metric_name: AGGREGATIONS[m.metric_type]
+            for m in table.metrics if m.metric_type in AGGREGATIONS}
+        max_rows = config.get('CUBE_MAX_ROWS')
+
+        sql = table.get_query_str(
+            groupby=dimensions,
+            metrics=sorted(aggregations),
+            granularity=granularity,
+            from_dttm=datetime(1900, 1, 1),
+            to_dttm=datetime(9999, 12, 31),
+            filter=[],
+            is_timeseries=True,
+            timeseries_limit=None,
+            row_limit=max_rows + 1 if max_rows else None,
+            extras={'time_grain_sqla': table.cube_grain})
+        df = pd.read_sql_query(sql=sql, con=table.database.get_sqla_engine())
+        if max_rows and len(df.index) > max_rows:
+            raise Exception(
+                "[{}] aggregates to more than {} rows, the CUBE_MAX_ROWS "
+                "setting".format(table.table_name, max_rows))
+
+        timestamps = pd.to_datetime(df.timestamp).values
+        df = df[~pd.isnull(timestamps)]
+        timestamps = timestamps[~pd.isnull(timestamps)]
+        timestamps, time_codes = np.unique(timestamps, return_inverse=True)
+
+        # In the order of the table's metrics, like the columns of its queries
+        measures = OrderedDict()
+        for name in [m.metric_name for m in table.metrics]:
+            if name not in aggregations:
+                continue
+            values = df[name]
+            if values.dtype == object:
+                try:
+                    values = values.astype(np.float64)
+                except (TypeError, ValueError):
+                    logging.warning(
+                        "Metric [{}] isn't numeric, it is left out of the "
+                        "cube of [{}]".format(name, table.table_name))
+                    del aggregations[name]
+                    continue
+            values = values.values
+            if values.dtype.kind in 'iu' and len(values):
+                values = values.astype(int_dtype(values.min(), values.max()))
+            measures[name] = values
+
+        return cls(
+            table_name=table.table_name,
+            database=table.database,
+            granularity=granularity,
+            grain=table.cube_grain,
+            dimensions={
+                name: encode(df[name].values) for name in dimensions},
+            time_codes=time_codes.astype(int_dtype(0, len(timestamps))),
+            timestamps=timestamps,
+            measures=measures,
+            aggregations=aggregations,
+            fingerprint=fingerprint(table),
+            loaded_on=start,
+            load_duration=datetime.now() - start)
+
+    @property
+    def row_count(self):
+        return len(self.time_codes)
+
+    def memory_usage(self):
+        """Returns the bytes held by each column of the cube"""
+        def categories_size(categories):
+            return categories.nbytes + sum(
+                sys.getsizeof(c) for c in categories)
+
+        usage = {
+            name: codes.nbytes + categories_size(categories)
+            for name, (codes, categories) in self.dimensions.items()}
+        usage.update({
+            name: values.nbytes for name, values in self.measures.items()})
+        usage[self.granularity] = (
+            self.time_codes.nbytes + self.timestamps.nbytes)
+        return usage
+
+    def stats(self):
+        usage = self.memory_usage()
+        return {
+            'grain': self.grain,
+            'rows': self.row_count,
+            'bytes': sum(usage.values()),
+            'bytes_by_column': usage,
+            'loaded_on': self.loaded_on.isoformat(),
+            'load_duration': self.load_duration.total_seconds(),
+        }
+
+    def can_serve(
+            self, groupby, metrics, granularity, from_dttm, to_dttm,
+            filter=None, is_timeseries=True, extras=None,  # noqa
+            columns=None, grouping_sets=False, percentiles=None,
+            window=None, **kwargs):
+        """Whether the query can be answered out of the cube
+
+        Time series need the cube's grain, or a coarser one it derives.
+        Unless the cube holds the raw timestamps, the time range has to
+        start on a bucket and end with one, or after the cube was loaded.
+        """
+        extras = extras or {}
+        filter = filter or []  # noqa
+        if (
+                columns or grouping_sets or percentiles or window or
+                not metrics or
+                extras.get('where') or extras.get('having') or
+                granularity != self.granularity or
+                not set(groupby or []) <= set(self.dimensions) or
+                not set(metrics) <= set(self.measures) or
+                any(
+                    col not in self.dimensions or op not in ('in', 'not in')
+                    for col, op, eq in filter)):
+            return False
+
+        raw = is_raw_grain(self.grains, self.grain)
+        time_grain = extras.get('time_grain_sqla')
+        same_grain = time_grain == self.grain or (
+            raw and is_raw_grain(self.grains, time_grain))
+        if is_timeseries and not same_grain:
+            grains = self.floored_grains
+            if (
+                    time_grain not in grains or
+                    time_grain not in self.grains or
+                    not raw and
+                    grains.index(time_grain) < grains.index(self.grain)):
+                return False
+        if raw:
+            return True
+
+        end = to_dttm + timedelta(microseconds=1)
+        return (
+            utils.floor_datetime(from_dttm, self.grain) == from_dttm and
+            (utils.floor_datetime(end, self.grain) == end or
+                to_dttm >= self.loaded_on))
+
+    def time_mask(self, from_dttm, to_dttm):
+        """Selects the cells from one time bound to the other, included"""
+        low = np.searchsorted(
+            self.timestamps, np.datetime64(from_dttm), side='left')
+        high = np.searchsorted(
+            self.timestamps, np.datetime64(to_dttm), side='right')
+        return (self.time_codes >= low) & (self.time_codes < high)
+
+    def filter_mask(self, filter):  # noqa
+        """Selects the cells the ``in`` and ``not in`` filters let through
+
+        Like in SQL, null values match neither kind of filter.
+        """
+        mask = np.ones(self.row_count, dtype=bool)
+        for col, op, eq in filter:
+            codes, categories = self.dimensions[col]
+            values = set(eq.split(","))
+            selected = np.array([
+                c is not None and (text_type(c) in values) == (op == 'in')
+                for c in categories], dtype=bool)
+            mask &= selected[codes]
+        return mask
+
+    def buckets(self, time_grain):
+        """Maps the cube's timestamps to the buckets of a coarser time grain"""
+        if (
+                is_raw_grain(self.grains, time_grain) or
+                time_grain == self.grain):
+            return np.arange(len(self.timestamps)), self.timestamps
+        if time_grain not in self._buckets:
+            floored = utils.floor_timestamps(self.timestamps, time_grain)
+            buckets, codes = np.unique(floored, return_inverse=True)
+            self._buckets[time_grain] = (codes.ravel(), buckets)
+        return self._buckets[time_grain]
+
+    def aggregate(self, mask, groupby, metrics, time_codes=None, n_times=0):
+        """Groups the selected cells, returns the key codes and metrics"""
+        codes = [self.dimensions[col][0][mask] for col in groupby]
+        sizes = [len(self.dimensions[col][1]) for col in groupby]
+        if time_codes is not None:
+            codes.append(time_codes[mask])
+            sizes.append(n_times)
+        rows = int(mask.sum())
+        if codes:
+            groups, keys = group_ids(codes, sizes)
+            n_groups = len(keys[0])
+        else:
+            # Like SQL, no group by gives a single row, even out of nothing
+            groups, keys, n_groups = np.zeros(rows, dtype=np.int64), [], 1
+        values = {
+            m: aggregate(
+                self.measures[m][mask], self.aggregations[m], groups,
+                n_groups)
+            for m in metrics}
+        return keys, values
+
+    def top_groups_mask(self, inner_mask, mask, groupby, metric, limit):
+        """Selects the cells of the groups ranking first by the metric
+
+        Groups are ranked over the cells of ``inner_mask``, and only the
+        ones with cells there are ranked at all, like with the inner join
+        on the top groups subquery in SQL.
+        """
+        either = inner_mask | mask
+        selected = np.zeros(self.row_count, dtype=bool)
+        if not either.any():
+            return selected
+        groups, keys = group_ids(
+            [self.dimensions[col][0][either] for col in groupby],
+            [len(self.dimensions[col][1]) for col in groupby])
+        n_groups = len(keys[0])
+        inner = inner_mask[either]
+        totals = aggregate(
+            self.measures[metric][either][inner], self.aggregations[metric],
+            groups[inner], n_groups)
+        ranked = np.flatnonzero(
+            np.bincount(groups[inner], minlength=n_groups) > 0)
+        top = ranked[np.argsort(
+            -totals[ranked].astype(np.float64), kind='mergesort')[:limit]]
+        is_top = np.zeros(n_groups, dtype=bool)
+        is_top[top] = True
+        for col, key in zip(groupby, keys):
+            # Nulls never match in the join, their groups are left out
+            categories = self.dimensions[col][1]
+            if len(categories) and categories[-1] is None:
+                is_top &= key != len(categories) - 1
+        selected[either] = is_top[groups]
+        return selected
+
+    def query(
+            self, groupby, metrics, granularity, from_dttm, to_dttm,
+            filter=None, is_timeseries=True,  # noqa
+            timeseries_limit=15, row_limit=None,
+            inner_from_dttm=None, inner_to_dttm=None,
+            extras=None, **kwargs):
+        """Answers the query, returns the dataframe SqlaTable.query would"""
+        extras = extras or {}
+        filter_mask = self.filter_mask(filter or [])
+        mask = filter_mask & self.time_mask(from_dttm, to_dttm)
+        main_metric = metrics[0]
+
+        if timeseries_limit and groupby:
+            mask &= self.top_groups_mask(
+                filter_mask & self.time_mask(
+                    inner_from_dttm or from_dttm, inner_to_dttm or to_dttm),
+                mask, groupby, main_metric, timeseries_limit)
+
+        if is_timeseries:
+            time_codes, buckets = self.buckets(extras.get('time_grain_sqla'))
+            keys, values = self.aggregate(
+                mask, groupby, metrics, time_codes[self.time_codes],
+                len(buckets))
+        else:
+            keys, values = self.aggregate(mask, groupby, metrics)
+
+        df = pd.DataFrame()
+        for col, key in zip(groupby, keys):
+            df[col] = self.dimensions[col][1][key]
+        if is_timeseries:
+            df['timestamp'] = buckets[keys[-1]]
+        for m in self.measures:
+            if m in metrics:
+                df[m] = values[m]
+
+        if groupby:
+            order = np.argsort(
+                -df[main_metric].values.astype(np.float64), kind='mergesort')
+            df = df.iloc[order].reset_index(drop=True)
+        if row_limit:
+            df = df[:row_limit]
+        return df
+
+
+class CubeRegistry(object):
+
+    """Keeps the cube of each table, loading them in the background
+
+    Cubes are keyed on the table id, and only served as long as the table
+    definition they were loaded from doesn't change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cubes = {}
+        self._loading = set()
+        self._failures = {}
+
+    def get(self, table):
+        """Returns the table's cube, if loaded, (re)loading it when due
+
+        Until the first load completes, the table is queried as usual.
+        A stale cube is served while its replacement loads.
+        """
+        key = fingerprint(table)
+        interval = timedelta(seconds=config.get('CUBE_REFRESH_INTERVAL'))
+        now = datetime.now()
+        with self._lock:
+            cube = self._cubes.get(table.id)
+            if cube and cube.fingerprint != key:
+                cube = None
+            failure = self._failures.get(table.id)
+            due = (
+                (not cube or cube.loaded_on + interval < now) and
+                (not failure or failure[0] + interval < now) and
+                table.id not in self._loading)
+            if due:
+                self._loading.add(table.id)
+        if due:
+            jobs.get_pool().apply_async(
+                self._load_in_background, (type(table), table.id))
+        return cube
+
+    def load(self, table):
+        """Loads the table's cube right away"""
+        try:
+            cube = Cube.load(table)
+        except Exception as e:
+            logging.exception(e)
+            with self._lock:
+                self._failures[table.id] = (datetime.now(), text_type(e))
+            raise
+        with self._lock:
+            self._cubes[table.id] = cube
+            self._failures.pop(table.id, None)
+        logging.info("Loaded {}, {} rows in {}".format(
+            cube, cube.row_count, cube.load_duration))
+        return cube
+
+    def _load_in_background(self, table_class, table_id):
+        with app.app_context():
+            try:
+                table = db.session.query(table_class).get(table_id)
+                if table and table.cube_grain:
+                    self.load(table)
+            except Exception:
+                # Logged and kept for the stats by load, the table is
+                # queried as usual until the next attempt
+                pass
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._loading.discard(table_id)
+
+    def drop(self, table_id):
+        """Frees the cube of a table"""
+        with self._lock:
+            self._cubes.pop(table_id, None)
+            self._failures.pop(table_id, None)
+
+    def stats(self, table_id):
+        """Returns the size and freshness of a table's cube"""
+        with self._lock:
+            cube = self._cubes.get(table_id)
+            failure = self._failures.get(table_id)
+            loading = table_id in self._loading
+        d = cube.stats() if cube else {}
+        d['loading'] = loading
+        if failure:
+            d['failed_on'] = failure[0].isoformat()
+            d['error'] = failure[1]
+        return d
+
+
+registry = CubeRegistry()
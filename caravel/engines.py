@@ -0,0 +1,230 @@
+"""Process-wide registry of SqlAlchemy engines for the Caravel databases
+
+Creating an engine also creates a connection pool, so building one per
+query means paying for a new connection every time. The registry keeps one
+engine per ``Database`` in each worker process and hands it out as long as
+the decrypted URI, the ``engine_params`` and the statement timeout it was
+built from don't change.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from caravel import app, inflight
+
+config = app.config
+
+
+class InstrumentedQueuePool(QueuePool):
+
+    """A QueuePool that keeps track of checkouts and time spent waiting"""
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.time() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts = self.checkouts
+            wait_total = self.wait_total
+            d = {
+                'checkouts': checkouts,
+                'timeouts': self.timeouts,
+                'wait_max': self.wait_max,
+            }
+        d.update({
+            'pool_size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'wait_total': wait_total,
+            'wait_avg': wait_total / checkouts if checkouts else 0.0,
+        })
+        return d
+
+
+def ping_connection(connection, branch):
+    """Pessimistic disconnect handling, tests connections on checkout
+
+    If the ping fails because the connection was dropped on the server
+    side, SqlAlchemy invalidates the whole pool and the ping is retried
+    on a fresh connection.
+    """
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def set_statement_timeout(dbapi_connection, dialect_name, timeout):
+    """Sets the server side statement timeout of a new connection
+
+    Servers that don't support one, like MySQL before 5.7.8 or MariaDB
+    before 10.1, only get a warning in the logs: the timeout is then
+    enforced by Caravel, see ``inflight``.
+    """
+    ms = int(timeout * 1000)
+    cursor = dbapi_connection.cursor()
+    try:
+        if dialect_name in ('postgresql', 'redshift'):
+            cursor.execute('SET statement_timeout = {:d}'.format(ms))
+            # Settings made in a transaction that's rolled back don't stick
+            dbapi_connection.commit()
+        elif dialect_name == 'mysql':
+            cursor.execute('SELECT VERSION()')
+            if 'mariadb' in cursor.fetchone()[0].lower():
+                # MariaDB's flavor, in seconds. MySQL 5.7.4 to 5.7.7 have a
+                # max_statement_time as well, in milliseconds.
+                cursor.execute(
+                    'SET SESSION max_statement_time = {:f}'.format(timeout))
+            else:
+                cursor.execute(
+                    'SET SESSION max_execution_time = {:d}'.format(ms))
+    except Exception as e:
+        logging.warning(
+            "Couldn't set the statement timeout of a connection, Caravel "
+            "enforces it instead: {}".format(e))
+        try:
+            dbapi_connection.rollback()
+        except Exception:
+            pass
+    finally:
+        cursor.close()
+
+
+class EngineRegistry(object):
+
+    """Keeps one engine per database id, rebuilt when its settings change"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = {}
+
+    @staticmethod
+    def fingerprint(uri, params, statement_timeout=None):
+        s = json.dumps(
+            [uri, params, statement_timeout], sort_keys=True, default=str)
+        return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def create(uri, params, database_id=None, statement_timeout=None):
+        """Creates an engine, applying the pool settings from the config
+
+        The statement timeout, in seconds, is set on the connections of
+        the databases that support one server side, and otherwise enforced
+        by cancelling the queries that run past it, see ``inflight``.
+        """
+        params = dict(params)
+        url = make_url(uri)
+        if statement_timeout and url.drivername.startswith('presto'):
+            connect_args = dict(params.get('connect_args', {}))
+            session_props = dict(connect_args.get('session_props', {}))
+            session_props.setdefault(
+                'query_max_run_time', '{:d}s'.format(int(statement_timeout)))
+            connect_args['session_props'] = session_props
+            params['connect_args'] = connect_args
+        poolclass = url.get_dialect().get_pool_class(url)
+        if 'poolclass' not in params and issubclass(poolclass, QueuePool):
+            params['poolclass'] = InstrumentedQueuePool
+            params.setdefault('pool_size', config.get('DATABASE_POOL_SIZE'))
+            params.setdefault(
+                'max_overflow', config.get('DATABASE_MAX_OVERFLOW'))
+            params.setdefault(
+                'pool_timeout', config.get('DATABASE_POOL_TIMEOUT'))
+        if config.get('DATABASE_POOL_RECYCLE'):
+            params.setdefault(
+                'pool_recycle', config.get('DATABASE_POOL_RECYCLE'))
+        engine = create_engine(uri, **params)
+        if config.get('DATABASE_POOL_PRE_PING'):
+            event.listen(engine, 'engine_connect', ping_connection)
+        if statement_timeout:
+            dialect_name = engine.dialect.name
+
+            def on_connect(dbapi_connection, connection_record):
+                set_statement_timeout(
+                    dbapi_connection, dialect_name, statement_timeout)
+            event.listen(engine, 'connect', on_connect)
+        inflight.registry.attach(
+            engine, database_id, statement_timeout=statement_timeout)
+        return engine
+
+    def get(self, database_id, uri, params, statement_timeout=None):
+        """Returns the engine for a database, creating it if needed"""
+        key = self.fingerprint(uri, params, statement_timeout)
+        stale = None
+        with self._lock:
+            entry = self._engines.get(database_id)
+            if entry and entry[0] == key:
+                return entry[1]
+            if entry:
+                stale = entry[1]
+            engine = self.create(
+                uri, params, database_id=database_id,
+                statement_timeout=statement_timeout)
+            self._engines[database_id] = (key, engine)
+        if stale:
+            logging.info(
+                "Settings for database [{}] changed, "
+                "replacing its engine".format(database_id))
+            stale.dispose()
+        return engine
+
+    def invalidate(self, database_id):
+        """Drops and disposes of the engine for a database"""
+        with self._lock:
+            entry = self._engines.pop(database_id, None)
+        if entry:
+            entry[1].dispose()
+
+    def stats(self, database_id):
+        """Returns checkout and wait statistics for a database's pool"""
+        with self._lock:
+            entry = self._engines.get(database_id)
+        if not entry:
+            return {}
+        pool = entry[1].pool
+        if isinstance(pool, InstrumentedQueuePool):
+            return pool.stats()
+        return {'status': pool.status()}
+
+
+registry = EngineRegistry()
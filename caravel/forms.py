@@ -192,6 +192,13 @@ class FormFactory(object):
                 'Stacked Bars',
                 default=False,
                 description=""),
+            'percentiles_in_sql': BetterBooleanField(
+                'Percentiles in SQL',
+                default=False,
+                description=(
+                    "Compute the quartiles in the database with "
+                    "PERCENTILE_CONT, on the databases supporting it. "
+                    "Only applies to min/max whiskers")),
             'include_series': BetterBooleanField(
                 'Include Series',
                 default=False,
@@ -356,6 +363,21 @@ class FormFactory(object):
                     '90 days ago',
                     '1 year ago'])
             ),
+            'time_snap': FreeFormSelectField(
+                'Snap Time Range', default='',
+                choices=[
+                    ('', 'datasource default'),
+                    ('1 minute', '1 minute'),
+                    ('5 minutes', '5 minutes'),
+                    ('1 hour', '1 hour'),
+                    ('1 day', '1 day'),
+                    ('granularity', 'granularity'),
+                ],
+                description=(
+                    "Rounds the [Since] and [Until] bounds down to a time "
+                    "boundary so that relative time ranges like '7 days ago' "
+                    "resolve to the same query, and cache entry, for a "
+                    "while. [granularity] snaps to the time granularity")),
             'max_bubble_size': FreeFormSelectField(
                 'Max Bubble Size', default="25",
                 choices=self.choicify([
@@ -587,6 +609,29 @@ class FormFactory(object):
             'contribution': BetterBooleanField(
                 "Contribution", default=False,
                 description="Compute the contribution to the total"),
+            'analytics_in_sql': BetterBooleanField(
+                "Analytics in SQL", default=False,
+                description=(
+                    "Compute the contribution, period ratio and rolling "
+                    "windows in the database, with window functions, on the "
+                    "databases supporting them. This assumes every series "
+                    "has a value for each timestamp")),
+            'max_points': IntegerField(
+                "Max Points", default=None,
+                validators=[validators.optional()],
+                description=(
+                    "[integer] Downsamples the series to about this many "
+                    "timestamps, shared by all of them, before sending them "
+                    "to the browser, leave empty to keep every point")),
+            'downsampling': SelectField(
+                "Downsampling", default='lttb',
+                choices=(
+                    ('lttb', 'Largest Triangle Three Buckets'),
+                    ('minmax', 'Min / Max per bucket'),
+                ),
+                description=(
+                    "How points are picked when downsampling, min / max "
+                    "keeps every peak")),
             'num_period_compare': IntegerField(
                 "Period Ratio", default=None,
                 validators=[validators.optional()],
@@ -600,7 +645,8 @@ class FormFactory(object):
                     "Overlay a timeseries from a "
                     "relative time period. Expects relative time delta "
                     "in natural language (example: 24 hours, 7 days, "
-                    "56 weeks, 365 days")),
+                    "56 weeks, 365 days). Separate several deltas with "
+                    "commas to overlay as many periods")),
             'subheader': TextField(
                 'Subheader',
                 description=(
@@ -700,13 +746,14 @@ class FormFactory(object):
             add_to_form(('granularity', 'druid_time_origin'))
             field_css_classes['granularity'] = ['form-control', 'select2_freeform']
             field_css_classes['druid_time_origin'] = ['form-control', 'select2_freeform']
-        add_to_form(('since', 'until'))
+        add_to_form(('since', 'until', 'time_snap'))
 
         QueryForm.fieldsets = ({
             'label': 'Time',
             'fields': (
                 time_fields,
                 ('since', 'until'),
+                'time_snap',
             ),
             'description': "Time related form attributes",
         },) + tuple(QueryForm.fieldsets)
@@ -0,0 +1,268 @@
+"""Process-wide registry of the queries running against the databases
+
+Every statement executed on an engine of the ``engines`` registry is
+tracked, along with the driver's connection and cursor, from the moment its
+cursor is handed to the driver until it returns. The statements streaming
+their results stay tracked until their connection goes back to the pool.
+A statement can then be cancelled from another thread in three ways:
+
+- by an admin,
+- by the user who started it, through the async job API,
+- once it runs past the statement timeout of its database, which only
+  applies until the driver returns, not while the results are streamed.
+
+A watcher thread, started on first use, enforces the timeouts and
+picks up the cancellations requested through the cache, which is how a
+query running in a web server process gets cancelled from another one.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import event
+
+from caravel import app, cache
+
+config = app.config
+
+# How often, in seconds, the watcher checks the running queries
+WATCH_INTERVAL = 1
+
+
+class QueryCancelled(Exception):
+
+    """Raised in place of the driver's error for the cancelled queries"""
+
+
+def cancel_key(query_id):
+    return 'inflight_{}_cancelled'.format(query_id)
+
+
+class InflightQuery(object):
+
+    """A statement being executed, with the driver handles to cancel it"""
+
+    def __init__(
+            self, engine, database_id, sql, dbapi_connection, cursor,
+            timeout=None, job_id=None, user_id=None):
+        self.id = uuid.uuid4().hex
+        self.engine = engine
+        self.database_id = database_id
+        self.sql = sql
+        self.dbapi_connection = dbapi_connection
+        self.cursor = cursor
+        self.job_id = job_id
+        self.user_id = user_id
+        self.started = time.time()
+        self.deadline = self.started + timeout if timeout else None
+        self.timeout = timeout
+        self.cancelled = None
+
+    def cancel(self, reason):
+        """Asks the driver to abort the statement
+
+        Depending on the driver, the statement is cancelled through its
+        cursor (pyhive, pyodbc), its connection (psycopg2, cx_Oracle,
+        sqlite's interrupt) or, for MySQL, with a KILL QUERY sent on
+        another connection.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = reason
+        logging.info("Cancelling query {} on database [{}]: {}".format(
+            self.id, self.database_id, reason))
+        try:
+            for obj, method in (
+                    (self.cursor, 'cancel'),
+                    (self.dbapi_connection, 'cancel'),
+                    (self.dbapi_connection, 'interrupt')):
+                if hasattr(obj, method):
+                    getattr(obj, method)()
+                    return
+            if self.engine.dialect.name == 'mysql':
+                thread_id = self.dbapi_connection.thread_id()
+                self.engine.execute('KILL QUERY {:d}'.format(thread_id))
+                return
+            logging.warning(
+                "Don't know how to cancel queries on database [{}]".format(
+                    self.database_id))
+        except Exception as e:
+            logging.exception(e)
+
+    def data(self):
+        return {
+            'id': self.id,
+            'database_id': self.database_id,
+            'sql': self.sql,
+            'job_id': self.job_id,
+            'user_id': self.user_id,
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'duration': time.time() - self.started,
+            'timeout': self.timeout,
+            'cancelled': self.cancelled,
+        }
+
+
+class InflightRegistry(object):
+
+    """Keeps track of the queries running in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._executions = {}
+        # The streaming executions, by the id of their driver's connection
+        self._streams = {}
+        self._context = threading.local()
+        self._watcher = None
+
+    @contextmanager
+    def annotate(self, job_id=None, user_id=None):
+        """Tags the queries run by the current thread in the block"""
+        previous = getattr(self._context, 'tags', None)
+        self._context.tags = {'job_id': job_id, 'user_id': user_id}
+        try:
+            yield
+        finally:
+            self._context.tags = previous
+
+    def attach(self, engine, database_id, statement_timeout=None):
+        """Tracks the statements executed on an engine"""
+
+        def before_cursor_execute(
+                conn, cursor, statement, parameters, context, executemany):
+            tags = getattr(self._context, 'tags', None) or {}
+            query = InflightQuery(
+                engine, database_id, statement, conn.connection.connection,
+                cursor, timeout=statement_timeout, **tags)
+            self.register(query, context or cursor)
+
+        def after_cursor_execute(
+                conn, cursor, statement, parameters, context, executemany):
+            if context is not None and context.execution_options.get(
+                    'stream_results'):
+                # The rows are still to be fetched, the statement runs on
+                # until the result or its connection is closed
+                with self._lock:
+                    self._streams.setdefault(
+                        id(conn.connection.connection), []).append(context)
+                    query = self._queries.get(
+                        self._executions.get(id(context)))
+                # Slow downloads are no reason to cancel it, only an admin
+                # or its user can from now on
+                if query:
+                    query.deadline = None
+            else:
+                self.unregister(context or cursor)
+
+        def checkin(dbapi_connection, *args):
+            with self._lock:
+                executions = self._streams.pop(id(dbapi_connection), [])
+            for execution in executions:
+                self.unregister(execution)
+
+        def handle_error(exception_context):
+            query = self.unregister(
+                exception_context.execution_context or
+                exception_context.cursor)
+            if query and query.cancelled:
+                raise QueryCancelled(query.cancelled)
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'handle_error', handle_error)
+        event.listen(engine, 'checkin', checkin)
+        event.listen(engine, 'invalidate', checkin)
+
+    def register(self, query, execution):
+        """Tracks a query, until ``unregister`` is called with ``execution``
+
+        Executions are identified by their SqlAlchemy execution context,
+        or their cursor for the statements run without one.
+        """
+        with self._lock:
+            self._queries[query.id] = query
+            self._executions[id(execution)] = query.id
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch)
+                self._watcher.daemon = True
+                self._watcher.start()
+
+    def unregister(self, execution):
+        if execution is None:
+            return
+        with self._lock:
+            query_id = self._executions.pop(id(execution), None)
+            return self._queries.pop(query_id, None)
+
+    def list(self, database_id=None):
+        """Returns the queries running in this process, oldest first"""
+        with self._lock:
+            queries = list(self._queries.values())
+        return sorted(
+            [q.data() for q in queries
+             if database_id is None or q.database_id == database_id],
+            key=lambda q: q['started'])
+
+    def get(self, query_id):
+        with self._lock:
+            return self._queries.get(query_id)
+
+    def cancel(self, query_id, reason="Cancelled"):
+        """Cancels a query, whichever web server process runs it
+
+        Returns whether the query runs in this process.
+        """
+        query = self.get(query_id)
+        if query:
+            query.cancel(reason)
+            return True
+        cache.set(
+            cancel_key(query_id), reason,
+            timeout=config.get('ASYNC_JOB_TIMEOUT'))
+        return False
+
+    def cancel_job(self, job_id, reason="Cancelled"):
+        """Cancels the queries of a background job run by this process"""
+        with self._lock:
+            queries = [
+                q for q in self._queries.values() if q.job_id == job_id]
+        for query in queries:
+            query.cancel(reason)
+        return bool(queries)
+
+    def _watch(self):
+        # Imported here as jobs tags the queries it runs through this module
+        from caravel import jobs
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            try:
+                with self._lock:
+                    queries = list(self._queries.values())
+                now = time.time()
+                for query in queries:
+                    if query.cancelled:
+                        continue
+                    if query.deadline and query.deadline < now:
+                        query.cancel(
+                            "The query exceeded the statement timeout of "
+                            "{} seconds".format(query.timeout))
+                    elif query.job_id and jobs.is_cancelled(query.job_id):
+                        query.cancel("The query was cancelled")
+                    else:
+                        reason = cache.get(cancel_key(query.id))
+                        if reason:
+                            query.cancel(reason)
+            except Exception as e:
+                logging.exception(e)
+
+
+registry = InflightRegistry()
@@ -0,0 +1,171 @@
+"""Background execution of long running queries
+
+Jobs run on a thread pool local to the web server process, which frees
+the worker that received the request while the database does the work.
+Their status and results go into the cache, so that any web server
+process can answer when the client polls for them.
+
+A second pool runs the queries behind a single chart concurrently, see
+``run_concurrently``.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from caravel import app, cache, db, inflight
+
+config = app.config
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_pool = None
+_pool_lock = threading.Lock()
+_query_pool = None
+_query_thread = threading.local()
+
+
+def get_pool():
+    """Returns the process' thread pool, created on first use
+
+    Creating it lazily makes sure each forked web server process gets
+    its own threads.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(config.get('ASYNC_WORKER_THREADS'))
+    return _pool
+
+
+def get_query_pool():
+    """Returns the process' pool for concurrent queries, created on first use"""
+    global _query_pool
+    with _pool_lock:
+        if _query_pool is None:
+            _query_pool = ThreadPool(config.get('QUERY_WORKER_THREADS'))
+    return _query_pool
+
+
+def run_concurrently(funcs):
+    """Calls the functions on the query pool, returns their results in order
+
+    Each call gets its own app context and database session, so the ORM
+    objects the functions use should have their relationships loaded by
+    the caller. The first exception raised is raised again here. Calls
+    made from the pool's own threads, or with a single function, run
+    inline rather than risk waiting on a saturated pool.
+    """
+    funcs = list(funcs)
+    if len(funcs) < 2 or getattr(_query_thread, 'active', False):
+        return [func() for func in funcs]
+    return get_query_pool().map(_call, funcs)
+
+
+def _call(func):
+    _query_thread.active = True
+    with app.app_context():
+        try:
+            return func()
+        finally:
+            db.session.remove()
+            _query_thread.active = False
+
+
+def is_enabled():
+    """Whether jobs can report back through the cache"""
+    cache_config = config.get('CACHE_CONFIG') or {}
+    return cache_config.get('CACHE_TYPE', 'null') != 'null'
+
+
+class JobCancelled(Exception):
+
+    """Raised by the jobs that notice they were cancelled"""
+
+
+def job_key(job_id):
+    return 'job_' + job_id
+
+
+def set_status(job_id, status, **kwargs):
+    job = get_status(job_id) or {'job_id': job_id}
+    job.update(kwargs)
+    job['status'] = status
+    cache.set(job_key(job_id), job, timeout=config.get('ASYNC_JOB_TIMEOUT'))
+    return job
+
+
+def get_status(job_id):
+    return cache.get(job_key(job_id))
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def submit(func, *args, **kwargs):
+    """Runs ``func(*args, **kwargs)`` in the background, returns a job id
+
+    ``user_id`` can be passed as a keyword argument to record who owns
+    the job, and ``job_id`` to pick the id of the job, for functions that
+    need to know it. Neither is passed along to ``func``.
+    """
+    user_id = kwargs.pop('user_id', None)
+    job_id = kwargs.pop('job_id', None) or new_job_id()
+    set_status(job_id, PENDING, user_id=user_id)
+    get_pool().apply_async(_run, (job_id, func, args, kwargs, user_id))
+    return job_id
+
+
+def cancel(job_id):
+    """Flags a job as cancelled
+
+    Pending jobs don't start, running ones are expected to check
+    ``is_cancelled`` as they go and raise ``JobCancelled``. The query the
+    job is waiting on, if any, is cancelled as well.
+    """
+    cache.set(
+        job_key(job_id) + '_cancelled', True,
+        timeout=config.get('ASYNC_JOB_TIMEOUT'))
+    inflight.registry.cancel_job(job_id)
+    job = get_status(job_id)
+    if job and job['status'] in (PENDING, RUNNING):
+        set_status(job_id, CANCELLED)
+
+
+def is_cancelled(job_id):
+    return bool(cache.get(job_key(job_id) + '_cancelled'))
+
+
+def _run(job_id, func, args, kwargs, user_id=None):
+    if is_cancelled(job_id):
+        return
+    set_status(job_id, RUNNING)
+    with app.app_context(), inflight.registry.annotate(job_id, user_id):
+        try:
+            payload = func(*args, **kwargs)
+        except JobCancelled:
+            set_status(job_id, CANCELLED)
+        except Exception as e:
+            if is_cancelled(job_id):
+                set_status(job_id, CANCELLED)
+            else:
+                logging.exception(e)
+                set_status(job_id, FAILED, error=str(e))
+        else:
+            if is_cancelled(job_id):
+                # Cancelled while finishing, the client was told so already
+                set_status(job_id, CANCELLED)
+            else:
+                set_status(job_id, SUCCESS, payload=payload)
+        finally:
+            db.session.remove()
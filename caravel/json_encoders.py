@@ -0,0 +1,115 @@
+"""Pluggable JSON encoding for the payloads served to the frontend
+
+Payloads are built out of pandas dataframes, so they are full of numpy
+scalars and arrays, timestamps, NaNs and NaTs. The encoder, picked by the
+JSON_ENCODER config, is expected to deal with those natively rather than
+through a Python callback for every value.
+
+Datetimes are encoded either as milliseconds since the epoch (``EPOCH``),
+what the charting libraries consume, or as ISO 8601 strings (``ISO``).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import decimal
+import functools
+import json
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from pandas.io.json import dumps as pandas_dumps
+
+from caravel import app
+
+config = app.config
+
+EPOCH = 'epoch'
+ISO = 'iso'
+
+
+def default(obj, dttm_format=EPOCH):
+    """Turns what json encoders don't know about into plain values"""
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, (datetime, date)):
+        if dttm_format == ISO:
+            return obj.isoformat()
+        return int(pd.Timestamp(obj).value // 10 ** 6)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return None if np.isnan(obj) else float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'M':
+            return [default(o, dttm_format) for o in pd.to_datetime(obj)]
+        return obj.tolist()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(
+        "Unserializable object {} of type {}".format(obj, type(obj)))
+
+
+def pandas_encoder(obj, dttm_format=EPOCH):
+    """Encodes with the ujson bundled in pandas
+
+    It handles numpy types natively, but only knows how to write dates
+    as epochs, ISO dates go through the standard library, which writes
+    NaN floats as is.
+    """
+    if dttm_format == ISO:
+        return json.dumps(
+            obj, default=functools.partial(default, dttm_format=ISO))
+    return pandas_dumps(obj, default_handler=default)
+
+
+def orjson_encoder(obj, dttm_format=EPOCH):
+    """Encodes with orjson, which serializes numpy arrays natively
+
+    Note that orjson always writes arrays of numpy datetimes as ISO dates.
+    """
+    import orjson
+    option = (
+        orjson.OPT_SERIALIZE_NUMPY |
+        orjson.OPT_NON_STR_KEYS |
+        orjson.OPT_PASSTHROUGH_DATETIME)
+    return orjson.dumps(
+        obj,
+        default=functools.partial(default, dttm_format=dttm_format),
+        option=option,
+    ).decode('utf-8')
+
+
+ENCODERS = {
+    'pandas': pandas_encoder,
+    'orjson': orjson_encoder,
+}
+
+
+def get_encoder(name=None):
+    """Returns the encoder function configured in JSON_ENCODER
+
+    JSON_ENCODER is either the name of one of the ENCODERS, 'auto' to
+    use orjson when it is installed, or a function with the same
+    signature as the ENCODERS.
+    """
+    encoder = name or config.get('JSON_ENCODER') or 'auto'
+    if callable(encoder):
+        return encoder
+    if encoder == 'auto':
+        try:
+            import orjson  # noqa
+            encoder = 'orjson'
+        except ImportError:
+            encoder = 'pandas'
+    return ENCODERS[encoder]
+
+
+def dumps(obj, dttm_format=EPOCH):
+    return get_encoder()(obj, dttm_format=dttm_format)
@@ -0,0 +1,26 @@
+"""time_snap
+
+Revision ID: 3b626e2a6783
+Revises: 956a063c52b3
+Create Date: 2016-05-20 10:12:41.230481
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b626e2a6783'
+down_revision = '956a063c52b3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('datasources', sa.Column('time_snap', sa.String(length=64), nullable=True))
+    op.add_column('tables', sa.Column('time_snap', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('tables') as batch_op:
+        batch_op.drop_column('time_snap')
+    with op.batch_alter_table('datasources') as batch_op:
+        batch_op.drop_column('time_snap')
@@ -0,0 +1,23 @@
+"""cube_grain
+
+Revision ID: 7c6b9e3d41f2
+Revises: a6c18f869a4e
+Create Date: 2016-06-01 11:08:37.520193
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c6b9e3d41f2'
+down_revision = 'a6c18f869a4e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('tables', sa.Column('cube_grain', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('tables') as batch_op:
+        batch_op.drop_column('cube_grain')
@@ -0,0 +1,41 @@
+"""catalog_tables
+
+Revision ID: 9b1e4c7d3a52
+Revises: 7c6b9e3d41f2
+Create Date: 2016-06-03 16:21:48.302816
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b1e4c7d3a52'
+down_revision = '7c6b9e3d41f2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('catalog_tables',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('database_id', sa.Integer(), nullable=False),
+        sa.Column('schema', sa.String(length=255), nullable=True),
+        sa.Column('table_name', sa.String(length=255), nullable=True),
+        sa.Column('columns', sa.Text(), nullable=True),
+        sa.Column('last_refreshed', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['database_id'], ['dbs.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint(
+            'database_id', 'schema', 'table_name', name='_catalog_table_uc')
+    )
+    op.create_index(
+        'ix_catalog_tables_name', 'catalog_tables',
+        ['database_id', 'table_name'])
+    op.add_column(
+        'dbs', sa.Column('catalog_last_refreshed', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('dbs') as batch_op:
+        batch_op.drop_column('catalog_last_refreshed')
+    op.drop_index('ix_catalog_tables_name', table_name='catalog_tables')
+    op.drop_table('catalog_tables')
@@ -0,0 +1,40 @@
+"""rollups
+
+Revision ID: a6c18f869a4e
+Revises: 3b626e2a6783
+Create Date: 2016-05-27 14:32:05.114519
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a6c18f869a4e'
+down_revision = '3b626e2a6783'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('rollups',
+        sa.Column('created_on', sa.DateTime(), nullable=True),
+        sa.Column('changed_on', sa.DateTime(), nullable=True),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('rollup_name', sa.String(length=250), nullable=True),
+        sa.Column('table_id', sa.Integer(), nullable=True),
+        sa.Column('dimensions', sa.Text(), nullable=True),
+        sa.Column('metrics', sa.Text(), nullable=True),
+        sa.Column('dttm_col', sa.String(length=250), nullable=True),
+        sa.Column('time_grain', sa.String(length=64), nullable=True),
+        sa.Column('row_count', sa.Integer(), nullable=True),
+        sa.Column('last_refreshed', sa.DateTime(), nullable=True),
+        sa.Column('created_by_fk', sa.Integer(), nullable=True),
+        sa.Column('changed_by_fk', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['changed_by_fk'], ['ab_user.id'], ),
+        sa.ForeignKeyConstraint(['created_by_fk'], ['ab_user.id'], ),
+        sa.ForeignKeyConstraint(['table_id'], ['tables.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('rollups')
@@ -0,0 +1,23 @@
+"""sql_editor_row_limit
+
+Revision ID: d4e3b2f7c615
+Revises: 9b1e4c7d3a52
+Create Date: 2016-06-06 10:42:11.870215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4e3b2f7c615'
+down_revision = '9b1e4c7d3a52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('dbs', sa.Column('sql_editor_row_limit', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('dbs') as batch_op:
+        batch_op.drop_column('sql_editor_row_limit')
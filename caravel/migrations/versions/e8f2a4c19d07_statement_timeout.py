@@ -0,0 +1,23 @@
+"""statement_timeout
+
+Revision ID: e8f2a4c19d07
+Revises: d4e3b2f7c615
+Create Date: 2016-06-08 15:03:27.419652
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8f2a4c19d07'
+down_revision = 'd4e3b2f7c615'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('dbs', sa.Column('statement_timeout', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('dbs') as batch_op:
+        batch_op.drop_column('statement_timeout')
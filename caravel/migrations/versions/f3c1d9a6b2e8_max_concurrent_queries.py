@@ -0,0 +1,26 @@
+"""max_concurrent_queries
+
+Revision ID: f3c1d9a6b2e8
+Revises: e8f2a4c19d07
+Create Date: 2016-06-10 11:42:05.218736
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3c1d9a6b2e8'
+down_revision = 'e8f2a4c19d07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('dbs', sa.Column('max_concurrent_queries', sa.Integer(), nullable=True))
+    op.add_column('clusters', sa.Column('max_concurrent_queries', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('clusters') as batch_op:
+        batch_op.drop_column('max_concurrent_queries')
+    with op.batch_alter_table('dbs') as batch_op:
+        batch_op.drop_column('max_concurrent_queries')
@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 import functools
 import json
 import logging
+import sqlite3
 import textwrap
 from collections import namedtuple
 from copy import deepcopy, copy
@@ -31,21 +32,23 @@ from pydruid.utils.postaggregator import Postaggregator
 from six import string_types
 from sqlalchemy import (
     Column, Integer, String, ForeignKey, Text, Boolean, DateTime, Date,
-    Table, create_engine, MetaData, desc, select, and_, func)
-from sqlalchemy.engine import reflection
+    Table, create_engine, desc, select, and_, func, case, union_all)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship
-from sqlalchemy.sql import table, literal_column, text, column
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql import table, literal, literal_column, null, text, column
 from sqlalchemy_utils import EncryptedType
 
-from caravel import app, db, get_session, utils
+from caravel import (
+    admission, app, cubes, db, engines, get_session, json_encoders,
+    reflection, utils)
+from caravel.query_object import QueryResult
 from caravel.viz import viz_types
 from caravel.utils import flasher
 
 config = app.config
 
-QueryResult = namedtuple('namedtuple', ['df', 'query', 'duration'])
-
 
 class JavascriptPostAggregator(Postaggregator):
     def __init__(self, name, field_names, function):
@@ -209,7 +212,7 @@ class Slice(Model, AuditMixinNullable):
 
     @property
     def json_data(self):
-        return json.dumps(self.data)
+        return json_encoders.dumps(self.data)
 
     @property
     def slice_url(self):
@@ -310,7 +313,7 @@ class Dashboard(Model, AuditMixinNullable):
             'slug': self.slug,
             'slices': [slc.data for slc in self.slices],
         }
-        return json.dumps(d)
+        return json_encoders.dumps(d)
 
 
 class Queryable(object):
@@ -360,6 +363,10 @@ class Database(Model, AuditMixinNullable):
     sqlalchemy_uri = Column(String(1024))
     password = Column(EncryptedType(String(1024), config.get('SECRET_KEY')))
     cache_timeout = Column(Integer)
+    catalog_last_refreshed = Column(DateTime)
+    sql_editor_row_limit = Column(Integer)
+    statement_timeout = Column(Integer)
+    max_concurrent_queries = Column(Integer)
     extra = Column(Text, default=textwrap.dedent("""\
     {
         "metadata_params": {},
@@ -373,7 +380,33 @@ class Database(Model, AuditMixinNullable):
     def get_sqla_engine(self):
         extra = self.get_extra()
         params = extra.get('engine_params', {})
-        return create_engine(self.sqlalchemy_uri_decrypted, **params)
+        if self.id is None:
+            # Not persisted yet, nothing to key a pooled engine on
+            return create_engine(self.sqlalchemy_uri_decrypted, **params)
+        return engines.registry.get(
+            self.id, self.sqlalchemy_uri_decrypted, params,
+            statement_timeout=self.get_statement_timeout())
+
+    def get_statement_timeout(self):
+        """The statement timeout of the database, in seconds, if any"""
+        return self.statement_timeout or config.get(
+            'DATABASE_STATEMENT_TIMEOUT')
+
+    def pool_stats(self):
+        """Checkout and wait statistics for this database's pool"""
+        return engines.registry.stats(self.id)
+
+    def admit(self):
+        """Waits for the database to run fewer than its maximum queries"""
+        return admission.controller.admit(
+            ('database', self.id),
+            self.max_concurrent_queries or config.get(
+                'DATABASE_MAX_CONCURRENT_QUERIES'),
+            name=self.database_name)
+
+    def queue_stats(self):
+        """Queue depth and wait times of the queries to this database"""
+        return admission.controller.stats(('database', self.id))
 
     def safe_sqlalchemy_uri(self):
         return self.sqlalchemy_uri
@@ -449,6 +482,40 @@ class Database(Model, AuditMixinNullable):
     def grains_dict(self):
         return {grain.name: grain for grain in self.grains()}
 
+    @property
+    def supports_percentile_cont(self):
+        """Whether the database flavor has the PERCENTILE_CONT aggregate"""
+        return self.sqlalchemy_uri.startswith(('postgresql', 'oracle'))
+
+    @property
+    def supports_window_functions(self):
+        """Whether the database flavor has window functions"""
+        uri = self.sqlalchemy_uri
+        if uri.startswith(('postgresql', 'presto', 'redshift', 'oracle')):
+            return True
+        if uri.startswith('mysql'):
+            # Starting with MySQL 8 and MariaDB 10.2
+            engine = self.get_sqla_engine()
+            if engine.dialect.server_version_info is None:
+                engine.connect().close()
+            info = engine.dialect.server_version_info
+            version = tuple(p for p in info if isinstance(p, int))
+            if any('mariadb' in '{}'.format(p).lower() for p in info):
+                # Reported as 5.5.5-10.1.9-MariaDB by some servers
+                if version[:3] == (5, 5, 5) and len(version) > 3:
+                    version = version[3:]
+                return version >= (10, 2)
+            return version >= (8,)
+        if uri.startswith('sqlite'):
+            return sqlite3.sqlite_version_info >= (3, 25)
+        return False
+
+    @property
+    def supports_grouping_sets(self):
+        """Whether the database flavor understands GROUP BY GROUPING SETS"""
+        return self.sqlalchemy_uri.startswith(
+            ('postgresql', 'presto', 'mssql', 'oracle'))
+
     def get_extra(self):
         extra = {}
         if self.extra:
@@ -458,19 +525,119 @@ class Database(Model, AuditMixinNullable):
                 logging.error(e)
         return extra
 
+    def get_sql_editor_row_limit(self):
+        return self.sql_editor_row_limit or config.get('SQL_EDITOR_ROW_LIMIT')
+
     def get_table(self, table_name, schema=None):
-        extra = self.get_extra()
-        meta = MetaData(**extra.get('metadata_params', {}))
-        return Table(
-            table_name, meta,
-            schema=schema or None,
-            autoload=True,
-            autoload_with=self.get_sqla_engine())
-
-    def get_columns(self, table_name):
-        engine = self.get_sqla_engine()
-        insp = reflection.Inspector.from_engine(engine)
-        return insp.get_columns(table_name)
+        """Returns the reflected table, out of the reflection cache"""
+        return reflection.registry.get(self, table_name, schema=schema)
+
+    def get_tables(self, table_names, schema=None):
+        """Returns the existing tables among ``table_names``, by name"""
+        return reflection.registry.get_many(self, table_names, schema=schema)
+
+    def get_columns(self, table_name, schema=None):
+        table = self.get_table(table_name, schema=schema)
+        return [{
+            'name': col.name,
+            'type': col.type,
+            'nullable': col.nullable,
+        } for col in table.columns]
+
+    def refresh_catalog(self, columns=False):
+        """Lists the schemas and tables of the database into its catalog
+
+        The catalog is refreshed a schema at a time, adding the tables that
+        are new and dropping the ones that are gone, with a commit each.
+        A schema refreshed by another process at the same time is left to
+        it. With ``columns``, the columns of the tables that don't have them
+        listed yet are fetched as well. Returns the number of tables.
+        """
+        insp = sqla.inspect(self.get_sqla_engine())
+        # The tables of the default schema are referred to without one
+        default_schema = insp.default_schema_name
+        try:
+            schemas = insp.get_schema_names()
+        except NotImplementedError:
+            schemas = []
+        if default_schema is None:
+            # No telling which of the schemas is the default one (sqlite)
+            schemas = []
+        keys = [None if s == default_schema else s for s in schemas]
+        if None not in keys:
+            keys.append(None)
+        now = datetime.now()
+        count = 0
+        for key in keys:
+            try:
+                names = set(insp.get_table_names(schema=key))
+            except Exception as e:
+                # Left as they were, permissions may be missing on a schema
+                logging.exception(e)
+                continue
+            existing = {
+                tbl.table_name: tbl
+                for tbl in db.session.query(CatalogTable).filter_by(
+                    database_id=self.id, schema=key)}
+            for table_name, tbl in existing.items():
+                if table_name not in names:
+                    db.session.delete(tbl)
+            for table_name in names:
+                tbl = existing.get(table_name)
+                if not tbl:
+                    tbl = CatalogTable(
+                        database_id=self.id, schema=key,
+                        table_name=table_name)
+                    db.session.add(tbl)
+                if columns and tbl.columns is None:
+                    try:
+                        cols = insp.get_columns(table_name, schema=key)
+                    except Exception as e:
+                        logging.exception(e)
+                    else:
+                        tbl.columns = json.dumps([
+                            [col['name'], str(col['type'])] for col in cols])
+                tbl.last_refreshed = now
+            try:
+                db.session.commit()
+            except (IntegrityError, StaleDataError) as e:
+                logging.info(
+                    "The catalog of [{}] was refreshed concurrently: "
+                    "{}".format(self.database_name, e))
+                db.session.rollback()
+            count += len(names)
+        # Schemas that are gone
+        qry = (
+            db.session.query(CatalogTable)
+            .filter(CatalogTable.database_id == self.id)
+            .filter(CatalogTable.schema != None)  # noqa
+        )
+        if len(keys) > 1:
+            qry = qry.filter(~CatalogTable.schema.in_([k for k in keys if k]))
+        qry.delete(synchronize_session=False)
+        self.catalog_last_refreshed = now
+        db.session.merge(self)
+        db.session.commit()
+        return count
+
+    def search_catalog(self, prefix='', schema=False, limit=None):
+        """Returns the catalog's tables whose name starts with ``prefix``
+
+        ``schema`` restricts the search to a schema, ``None`` being the
+        default one.
+        """
+        prefix = (
+            prefix.replace('\\', '\\\\')
+            .replace('%', '\\%').replace('_', '\\_'))
+        qry = (
+            db.session.query(CatalogTable)
+            .filter(CatalogTable.database_id == self.id)
+            .filter(CatalogTable.table_name.like(prefix + '%', escape='\\'))
+        )
+        if schema is not False:
+            qry = qry.filter(CatalogTable.schema == (schema or None))
+        qry = qry.order_by(CatalogTable.table_name, CatalogTable.schema)
+        return qry.limit(limit or config.get('CATALOG_SEARCH_LIMIT')).all()
 
     @property
     def sqlalchemy_uri_decrypted(self):
@@ -487,6 +654,60 @@ class Database(Model, AuditMixinNullable):
         return '<a href="{}">SQL</a>'.format(self.sql_url)
 
 
+def invalidate_engine(mapper, connection, target):  # noqa
+    engines.registry.invalidate(target.id)
+    reflection.registry.invalidate(target.id)
+
+sqla.event.listen(Database, 'after_update', invalidate_engine)
+sqla.event.listen(Database, 'after_delete', invalidate_engine)
+
+
+class CatalogTable(Model):
+
+    """A table of a database, as listed in the catalog of the SQL editor
+
+    The catalog keeps the names, and optionally the columns, of the tables
+    of large databases at hand, so that they can be searched without
+    listing them all from the database every time.
+    """
+
+    __tablename__ = 'catalog_tables'
+    id = Column(Integer, primary_key=True)
+    database_id = Column(Integer, ForeignKey('dbs.id'), nullable=False)
+    database = relationship(
+        'Database',
+        backref=sqla.orm.backref('catalog', cascade='all, delete-orphan'),
+        foreign_keys=[database_id])
+    schema = Column(String(255))
+    table_name = Column(String(255))
+    # As JSON, a list of [name, type] pairs
+    columns = Column(Text)
+    last_refreshed = Column(DateTime)
+
+    __table_args__ = (
+        sqla.UniqueConstraint(
+            'database_id', 'schema', 'table_name',
+            name='_catalog_table_uc'),
+        sqla.Index('ix_catalog_tables_name', 'database_id', 'table_name'),
+    )
+
+    def __repr__(self):
+        return self.full_name
+
+    @property
+    def full_name(self):
+        if self.schema:
+            return "{}.{}".format(self.schema, self.table_name)
+        return self.table_name
+
+    @property
+    def data(self):
+        d = {'schema': self.schema, 'name': self.table_name}
+        if self.columns is not None:
+            d['columns'] = json.loads(self.columns)
+        return d
+
+
 class SqlaTable(Model, Queryable, AuditMixinNullable):
 
     """An ORM object for SqlAlchemy table references"""
@@ -507,7 +728,9 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
         'Database', backref='tables', foreign_keys=[database_id])
     offset = Column(Integer, default=0)
     cache_timeout = Column(Integer)
+    time_snap = Column(String(64))
     schema = Column(String(255))
+    cube_grain = Column(String(64))
 
     baselink = "tablemodelview"
 
@@ -585,7 +808,271 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
     def sql_link(self):
         return '<a href="{}">SQL</a>'.format(self.sql_url)
 
-    def query(  # sqla
+    def query(self, **query_obj):  # sqla
+        """Querying any sqla table from this common interface"""
+        qry_start_dttm = datetime.now()
+        cube = self.find_cube(**query_obj)
+        if cube:
+            sql = self.get_query_str(**query_obj)
+            df = cube.query(**query_obj)
+            sql = "-- Answered by the in-memory cube {}, as of {}\n{}".format(
+                cube, cube.loaded_on, sqlparse.format(sql, reindent=True))
+            return QueryResult(
+                df=df, duration=datetime.now() - qry_start_dttm, query=sql)
+
+        rollup = self.find_rollup(**query_obj)
+        sql = self.get_query_str(rollup=rollup, **query_obj)
+        engine = self.database.get_sqla_engine()
+        print(sql)
+        with self.database.admit():
+            df = pd.read_sql_query(
+                sql=sql,
+                con=engine
+            )
+        sql = sqlparse.format(sql, reindent=True)
+        if rollup:
+            sql = "-- Routed to the rollup {}, as of {}\n{}".format(
+                rollup.summary, rollup.last_refreshed, sql)
+        return QueryResult(
+            df=df, duration=datetime.now() - qry_start_dttm, query=sql)
+
+    def iter_query(self, chunk_size=10000, **query_obj):
+        """Runs the query, fetching its results in chunks
+
+        Yields the column names first, then lists of up to ``chunk_size``
+        rows, as tuples. Drivers that support it use a server side cursor,
+        so that the result set is never held in memory as a whole.
+        """
+        sql = self.get_query_str(
+            rollup=self.find_rollup(**query_obj), **query_obj)
+        engine = self.database.get_sqla_engine()
+        with self.database.admit():
+            conn = engine.connect().execution_options(stream_results=True)
+            try:
+                result = conn.execute(sql)
+                yield result.keys()
+                rows = result.fetchmany(chunk_size)
+                while rows:
+                    yield [tuple(row) for row in rows]
+                    rows = result.fetchmany(chunk_size)
+            finally:
+                conn.close()
+
+    def find_cube(self, **query_obj):
+        """Returns the in-memory cube of the table, if it can serve the query
+
+        Cubes are opted into by setting a ``cube_grain``. The first call
+        schedules the loading of the cube, queries go to the database
+        until it is loaded.
+        """
+        if not self.cube_grain or self.id is None:
+            return None
+        cube = cubes.registry.get(self)
+        if cube and cube.can_serve(**query_obj):
+            return cube
+
+    def find_rollup(self, **query_obj):
+        """Returns the smallest rollup that can serve the query, if any"""
+        if not config.get('ROLLUP_ROUTING'):
+            return None
+        rollups = [r for r in self.rollups if r.can_serve(**query_obj)]
+        if rollups:
+            return min(rollups, key=lambda r: (
+                r.row_count is None, r.row_count, len(r.dimension_names)))
+
+    def get_query_str(  # sqla
+            self, grouping_sets=False, percentiles=None, window=None,
+            **query_obj):
+        """Returns the SQL for the query, as run by ``query``
+
+        ``rollup`` reads from a rollup table instead of this one.
+        """
+        if grouping_sets:
+            return self.get_grouping_sets_query_str(**query_obj)
+        if percentiles:
+            return self.get_percentiles_query_str(percentiles, **query_obj)
+        qry = self.get_sqla_query(**query_obj)
+        if window:
+            qry = self.apply_window_transforms(
+                qry, query_obj['groupby'], query_obj['metrics'], **window)
+        return self.compile_query(qry)
+
+    def sqla_columns(self, rollup=None):
+        """Returns the columns queries can use, by name"""
+        if rollup:
+            return rollup.sqla_columns()
+        return {col.column_name: col for col in self.columns}
+
+    def compile_query(self, qry):
+        engine = self.database.get_sqla_engine()
+        return "{}".format(
+            qry.compile(
+                engine, compile_kwargs={"literal_binds": True},),
+            )
+
+    def get_grouping_sets_query_str(  # sqla
+            self, groupby, metrics, row_limit=None, **query_obj):
+        """Returns the SQL aggregating the metrics by each groupby column
+
+        All the columns are aggregated in a single statement, with
+        GROUPING SETS on the databases supporting them and a UNION ALL
+        of one aggregate per column otherwise. Each row holds the name of
+        the column it's grouped by in ``__grouping``, the other groupby
+        columns are null. ``row_limit`` applies to each column.
+        """
+        query_obj.update(
+            is_timeseries=False, timeseries_limit=None, columns=None)
+        if not self.database.supports_grouping_sets:
+            parts = []
+            for col in groupby:
+                subq = self.get_sqla_query(
+                    groupby=[col], metrics=metrics, row_limit=row_limit,
+                    **query_obj).alias()
+                parts.append(select(
+                    [literal(col).label('__grouping')] +
+                    [subq.c[c] if c == col else null().label(c)
+                     for c in groupby] +
+                    [subq.c[m] for m in metrics]))
+            return self.compile_query(union_all(*parts))
+
+        engine = self.database.get_sqla_engine()
+        cols = self.sqla_columns(query_obj.get('rollup'))
+        exprs = [cols[col].sqla_col.element for col in groupby]
+        grouping_sets = literal_column("GROUPING SETS ({})".format(", ".join(
+            "({})".format(expr.compile(dialect=engine.dialect))
+            for expr in exprs)))
+        grouping = case([
+            (func.grouping(expr) == 0, literal(col))
+            for col, expr in zip(groupby, exprs)])
+        qry = self.get_sqla_query(
+            groupby=groupby, metrics=metrics, row_limit=None, **query_obj)
+        qry = (
+            qry.column(grouping.label('__grouping'))
+            .group_by(None).group_by(grouping_sets)
+            .order_by(None)
+        )
+        if row_limit:
+            # Keeps the top rows by the main metric within each column
+            subq = qry.alias('grouping_sets')
+            outputs = ['__grouping'] + list(groupby) + list(metrics)
+            rank = func.row_number().over(
+                partition_by=subq.c['__grouping'],
+                order_by=desc(subq.c[metrics[0]]))
+            ranked = select(
+                [subq.c[c] for c in outputs] + [rank.label('__rank')]
+            ).alias('ranked')
+            qry = (
+                select([ranked.c[c] for c in outputs])
+                .where(ranked.c['__rank'] <= row_limit)
+            )
+        return self.compile_query(qry)
+
+    def apply_window_transforms(  # sqla
+            self, qry, groupby, metrics,
+            contribution=False, num_period_compare=0,
+            rolling_type=None, rolling_periods=0):
+        """Wraps a time series query to post process it with window functions
+
+        Mirrors the pandas post processing of time series charts, each
+        series being partitioned by the groupby columns and ordered by
+        timestamp. Every step gets its own subquery, as window functions
+        can't be nested.
+        """
+        dialect = self.database.get_sqla_engine().dialect
+
+        def keys(subq):
+            return [subq.c[col] for col in groupby] + [subq.c.timestamp]
+
+        def over(expr, subq, frame):
+            clauses = []
+            if groupby:
+                clauses.append("PARTITION BY " + ", ".join(
+                    "{}".format(subq.c[col].compile(dialect=dialect))
+                    for col in groupby))
+            clauses.append("ORDER BY {} ROWS {}".format(
+                subq.c.timestamp.compile(dialect=dialect), frame))
+            return literal_column("{} OVER ({})".format(
+                expr.compile(
+                    dialect=dialect, compile_kwargs={"literal_binds": True}),
+                " ".join(clauses)))
+
+        subq = qry.alias('series')
+        if contribution:
+            # Shares of the total of all the series and metrics, at each
+            # timestamp
+            total = functools.reduce(
+                lambda a, b: a + b,
+                [func.coalesce(subq.c[m], 0) for m in metrics])
+            total = func.nullif(
+                func.sum(total).over(partition_by=subq.c.timestamp), 0)
+            subq = select(keys(subq) + [
+                (literal_column('1.0') * subq.c[m] / total).label(m)
+                for m in metrics
+            ]).alias('contribution')
+        if num_period_compare:
+            partition_by = [subq.c[col] for col in groupby] or None
+            subq = select(keys(subq) + [
+                (literal_column('1.0') * subq.c[m] / func.nullif(
+                    func.lag(subq.c[m], num_period_compare).over(
+                        partition_by=partition_by,
+                        order_by=subq.c.timestamp),
+                    0) - 1).label(m)
+                for m in metrics
+            ] + [
+                func.row_number().over(
+                    partition_by=partition_by,
+                    order_by=subq.c.timestamp).label('period')
+            ]).alias('period_compare')
+            # The first periods have nothing to compare to
+            subq = select(keys(subq) + [subq.c[m] for m in metrics]).where(
+                subq.c.period > num_period_compare).alias('period_ratio')
+        aggregates = {'mean': 'AVG', 'std': 'STDDEV_SAMP', 'sum': 'SUM'}
+        if rolling_type in aggregates and rolling_periods:
+            frame = "BETWEEN {} PRECEDING AND CURRENT ROW".format(
+                rolling_periods - 1)
+            subq = select(keys(subq) + [
+                over(getattr(func, aggregates[rolling_type])(subq.c[m]),
+                     subq, frame).label(m)
+                for m in metrics
+            ]).alias('rolling')
+        elif rolling_type == 'cumsum':
+            subq = select(keys(subq) + [
+                over(func.sum(subq.c[m]), subq, "UNBOUNDED PRECEDING").label(m)
+                for m in metrics
+            ]).alias('cumulative')
+        return select([subq])
+
+    def get_percentiles_query_str(  # sqla
+            self, percentiles, groupby, metrics, **query_obj):
+        """Returns the SQL for percentiles of the metrics, by groupby
+
+        The percentiles are computed with PERCENTILE_CONT over the rows of
+        the query, along with the min and max of each metric, in columns
+        named after the metric: ``<metric>__p<percentile>``,
+        ``<metric>__min`` and ``<metric>__max``. Blank values count as
+        zeros, as they do when the statistics are computed in pandas.
+        """
+        engine = self.database.get_sqla_engine()
+        subq = self.get_sqla_query(
+            groupby=groupby, metrics=metrics, **query_obj).alias('box_values')
+        select_exprs = [subq.c[col] for col in groupby]
+        for metric in metrics:
+            value = func.coalesce(subq.c[metric], 0)
+            expr = value.compile(
+                dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+            for percentile in percentiles:
+                select_exprs.append(literal_column(
+                    "PERCENTILE_CONT({}) WITHIN GROUP (ORDER BY {})".format(
+                        percentile / 100, expr),
+                ).label('{}__p{}'.format(metric, percentile)))
+            select_exprs += [
+                func.min(value).label(metric + '__min'),
+                func.max(value).label(metric + '__max'),
+            ]
+        qry = select(select_exprs).group_by(*[subq.c[col] for col in groupby])
+        return self.compile_query(qry)
+
+    def get_sqla_query(  # sqla
             self, groupby, metrics,
             granularity,
             from_dttm, to_dttm,
@@ -594,14 +1081,15 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
             timeseries_limit=15, row_limit=None,
             inner_from_dttm=None, inner_to_dttm=None,
             extras=None,
-            columns=None):
-        """Querying any sqla table from this common interface"""
+            columns=None,
+            rollup=None):
+        """Returns the SQLAlchemy select for the query"""
         # For backward compatibility
         if granularity not in self.dttm_cols:
             granularity = self.main_dttm_col
 
-        cols = {col.column_name: col for col in self.columns}
-        qry_start_dttm = datetime.now()
+        cols = self.sqla_columns(rollup)
+        sqla_metrics = rollup.sqla_metrics() if rollup else self.metrics
 
         if not granularity and is_timeseries:
             raise Exception(_(
@@ -610,11 +1098,11 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
 
         metrics_exprs = [
             m.sqla_col
-            for m in self.metrics if m.metric_name in metrics]
+            for m in sqla_metrics if m.metric_name in metrics]
 
         if metrics:
             main_metric_expr = [
-                m.sqla_col for m in self.metrics
+                m.sqla_col for m in sqla_metrics
                 if m.metric_name == metrics[0]][0]
         else:
             main_metric_expr = literal_column("COUNT(*)").label("ccount")
@@ -675,7 +1163,7 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
         select_exprs += metrics_exprs
         qry = select(select_exprs)
 
-        tbl = table(self.table_name)
+        tbl = table(rollup.rollup_name if rollup else self.table_name)
         if self.schema:
             tbl.schema = self.schema
 
@@ -719,24 +1207,15 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
 
             tbl = tbl.join(subq.alias(), and_(*on_clause))
 
-        qry = qry.select_from(tbl)
-
-        engine = self.database.get_sqla_engine()
-        sql = "{}".format(
-            qry.compile(
-                engine, compile_kwargs={"literal_binds": True},),
-            )
-        print(sql)
-        df = pd.read_sql_query(
-            sql=sql,
-            con=engine
-        )
-        sql = sqlparse.format(sql, reindent=True)
-        return QueryResult(
-            df=df, duration=datetime.now() - qry_start_dttm, query=sql)
+        return qry.select_from(tbl)
 
     def fetch_metadata(self):
-        """Fetches the metadata for the table and merges it in"""
+        """Fetches the metadata for the table and merges it in
+
+        The table is reflected once, its existing columns and metrics are
+        loaded in a query each, and what's new or changed is written in a
+        single flush. Returns whether the table could be reflected.
+        """
         try:
             table = self.database.get_table(self.table_name, schema=self.schema)
         except Exception as e:
@@ -744,10 +1223,13 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
             flasher(
                 "Table doesn't seem to exist in the specified database, "
                 "couldn't fetch column information", "danger")
-            return
+            return False
+
+        M = SqlMetric  # noqa shortcut to class
+        # Loading the relationships is a query each
+        dbcols = {dbcol.column_name: dbcol for dbcol in self.columns}
+        dbmetrics = {metric.metric_name: metric for metric in self.metrics}
 
-        TC = TableColumn  # noqa shortcut to class
-        M = SqlMetric  # noqa
         metrics = []
         any_date_col = None
         for col in table.columns:
@@ -755,14 +1237,7 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
                 datatype = str(col.type)
             except Exception as e:
                 datatype = "UNKNOWN"
-            dbcol = (
-                db.session
-                .query(TC)
-                .filter(TC.table == self)
-                .filter(TC.column_name == col.name)
-                .first()
-            )
-            db.session.flush()
+            dbcol = dbcols.get(col.name)
             if not dbcol:
                 dbcol = TableColumn(column_name=col.name)
                 num_types = ('DOUBLE', 'FLOAT', 'INT', 'BIGINT', 'LONG')
@@ -776,8 +1251,8 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
                     dbcol.sum = True
                 elif any([t in datatype for t in date_types]):
                     dbcol.is_dttm = True
-            db.session.merge(self)
-            self.columns.append(dbcol)
+                self.columns.append(dbcol)
+                dbcols[col.name] = dbcol
 
             if not any_date_col and 'date' in datatype.lower():
                 any_date_col = col.name
@@ -812,9 +1287,9 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
                     metric_type='count_distinct',
                     expression="COUNT(DISTINCT {})".format(quoted)
                 ))
-            dbcol.type = datatype
-            db.session.merge(self)
-            db.session.commit()
+            if dbcol.type != datatype:
+                # Only the columns that actually changed get updated
+                dbcol.type = datatype
 
         metrics.append(M(
             metric_name='count',
@@ -823,18 +1298,14 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
             expression="COUNT(*)"
         ))
         for metric in metrics:
-            m = (
-                db.session.query(M)
-                .filter(M.metric_name == metric.metric_name)
-                .filter(M.table_id == self.id)
-                .first()
-            )
-            metric.table_id = self.id
-            if not m:
-                db.session.add(metric)
-                db.session.commit()
+            if metric.metric_name not in dbmetrics:
+                self.metrics.append(metric)
+                dbmetrics[metric.metric_name] = metric
         if not self.main_dttm_col:
             self.main_dttm_col = any_date_col
+        db.session.merge(self)
+        db.session.commit()
+        return True
 
 
 class SqlMetric(Model, AuditMixinNullable):
@@ -899,6 +1370,233 @@ class TableColumn(Model, AuditMixinNullable):
         return col
 
 
+class Rollup(Model, AuditMixinNullable):
+
+    """A pre-aggregated copy of a table, by some dimensions at a time grain
+
+    The rollup table lives next to the table it aggregates, with a column
+    per dimension, the time column truncated to the grain, and a column per
+    metric, named after it. Only metrics that can be aggregated again
+    (sums, counts, min and max) can be rolled up.
+    """
+
+    __tablename__ = 'rollups'
+    id = Column(Integer, primary_key=True)
+    rollup_name = Column(String(250))
+    table_id = Column(Integer, ForeignKey('tables.id'))
+    table = relationship(
+        'SqlaTable', backref='rollups', foreign_keys=[table_id])
+    dimensions = Column(Text)
+    metrics = Column(Text)
+    dttm_col = Column(String(250))
+    time_grain = Column(String(64), default='day')
+    row_count = Column(Integer)
+    last_refreshed = Column(DateTime)
+
+    # How each metric type aggregates the rolled up values again
+    reaggregations = {
+        'sum': 'SUM',
+        'count': 'SUM',
+        'min': 'MIN',
+        'max': 'MAX',
+    }
+
+    def __repr__(self):
+        return self.rollup_name
+
+    @validates('rollup_name')
+    def validate_rollup_name(self, key, rollup_name):
+        if self.rollup_name is not None and rollup_name != self.rollup_name:
+            # The table built under the previous name isn't this one's
+            self.last_refreshed = None
+            self.row_count = None
+        return rollup_name
+
+    @property
+    def dimension_names(self):
+        return [d.strip() for d in (self.dimensions or '').split(',') if d.strip()]
+
+    @property
+    def metric_names(self):
+        return [m.strip() for m in (self.metrics or '').split(',') if m.strip()]
+
+    @property
+    def granularity(self):
+        return self.dttm_col or self.table.main_dttm_col
+
+    @property
+    def summary(self):
+        return "{} by {}, {}".format(
+            self.rollup_name, self.time_grain,
+            ", ".join(self.dimension_names) or "no dimension")
+
+    def sqla_columns(self):
+        """Returns the columns of the rollup table, by name"""
+        return {
+            name: TableColumn(column_name=name)
+            for name in self.dimension_names + [self.granularity]}
+
+    def sqla_metrics(self):
+        """Returns metrics aggregating the rolled up values again"""
+        dialect = self.table.database.get_sqla_engine().dialect
+        metric_types = {m.metric_name: m.metric_type for m in self.table.metrics}
+        return [
+            SqlMetric(
+                metric_name=name,
+                expression="{}({})".format(
+                    self.reaggregations[metric_types.get(name)],
+                    column(name).compile(dialect=dialect)))
+            for name in self.metric_names]
+
+    def validate(self):
+        """Raises if the rollup can't be built out of its table"""
+        if not self.rollup_name:
+            raise Exception("Rollups need a name")
+        if self.rollup_name == self.table.table_name:
+            raise Exception(
+                "The rollup can't be named after the table it aggregates")
+        if self.table.database_id:
+            schema = self.table.schema or None
+            session = db.session
+            tables = session.query(SqlaTable).filter(
+                SqlaTable.database_id == self.table.database_id,
+                SqlaTable.table_name == self.rollup_name)
+            rollups = session.query(Rollup).join(SqlaTable).filter(
+                SqlaTable.database_id == self.table.database_id,
+                Rollup.rollup_name == self.rollup_name)
+            if self.id:
+                rollups = rollups.filter(Rollup.id != self.id)
+            if (
+                    any((t.schema or None) == schema for t in tables) or
+                    any((r.table.schema or None) == schema for r in rollups)):
+                raise Exception(
+                    "[{}] is already the name of a table of [{}]".format(
+                        self.rollup_name, self.table.database))
+        if self.time_grain not in utils.CALENDAR_GRAINS:
+            raise Exception(
+                "Rollups need one of these time grains: {}".format(
+                    ", ".join(utils.CALENDAR_GRAINS)))
+        if self.time_grain not in self.table.database.grains_dict():
+            raise Exception(
+                "[{}] has no [{}] time grain".format(
+                    self.table.database, self.time_grain))
+        columns = {c.column_name for c in self.table.columns}
+        missing = set(self.dimension_names) - columns
+        if missing:
+            raise Exception("Unknown dimensions: {}".format(
+                ", ".join(sorted(missing))))
+        metric_types = {m.metric_name: m.metric_type for m in self.table.metrics}
+        for name in self.metric_names:
+            if metric_types.get(name) not in self.reaggregations:
+                raise Exception(
+                    "Metric [{}] can't be rolled up, only {} metrics "
+                    "can".format(name, ", ".join(sorted(self.reaggregations))))
+
+    def can_serve(
+            self, groupby, metrics, granularity, from_dttm, to_dttm,
+            filter=None, is_timeseries=True, extras=None,  # noqa
+            columns=None, **kwargs):
+        """Whether the rollup holds everything the query needs
+
+        The groupby and filter columns have to be dimensions of the rollup
+        and its metrics have to include the query's. Time series need the
+        same grain, or a coarser one the rollup buckets fit in. The time
+        range has to start on a bucket and end with one, or after the last
+        refresh: rollups serve the data as of their last refresh.
+        """
+        extras = extras or {}
+        if (
+                not self.last_refreshed or
+                columns or
+                extras.get('where') or extras.get('having') or
+                granularity != self.granularity or
+                not set(groupby or []) <= set(self.dimension_names) or
+                not set(metrics or []) <= set(self.metric_names) or
+                not {col for col, op, eq in filter or []} <=
+                set(self.dimension_names)):
+            return False
+
+        grains = utils.CALENDAR_GRAINS
+        time_grain = extras.get('time_grain_sqla')
+        if is_timeseries and time_grain != self.time_grain:
+            # Weeks don't fit in months and years
+            if (
+                    time_grain not in grains or
+                    grains.index(time_grain) < grains.index(self.time_grain) or
+                    self.time_grain == 'week'):
+                return False
+
+        end = to_dttm + timedelta(microseconds=1)
+        return (
+            utils.floor_datetime(from_dttm, self.time_grain) == from_dttm and
+            (utils.floor_datetime(end, self.time_grain) == end or
+                to_dttm >= self.last_refreshed))
+
+    def latest_bucket(self):
+        """Returns the start of the last bucket in the rollup table, if any"""
+        database = self.table.database
+        engine = database.get_sqla_engine()
+        if not engine.has_table(self.rollup_name, schema=self.table.schema):
+            return None
+        tbl = table(self.rollup_name)
+        tbl.schema = self.table.schema
+        latest = engine.execute(
+            select([func.max(column(self.granularity))]).select_from(tbl)
+        ).scalar()
+        if latest is not None:
+            return pd.to_datetime(latest).to_pydatetime()
+
+    def refresh(self, full=False):
+        """Builds the rollup table, or refreshes its latest buckets
+
+        An incremental refresh recomputes the buckets from the last one in
+        the rollup table on, as it may have been partial.
+        """
+        self.validate()
+        refreshed = datetime.now()
+        database = self.table.database
+        engine = database.get_sqla_engine()
+        exists = engine.has_table(self.rollup_name, schema=self.table.schema)
+        if exists and not self.last_refreshed:
+            # Only ever replace the tables the rollup built
+            raise Exception(
+                "A table named [{}] already exists in [{}], pick another "
+                "name for the rollup".format(self.rollup_name, database))
+        start = None if full or not exists else self.latest_bucket()
+
+        sql = self.table.get_query_str(
+            groupby=self.dimension_names,
+            metrics=self.metric_names,
+            granularity=self.granularity,
+            from_dttm=start or datetime(1900, 1, 1),
+            to_dttm=datetime(9999, 12, 31),
+            filter=[],
+            is_timeseries=True,
+            timeseries_limit=None,
+            row_limit=None,
+            extras={'time_grain_sqla': self.time_grain})
+        df = pd.read_sql_query(sql=sql, con=engine)
+        df = df.rename(columns={'timestamp': self.granularity})
+        df[self.granularity] = pd.to_datetime(df[self.granularity])
+
+        with engine.begin() as conn:
+            if start:
+                tbl = table(self.rollup_name, column(self.granularity))
+                tbl.schema = self.table.schema
+                conn.execute(tbl.delete().where(
+                    column(self.granularity) >=
+                    text(database.dttm_converter(start))))
+            df.to_sql(
+                self.rollup_name, conn, schema=self.table.schema,
+                if_exists='append' if start else 'replace', index=False)
+            tbl = table(self.rollup_name)
+            tbl.schema = self.table.schema
+            self.row_count = conn.execute(
+                select([func.count()]).select_from(tbl)).scalar()
+        self.last_refreshed = refreshed
+        return len(df.index)
+
+
 class DruidCluster(Model, AuditMixinNullable):
 
     """ORM object referencing the Druid clusters"""
@@ -914,6 +1612,7 @@ class DruidCluster(Model, AuditMixinNullable):
     broker_port = Column(Integer)
     broker_endpoint = Column(String(255), default='druid/v2')
     metadata_last_refreshed = Column(DateTime)
+    max_concurrent_queries = Column(Integer)
 
     def __repr__(self):
         return self.cluster_name
@@ -924,6 +1623,18 @@ class DruidCluster(Model, AuditMixinNullable):
             self.broker_endpoint)
         return cli
 
+    def admit(self):
+        """Waits for the cluster to run fewer than its maximum queries"""
+        return admission.controller.admit(
+            ('druid', self.id),
+            self.max_concurrent_queries or config.get(
+                'DRUID_MAX_CONCURRENT_QUERIES'),
+            name=self.cluster_name)
+
+    def queue_stats(self):
+        """Queue depth and wait times of the queries to this cluster"""
+        return admission.controller.stats(('druid', self.id))
+
     def get_datasources(self):
         endpoint = (
             "http://{obj.coordinator_host}:{obj.coordinator_port}/"
@@ -961,6 +1672,7 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
         'DruidCluster', backref='datasources', foreign_keys=[cluster_name])
     offset = Column(Integer, default=0)
     cache_timeout = Column(Integer)
+    time_snap = Column(String(64))
 
     @property
     def metrics_combo(self):
@@ -1199,7 +1911,8 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
                     "direction": "descending",
                 }],
             }
-            client.groupby(**pre_qry)
+            with self.cluster.admit():
+                client.groupby(**pre_qry)
             query_str += "// Two phase query\n// Phase 1\n"
             query_str += json.dumps(client.query_dict, indent=2) + "\n"
             query_str += "//\nPhase 2 (built based on phase one's results)\n"
@@ -1236,7 +1949,8 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
                     "direction": "descending",
                 }],
             }
-        client.groupby(**qry)
+        with self.cluster.admit():
+            client.groupby(**qry)
         query_str += json.dumps(client.query_dict, indent=2)
         df = client.export_pandas()
         if df is None or df.size == 0:
@@ -0,0 +1,260 @@
+"""A canonical representation of the queries issued by visualizations"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from six import string_types
+
+from caravel import app, cache, utils
+from caravel.caching import single_flight
+
+config = app.config
+
+QueryResult = namedtuple('QueryResult', ['df', 'query', 'duration'])
+
+
+def canonicalize(obj):
+    """Turns query parameters into a form that serializes deterministically
+
+    Dates become ISO strings, tuples become lists and sets sorted lists.
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, dict):
+        return {k: canonicalize(v) for k, v in obj.items()}
+    if isinstance(obj, (set, frozenset)):
+        return sorted((canonicalize(o) for o in obj), key=_sort_key)
+    if isinstance(obj, (list, tuple)):
+        return [canonicalize(o) for o in obj]
+    return obj
+
+
+# Time grains on which every database agrees on where buckets start
+PARTITION_GRAINS = ('second', 'minute', 'hour', 'day', 'month', 'year')
+
+
+def _sort_key(obj):
+    if isinstance(obj, string_types):
+        return obj
+    return json.dumps(obj, sort_keys=True)
+
+
+class QueryObject(object):
+
+    """The keyword arguments of a ``datasource.query`` call
+
+    Visualizations describe the data they need as a dict of parameters
+    for ``datasource.query``. Two visualizations asking for the same
+    data end up with QueryObjects that have the same ``cache_key``,
+    whatever their type, their display options or the way their URL is
+    built, which allows them to share a cached result set.
+    """
+
+    def __init__(self, datasource, **kwargs):
+        self.datasource = datasource
+        self.params = kwargs
+
+    def to_dict(self):
+        return dict(self.params)
+
+    def canonical(self):
+        """Returns the query as plain, order independent, data"""
+        params = canonicalize(self.params)
+        # The order in which the filters are applied doesn't matter
+        if params.get('filter'):
+            params['filter'] = sorted(params['filter'], key=_sort_key)
+        # Blank extras (no where clause, default time grain, ...) are noops
+        if params.get('extras'):
+            params['extras'] = {
+                k: v for k, v in params['extras'].items() if v}
+        return {
+            'datasource': [self.datasource.type, self.datasource.id],
+            'params': params,
+        }
+
+    def serialize(self):
+        return json.dumps(
+            self.canonical(), sort_keys=True, separators=(',', ':'))
+
+    @property
+    def cache_key(self):
+        digest = hashlib.md5(self.serialize().encode('utf-8')).hexdigest()
+        return 'query_' + digest
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, QueryObject) and
+            self.serialize() == other.serialize())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.serialize())
+
+    def run(self):
+        """Runs the query against the datasource, bypassing the cache"""
+        return self.datasource.query(**self.params)
+
+    def get_result(self, cache_timeout=None, force=False):
+        """Returns the QueryResult, from the cache when possible"""
+        if not config.get('CACHE_QUERY_RESULTS'):
+            return self.run()
+        cache_key = self.cache_key
+
+        def compute():
+            result = self.run()
+            cache.set(cache_key, result, timeout=cache_timeout)
+            return result
+
+        if force:
+            return compute()
+        result = cache.get(cache_key)
+        if result is not None:
+            logging.info("Serving query results from cache")
+            return result
+        result, shared = single_flight.do(cache_key, compute)
+        if shared:
+            # Callers post-process the dataframe in place
+            result = result._replace(df=result.df.copy())
+        return result
+
+    def for_time_range(self, from_dttm, to_dttm):
+        """Returns the same query, over another time range"""
+        params = dict(self.params, from_dttm=from_dttm, to_dttm=to_dttm)
+        return QueryObject(self.datasource, **params)
+
+    def partition_grain(self):
+        """Returns the grain the time range can be split on, if any
+
+        Splitting the time range of a query only gives the same results
+        when every group of the result set falls in exactly one part, which
+        holds for the time grains that all databases truncate alike, and
+        when nothing, like a timeseries limit or a window function, is
+        computed over the whole time range. Raw timestamps can be split on
+        any grain, days are used.
+        """
+        params = self.params
+        datasource = self.datasource
+        granularity = params.get('granularity')
+        if (
+                datasource.type != 'table' or
+                not params.get('is_timeseries', True) or
+                not granularity or
+                granularity not in datasource.dttm_cols or
+                params.get('columns') or
+                params.get('window') or
+                (params.get('timeseries_limit') and params.get('groupby'))):
+            return None
+        time_grain = (params.get('extras') or {}).get('time_grain_sqla')
+        grain = datasource.database.grains_dict().get(time_grain)
+        if not grain or grain.function == '{col}':
+            return 'day'
+        if time_grain in PARTITION_GRAINS:
+            return time_grain
+
+    def time_partitions(self, grain, max_parts=None):
+        """Splits the time range in parts aligned on the grain
+
+        Returns a list of ``(start, end)`` bounds, both inclusive, like
+        the ones of the query, or None if there are more than ``max_parts``.
+        """
+        parts = []
+        start = self.params['from_dttm']
+        to_dttm = self.params['to_dttm']
+        while start <= to_dttm:
+            if max_parts and len(parts) >= max_parts:
+                return None
+            end = utils.next_bucket(start, grain)
+            if end > to_dttm:
+                parts.append((start, to_dttm))
+                break
+            parts.append((start, end - timedelta(microseconds=1)))
+            start = end
+        return parts
+
+    def get_partitioned_result(self, grain, cache_timeout=None, force=False):
+        """Returns the QueryResult, reusing the cached parts of its time range
+
+        The time range is split in parts aligned on ``grain``. The rows of
+        the parts that ended before CACHE_TIME_BUCKETS_GRACE_PERIOD seconds
+        ago won't change anymore, they are cached on their own. Runs of
+        parts that are missing from the cache, or still open, are queried,
+        one query per run, and all the parts are concatenated.
+        """
+        qry_start_dttm = datetime.now()
+        parts = self.time_partitions(
+            grain, max_parts=config.get('CACHE_TIME_BUCKETS_MAX'))
+        if not parts:
+            return self.get_result(cache_timeout=cache_timeout, force=force)
+        closed_before = qry_start_dttm - timedelta(
+            seconds=config.get('CACHE_TIME_BUCKETS_GRACE_PERIOD'))
+        closed = [end < closed_before for start, end in parts]
+        keys = [
+            'bucket_' + self.for_time_range(start, end).cache_key
+            for start, end in parts]
+
+        dfs = [None] * len(parts)
+        if not force:
+            closed_keys = [key for key, c in zip(keys, closed) if c]
+            cached = dict(zip(closed_keys, cache.get_many(*closed_keys)))
+            dfs = [cached.get(key) for key in keys]
+
+        row_limit = self.params.get('row_limit')
+        bucket_starts = pd.to_datetime([
+            utils.floor_datetime(start, grain) for start, end in parts]).values
+        queries = []
+        queried = 0
+        for first, last in list(_missing_runs(dfs)):
+            result = self.for_time_range(
+                parts[first][0], parts[last][1]).run()
+            df = result.df
+            if row_limit and len(df.index) >= row_limit:
+                # The run got truncated, so might be its parts
+                return self.get_result(cache_timeout=cache_timeout, force=True)
+            queries.append(result.query)
+
+            timestamps = pd.to_datetime(df['timestamp'], utc=False).values
+            part_ids = np.searchsorted(
+                bucket_starts, timestamps, side='right') - 1
+            for i in range(first, last + 1):
+                dfs[i] = df[part_ids == i]
+                if closed[i]:
+                    cache.set(keys[i], dfs[i], timeout=cache_timeout)
+            queried += last - first + 1
+        logging.info(
+            "Queried {} out of {} time buckets".format(queried, len(parts)))
+
+        df = pd.concat(dfs, ignore_index=True)
+        if row_limit and len(df.index) > row_limit:
+            return self.get_result(cache_timeout=cache_timeout, force=force)
+        return QueryResult(
+            df=df,
+            query="\n\n".join(queries) or "-- Served from the cache",
+            duration=datetime.now() - qry_start_dttm)
+
+
+def _missing_runs(items):
+    """Yields the (first, last) indexes of the runs of None in ``items``
+
+    >>> list(_missing_runs([None, 1, None, None, 2]))
+    [(0, 0), (2, 3)]
+    """
+    first = None
+    for i, item in enumerate(items):
+        if item is None and first is None:
+            first = i
+        elif item is not None and first is not None:
+            yield first, i - 1
+            first = None
+    if first is not None:
+        yield first, len(items) - 1
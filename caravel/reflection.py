@@ -0,0 +1,165 @@
+"""Process-wide cache of the table metadata reflected from the databases
+
+Reflecting a table (``autoload=True``) takes several round trips to the
+database, which on Presto or Redshift adds up to seconds. The cache keeps
+the reflected ``Table`` objects of each web server process, keyed on the
+database, schema and table name, for ``REFLECTION_CACHE_TIMEOUT`` seconds
+or until they are invalidated. The cached tables are shared across
+threads and must be treated as read only.
+
+The catalogs of the SQL editor, the list of the tables of each database,
+are refreshed in the background from here as well.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import MetaData, Table
+
+from caravel import app, db, jobs
+
+config = app.config
+
+
+class ReflectionCache(object):
+
+    """Keeps the tables reflected from each database for a while"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._refreshing = set()
+
+    @staticmethod
+    def metadata(database):
+        extra = database.get_extra()
+        return MetaData(**extra.get('metadata_params', {}))
+
+    def _get_cached(self, key):
+        timeout = config.get('REFLECTION_CACHE_TIMEOUT')
+        with self._lock:
+            entry = self._tables.get(key)
+        if entry and (not timeout or entry[0] + timeout > time.time()):
+            return entry[1]
+
+    def _set_cached(self, key, table):
+        with self._lock:
+            self._tables[key] = (time.time(), table)
+
+    def get(self, database, table_name, schema=None):
+        """Returns the reflected table, reflecting it if needed"""
+        schema = schema or None
+        key = (database.id, schema, table_name)
+        table = self._get_cached(key)
+        if table is None:
+            table = Table(
+                table_name, self.metadata(database),
+                schema=schema,
+                autoload=True,
+                autoload_with=database.get_sqla_engine())
+            if database.id is not None:
+                self._set_cached(key, table)
+        return table
+
+    def get_many(self, database, table_names, schema=None):
+        """Returns the tables that exist among ``table_names``, by name
+
+        The tables missing from the cache are reflected in one pass, on a
+        single connection, rather than one at a time.
+        """
+        schema = schema or None
+        tables = {}
+        missing = set()
+        for table_name in table_names:
+            table = self._get_cached((database.id, schema, table_name))
+            if table is None:
+                missing.add(table_name)
+            else:
+                tables[table_name] = table
+        if not missing:
+            return tables
+        meta = self.metadata(database)
+        with database.get_sqla_engine().connect() as conn:
+            meta.reflect(
+                bind=conn, schema=schema,
+                only=lambda name, _: name in missing)
+        for table_name in missing:
+            key = '{}.{}'.format(schema, table_name) if schema else table_name
+            table = meta.tables.get(key)
+            if table is not None:
+                tables[table_name] = table
+                if database.id is not None:
+                    self._set_cached(
+                        (database.id, schema, table_name), table)
+        return tables
+
+    def prefetch(self, database, table_names, schema=None):
+        """Reflects the tables in the background, to warm the cache up"""
+        jobs.get_pool().apply_async(
+            self._prefetch_in_background,
+            (type(database), database.id, list(table_names), schema))
+
+    def _prefetch_in_background(
+            self, database_class, database_id, table_names, schema):
+        with app.app_context():
+            try:
+                database = db.session.query(database_class).get(database_id)
+                if database:
+                    self.get_many(database, table_names, schema=schema)
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                db.session.remove()
+
+    def refresh_catalog(self, database):
+        """Refreshes the catalog of a database in the background, when due
+
+        Catalogs older than CATALOG_REFRESH_INTERVAL seconds are due.
+        Returns whether a refresh is running.
+        """
+        interval = timedelta(seconds=config.get('CATALOG_REFRESH_INTERVAL'))
+        refreshed = database.catalog_last_refreshed
+        with self._lock:
+            if database.id in self._refreshing:
+                return True
+            if refreshed and refreshed + interval > datetime.now():
+                return False
+            self._refreshing.add(database.id)
+        jobs.get_pool().apply_async(
+            self._refresh_catalog_in_background,
+            (type(database), database.id))
+        return True
+
+    def _refresh_catalog_in_background(self, database_class, database_id):
+        with app.app_context():
+            try:
+                database = db.session.query(database_class).get(database_id)
+                if database:
+                    count = database.refresh_catalog()
+                    logging.info("Refreshed the catalog of [{}], {} tables"
+                                 .format(database, count))
+            except Exception as e:
+                logging.exception(e)
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._refreshing.discard(database_id)
+
+    def invalidate(self, database_id, table_name=None, schema=None):
+        """Drops a table, or all the tables of a database, from the cache"""
+        schema = schema or None
+        with self._lock:
+            for key in list(self._tables):
+                if key[0] != database_id:
+                    continue
+                if table_name is None or key[1:] == (schema, table_name):
+                    del self._tables[key]
+
+
+registry = ReflectionCache()
@@ -0,0 +1,110 @@
+"""Execution of the SQL editor queries, and their result store
+
+Queries run as background jobs (see ``jobs``), identified by the job id.
+Their results are fetched in pages of SQL_EDITOR_PAGE_SIZE rows and each
+page goes into the cache as a JSON string, ready to be served as is, so
+that neither the job nor the web server ever holds the whole result set.
+Without a cache shared across processes, queries run in the request, and
+their results are returned in one go.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+
+from sqlalchemy import select, text
+from sqlalchemy.sql.expression import TextAsFrom
+
+from caravel import app, cache, db, jobs, json_encoders
+
+config = app.config
+
+
+def page_key(query_id, page):
+    return 'query_{}_page_{}'.format(query_id, page)
+
+
+def get_page(query_id, page):
+    """Returns a page of results, as a JSON list of rows"""
+    return cache.get(page_key(query_id, page))
+
+
+def limit_sql(sql, limit, engine):
+    """Wraps the query in a SELECT * ... LIMIT"""
+    sql = sql.strip().strip(';')
+    qry = (
+        select('*')
+        .select_from(TextAsFrom(text(sql), ['*']).alias('inner_qry'))
+        .limit(limit)
+    )
+    return str(qry.compile(engine, compile_kwargs={"literal_binds": True}))
+
+
+def iter_pages(database, sql, page_size=None):
+    """Runs the query, yields its column names, then its pages of rows"""
+    page_size = page_size or config.get('SQL_EDITOR_PAGE_SIZE')
+    engine = database.get_sqla_engine()
+    sql = limit_sql(sql, database.get_sql_editor_row_limit(), engine)
+    with database.admit():
+        conn = engine.connect().execution_options(stream_results=True)
+        try:
+            result = conn.execute(sql)
+            yield result.keys()
+            rows = result.fetchmany(page_size)
+            while rows:
+                yield [tuple(row) for row in rows]
+                rows = result.fetchmany(page_size)
+        finally:
+            conn.close()
+
+
+def execute(database_class, database_id, sql, query_id=None):
+    """Runs a query from the SQL editor, returns a summary as JSON
+
+    With a ``query_id``, the pages of results go to the cache, and the job
+    stops fetching them once cancelled. Without one, they are returned
+    along with the summary, under ``data``.
+    """
+    start = time.time()
+    database = db.session.query(database_class).get(database_id)
+    pages = iter_pages(database, sql)
+    columns = next(pages)
+    rows = 0
+    count = 0
+    data = []
+    for page in pages:
+        if query_id:
+            if jobs.is_cancelled(query_id):
+                pages.close()
+                raise jobs.JobCancelled()
+            cache.set(
+                page_key(query_id, count),
+                json_encoders.dumps(page, dttm_format=json_encoders.ISO),
+                timeout=config.get('ASYNC_JOB_TIMEOUT'))
+        else:
+            data.extend(page)
+        rows += len(page)
+        count += 1
+    summary = {
+        'query_id': query_id,
+        'columns': columns,
+        'rows': rows,
+        'pages': count,
+        'page_size': config.get('SQL_EDITOR_PAGE_SIZE'),
+        'limit': database.get_sql_editor_row_limit(),
+        'limit_reached': rows >= database.get_sql_editor_row_limit(),
+        'duration': time.time() - start,
+    }
+    if not query_id:
+        summary['data'] = data
+    return json_encoders.dumps(summary, dttm_format=json_encoders.ISO)
+
+
+def submit(database, sql, user_id=None):
+    """Runs the query in the background, returns its id"""
+    query_id = jobs.new_job_id()
+    return jobs.submit(
+        execute, type(database), database.id, sql, query_id,
+        job_id=query_id, user_id=user_id)
@@ -7,8 +7,9 @@ from __future__ import unicode_literals
 import functools
 import json
 import logging
+import math
 import numpy
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import parsedatetime
 from dateutil.parser import parse
@@ -130,6 +131,136 @@ def parse_human_timedelta(s):
     return d - dttm
 
 
+CALENDAR_GRAINS = ('second', 'minute', 'hour', 'day', 'week', 'month', 'year')
+
+
+def floor_datetime(dttm, grain):
+    """Rounds a datetime down to a time grain
+
+    ``grain`` is either a ``timedelta``, in which case the datetime is
+    floored to a multiple of it since the epoch, or one of the calendar
+    grains in ``CALENDAR_GRAINS`` (weeks start on Monday).
+
+    >>> dttm = datetime(2016, 5, 18, 13, 47, 21)
+    >>> floor_datetime(dttm, timedelta(minutes=5))
+    datetime.datetime(2016, 5, 18, 13, 45)
+    >>> floor_datetime(dttm, 'hour')
+    datetime.datetime(2016, 5, 18, 13, 0)
+    >>> floor_datetime(dttm, 'week')
+    datetime.datetime(2016, 5, 16, 0, 0)
+    >>> floor_datetime(dttm, 'month')
+    datetime.datetime(2016, 5, 1, 0, 0)
+    """
+    if isinstance(grain, timedelta):
+        epoch = datetime(1970, 1, 1, tzinfo=dttm.tzinfo)
+        step = grain.total_seconds()
+        secs = math.floor((dttm - epoch).total_seconds() / step) * step
+        return epoch + timedelta(seconds=secs)
+    dttm = dttm.replace(microsecond=0)
+    if grain == 'second':
+        return dttm
+    dttm = dttm.replace(second=0)
+    if grain == 'minute':
+        return dttm
+    dttm = dttm.replace(minute=0)
+    if grain == 'hour':
+        return dttm
+    dttm = dttm.replace(hour=0)
+    if grain == 'day':
+        return dttm
+    if grain == 'week':
+        return dttm - timedelta(days=dttm.weekday())
+    dttm = dttm.replace(day=1)
+    if grain == 'month':
+        return dttm
+    if grain == 'year':
+        return dttm.replace(month=1)
+    raise ValueError("Unknown time grain [{}]".format(grain))
+
+
+def floor_timestamps(values, grain):
+    """``floor_datetime`` over an array of numpy datetimes, for calendar grains
+
+    >>> values = numpy.array(['2016-05-18T13:47:21'], dtype='datetime64[ns]')
+    >>> str(floor_timestamps(values, 'week')[0])[:19]
+    '2016-05-16T00:00:00'
+    >>> str(floor_timestamps(values, 'month')[0])[:19]
+    '2016-05-01T00:00:00'
+    """
+    units = {
+        'second': 's', 'minute': 'm', 'hour': 'h', 'day': 'D',
+        'month': 'M', 'year': 'Y',
+    }
+    if grain == 'week':
+        days = values.astype('datetime64[D]')
+        # The epoch was a Thursday
+        weekdays = (days.astype(numpy.int64) + 3) % 7
+        return (days - weekdays.astype('timedelta64[D]')).astype(values.dtype)
+    if grain not in units:
+        raise ValueError("Unknown time grain [{}]".format(grain))
+    return values.astype('datetime64[{}]'.format(units[grain])).astype(
+        values.dtype)
+
+
+def next_bucket(dttm, grain):
+    """Returns the start of the time grain bucket following ``dttm``'s
+
+    >>> next_bucket(datetime(2016, 12, 18, 13, 47), 'month')
+    datetime.datetime(2017, 1, 1, 0, 0)
+    >>> next_bucket(datetime(2016, 5, 18, 13, 47), 'day')
+    datetime.datetime(2016, 5, 19, 0, 0)
+    >>> next_bucket(datetime(2016, 5, 18, 13, 47), timedelta(minutes=15))
+    datetime.datetime(2016, 5, 18, 14, 0)
+    """
+    start = floor_datetime(dttm, grain)
+    if isinstance(grain, timedelta):
+        return start + grain
+    if grain == 'month':
+        return floor_datetime(start + timedelta(days=32), 'month')
+    if grain == 'year':
+        return start.replace(year=start.year + 1)
+    steps = {
+        'second': timedelta(seconds=1),
+        'minute': timedelta(minutes=1),
+        'hour': timedelta(hours=1),
+        'day': timedelta(days=1),
+        'week': timedelta(weeks=1),
+    }
+    return start + steps[grain]
+
+
+def parse_time_snap(snap, granularity=None):
+    """Turns a time snapping policy into a grain for ``floor_datetime``
+
+    The policy is either empty (no snapping), a natural language time delta
+    as in '5 minutes' or 'granularity', to snap to the time granularity of
+    the visualization. Returns None when there is nothing to snap to.
+
+    >>> parse_time_snap('5 minutes') == timedelta(minutes=5)
+    True
+    >>> parse_time_snap('day')
+    'day'
+    >>> parse_time_snap('granularity', 'month')
+    'month'
+    >>> parse_time_snap('granularity', 'all') is None
+    True
+    >>> parse_time_snap('') is None
+    True
+    """
+    if snap == 'granularity':
+        snap = granularity
+    if not snap or snap == 'all':
+        return None
+    if snap in CALENDAR_GRAINS:
+        return snap
+    try:
+        delta = parse_human_timedelta(snap)
+    except Exception:
+        return None
+    if delta.total_seconds() > 0:
+        return delta
+
+
 class JSONEncodedDict(TypeDecorator):
 
     """Represents an immutable structure as a json-encoded string."""
@@ -231,6 +362,184 @@ def json_iso_dttm_ser(obj):
     return obj
 
 
+def df_to_columnar(df):
+    """Returns a dataframe as ``{"columns": [...], "data": {col: [...]}}``
+
+    Unlike ``df.to_dict(orient="records")``, column names aren't repeated
+    on every row, and values are pulled out of the numpy arrays a column at
+    a time instead of building a dict per row.
+
+    >>> import pandas as pd
+    >>> df = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']}, columns=['a', 'b'])
+    >>> df_to_columnar(df) == {
+    ...     'columns': ['a', 'b'], 'data': {'a': [1, 2], 'b': ['x', 'y']}}
+    True
+    """
+    data = {}
+    for col in df.columns:
+        series = df[col]
+        if series.dtype.kind == 'M':
+            # Lets the json serializers handle them like any datetime
+            data[col] = series.dt.to_pydatetime().tolist()
+        else:
+            data[col] = series.values.tolist()
+    return {'columns': list(df.columns), 'data': data}
+
+
+def lttb_indices(x, y, threshold):
+    """Downsamples a series with Largest-Triangle-Three-Buckets
+
+    Returns the indices of the ``threshold`` points to keep. The first and
+    last points are always kept, and out of each bucket in between, the
+    point forming the largest triangle with the point kept in the previous
+    bucket and the average of the next bucket. This keeps the visual shape
+    of the series, peaks included.
+
+    >>> x = numpy.arange(10)
+    >>> y = numpy.array([0, 1, 0, 5, 0, 1, 0, -3, 0, 1])
+    >>> lttb_indices(x, y, 4).tolist()
+    [0, 3, 7, 9]
+    """
+    n = len(x)
+    if threshold < 3 or threshold >= n:
+        return numpy.arange(n)
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.nan_to_num(numpy.asarray(y, dtype=float))
+    # Bucket boundaries for the points between the first and the last
+    edges = numpy.linspace(1, n - 1, threshold - 1).astype(int)
+    indices = numpy.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    prev = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i < threshold - 3:
+            avg_x = x[end:edges[i + 2]].mean()
+            avg_y = y[end:edges[i + 2]].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        areas = numpy.abs(
+            (x[prev] - avg_x) * (y[start:end] - y[prev]) -
+            (x[prev] - x[start:end]) * (avg_y - y[prev]))
+        prev = start + int(numpy.argmax(areas))
+        indices[i + 1] = prev
+    return indices
+
+
+def minmax_indices(y, threshold):
+    """Downsamples a series keeping the min and max of each bucket
+
+    Returns the sorted indices of the points to keep, at most
+    ``threshold`` + 2 of them as the first and last points are always kept.
+
+    >>> y = numpy.array([0, 1, 0, 5, 0, 1, 0, -3, 0, 1])
+    >>> minmax_indices(y, 4).tolist()
+    [0, 3, 7, 9]
+    """
+    n = len(y)
+    if threshold < 2 or threshold >= n:
+        return numpy.arange(n)
+    y = numpy.nan_to_num(numpy.asarray(y, dtype=float))
+    edges = numpy.linspace(0, n, threshold // 2 + 1).astype(int)
+    bucket_ids = numpy.repeat(numpy.arange(len(edges) - 1), numpy.diff(edges))
+    # Sorted by bucket then value, each bucket starts with its min and
+    # ends with its max
+    order = numpy.lexsort((y, bucket_ids))
+    mins = order[edges[:-1]]
+    maxs = order[edges[1:] - 1]
+    return numpy.unique(numpy.concatenate(([0], mins, maxs, [n - 1])))
+
+
+DOWNSAMPLING_METHODS = {
+    'lttb': lttb_indices,
+    'minmax': lambda x, y, threshold: minmax_indices(y, threshold),
+}
+
+
+BOX_PLOT_STATS = ('Q1', 'median', 'Q3', 'whisker_high', 'whisker_low', 'outliers')
+
+
+def sorted_percentiles(values, starts, counts, q):
+    """Percentiles of groups laid out sorted and back to back in ``values``
+
+    Interpolates linearly between the closest ranks, like numpy.percentile.
+    """
+    pos = (counts - 1) * (q / 100)
+    low = numpy.floor(pos).astype(int)
+    high = numpy.ceil(pos).astype(int)
+    below = values[starts + low]
+    return below + (values[starts + high] - below) * (pos - low)
+
+
+def box_plot_stats(group_ids, values, whisker_type):
+    """Computes the statistics of box plots, for many groups at once
+
+    ``group_ids`` assigns each value to a group, numbered from 0 without
+    gaps. The values are sorted once, by group then value, and the
+    quartiles, whiskers and outliers are all read from that array. Returns
+    a dict with an entry per BOX_PLOT_STATS, each holding one value per
+    group.
+
+    >>> stats = box_plot_stats(
+    ...     [0, 0, 0, 0, 1, 1, 1], [1, 2, 3, 100, 5, 6, 7], 'Tukey')
+    >>> stats['median'].tolist()
+    [2.5, 6.0]
+    >>> stats['whisker_high'].tolist(), stats['whisker_low'].tolist()
+    ([3.0, 7.0], [1.0, 5.0])
+    >>> [sorted(o) for o in stats['outliers']]
+    [[100.0], []]
+    """
+    group_ids = numpy.asarray(group_ids)
+    values = numpy.asarray(values, dtype=float)
+    order = numpy.lexsort((values, group_ids))
+    group_ids = group_ids[order]
+    values = values[order]
+    counts = numpy.bincount(group_ids)
+    starts = numpy.cumsum(counts) - counts
+
+    def percentiles(q):
+        return sorted_percentiles(values, starts, counts, q)
+
+    stats = {
+        'Q1': percentiles(25),
+        'median': percentiles(50),
+        'Q3': percentiles(75),
+    }
+    if whisker_type == "Tukey":
+        iqr = stats['Q3'] - stats['Q1']
+        upper_outer_lim = stats['Q3'] + 1.5 * iqr
+        lower_outer_lim = stats['Q1'] - 1.5 * iqr
+        # Values within the limits of their group come as a contiguous run
+        # of the group, whose length gives the closest value to the limit
+        n_within = numpy.bincount(
+            group_ids, weights=values <= upper_outer_lim[group_ids],
+            minlength=len(counts)).astype(int)
+        n_below = numpy.bincount(
+            group_ids, weights=values < lower_outer_lim[group_ids],
+            minlength=len(counts)).astype(int)
+        stats['whisker_high'] = values[starts + n_within - 1]
+        stats['whisker_low'] = values[starts + n_below]
+    elif whisker_type == "Min/max (no outliers)":
+        stats['whisker_high'] = values[starts + counts - 1]
+        stats['whisker_low'] = values[starts]
+    elif " percentiles" in whisker_type:
+        low, high = whisker_type.replace(" percentiles", "").split("/")
+        stats['whisker_high'] = percentiles(int(high))
+        stats['whisker_low'] = percentiles(int(low))
+    else:
+        raise ValueError("Unknown whisker type: {}".format(whisker_type))
+
+    is_outlier = (
+        (values > stats['whisker_high'][group_ids]) |
+        (values < stats['whisker_low'][group_ids]))
+    n_outliers = numpy.bincount(
+        group_ids[is_outlier], minlength=len(counts))
+    stats['outliers'] = [
+        set(outliers.tolist()) for outliers in numpy.split(
+            values[is_outlier], numpy.cumsum(n_outliers)[:-1])]
+    return stats
+
+
 def markdown(s, markup_wrap=False):
     s = s or ''
     s = md(s, [
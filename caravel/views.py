@@ -15,7 +15,8 @@ import pandas as pd
 import sqlalchemy as sqla
 
 from flask import (
-    g, request, redirect, flash, Response, render_template, Markup)
+    g, request, redirect, flash, Response, render_template, Markup,
+    stream_with_context)
 from flask.ext.appbuilder import ModelView, CompactCRUDMixin, BaseView, expose
 from flask.ext.appbuilder.actions import action
 from flask.ext.appbuilder.models.sqla.interface import SQLAInterface
@@ -24,12 +25,13 @@ from flask.ext.babelpkg import gettext as _
 from flask_appbuilder.models.sqla.filters import BaseFilter
 
 from pydruid.client import doublesum
-from sqlalchemy import create_engine, select, text
-from sqlalchemy.sql.expression import TextAsFrom
+from sqlalchemy import create_engine
 from werkzeug.routing import BaseConverter
 from wtforms.validators import ValidationError
 
-from caravel import appbuilder, db, models, viz, utils, app, sm, ascii_art
+from caravel import (
+    appbuilder, db, models, viz, utils, app, sm, ascii_art, jobs, cubes,
+    admission, inflight, reflection, sql_editor)
 
 config = app.config
 log_this = models.Log.log_this
@@ -85,6 +87,33 @@ def validate_json(form, field):  # noqa
         raise ValidationError("json isn't valid")
 
 
+def get_viz(datasource_type, datasource_id, form_data, slice_id=None):
+    """Instantiates a viz object from the datasource and form data"""
+    datasource_class = models.SqlaTable \
+        if datasource_type == "table" else models.DruidDatasource
+    datasource = (
+        db.session.query(datasource_class)
+        .filter_by(id=datasource_id)
+        .first()
+    )
+    slc = None
+    if slice_id:
+        slc = db.session.query(models.Slice).filter_by(id=slice_id).first()
+    viz_type = form_data.get("viz_type") or "table"
+    return viz.viz_types[viz_type](
+        datasource, form_data=form_data, slice_=slc)
+
+
+def get_viz_json(datasource_type, datasource_id, form_data, slice_id=None):
+    """Returns a viz's json payload, used to run it as a background job
+
+    The viz is rebuilt from scratch as the ORM objects loaded while serving
+    the request are bound to a session that doesn't outlive it.
+    """
+    obj = get_viz(datasource_type, datasource_id, form_data, slice_id)
+    return obj.get_json()
+
+
 def generate_download_headers(extension):
     filename = datetime.now().strftime("%Y%m%d_%H%M%S")
     content_disp = "attachment; filename={}.{}".format(filename, extension)
@@ -94,6 +123,13 @@ def generate_download_headers(extension):
     return headers
 
 
+def json_error_response(msg, status=500):
+    return Response(
+        json.dumps({'error': msg}),
+        status=status,
+        mimetype="application/json")
+
+
 class DeleteMixin(object):
     @action(
         "muldelete", "Delete", "Delete all Really?", "fa-trash", single=False)
@@ -190,7 +226,9 @@ class DatabaseView(CaravelModelView, DeleteMixin):  # noqa
     datamodel = SQLAInterface(models.Database)
     list_columns = ['database_name', 'sql_link', 'creator', 'changed_on_']
     add_columns = [
-        'database_name', 'sqlalchemy_uri', 'cache_timeout', 'extra']
+        'database_name', 'sqlalchemy_uri', 'cache_timeout',
+        'statement_timeout', 'sql_editor_row_limit',
+        'max_concurrent_queries', 'extra']
     search_exclude_columns = ('password',)
     edit_columns = add_columns
     add_template = "caravel/models/database/add.html"
@@ -210,6 +248,16 @@ class DatabaseView(CaravelModelView, DeleteMixin):  # noqa
             "gets unpacked into the [sqlalchemy.MetaData]"
             "(http://docs.sqlalchemy.org/en/rel_1_0/core/metadata.html"
             "#sqlalchemy.schema.MetaData) call. ", True),
+        'statement_timeout': (
+            "Queries running for longer than this many seconds are "
+            "cancelled, defaults to the DATABASE_STATEMENT_TIMEOUT setting"),
+        'sql_editor_row_limit': (
+            "Maximum number of rows returned by the queries of the SQL "
+            "editor, defaults to the SQL_EDITOR_ROW_LIMIT setting"),
+        'max_concurrent_queries': (
+            "Maximum number of queries running at once on this database, "
+            "across all the web server processes, the others wait in line. "
+            "Defaults to the DATABASE_MAX_CONCURRENT_QUERIES setting"),
     }
 
     def pre_add(self, db):
@@ -238,14 +286,24 @@ class TableModelView(CaravelModelView, DeleteMixin):  # noqa
         'changed_by_', 'changed_on_']
     add_columns = [
         'table_name', 'database', 'schema',
-        'default_endpoint', 'offset', 'cache_timeout']
+        'default_endpoint', 'offset', 'cache_timeout', 'time_snap']
     edit_columns = [
         'table_name', 'is_featured', 'database', 'schema', 'description', 'owner',
-        'main_dttm_col', 'default_endpoint', 'offset', 'cache_timeout']
+        'main_dttm_col', 'default_endpoint', 'offset', 'cache_timeout',
+        'time_snap', 'cube_grain']
     related_views = [TableColumnInlineView, SqlMetricInlineView]
     base_order = ('changed_on', 'desc')
     description_columns = {
         'offset': "Timezone offset (in hours) for this datasource",
+        'time_snap': (
+            "Rounds the time range of queries down to a boundary, like "
+            "'5 minutes' or 'granularity', so that relative time ranges "
+            "hit the cache. Can be overridden per slice"),
+        'cube_grain': (
+            "Holds the table in memory, aggregated by its groupable and "
+            "filterable columns at this time grain ('Time Column' to keep "
+            "the timestamps as they are), to answer the queries on sum, "
+            "count, min and max metrics without going to the database"),
         'schema': (
             "Schema, as used only in some databases like Postgres, Redshift "
             "and DB2"),
@@ -266,7 +324,15 @@ class TableModelView(CaravelModelView, DeleteMixin):  # noqa
         utils.merge_perm(sm, 'datasource_access', table.perm)
 
     def post_update(self, table):
+        reflection.registry.invalidate(
+            table.database_id, table.table_name, schema=table.schema)
         self.post_add(table)
+        cubes.registry.drop(table.id)
+        if table.cube_grain:
+            try:
+                cubes.Cube.validate(table)
+            except Exception as e:
+                flash(str(e), "danger")
 
 appbuilder.add_view(
     TableModelView,
@@ -275,6 +341,49 @@ appbuilder.add_view(
     icon='fa-table',)
 
 
+class RollupModelView(CaravelModelView, DeleteMixin):  # noqa
+    datamodel = SQLAInterface(models.Rollup)
+    list_columns = [
+        'rollup_name', 'table', 'time_grain', 'dimensions', 'metrics',
+        'row_count', 'last_refreshed']
+    add_columns = [
+        'rollup_name', 'table', 'dimensions', 'metrics', 'dttm_col',
+        'time_grain']
+    edit_columns = add_columns
+    description_columns = {
+        'rollup_name': (
+            "Name of the table holding the rollup, created in the database "
+            "and schema of the table it aggregates"),
+        'dimensions': "Comma separated columns to group by",
+        'metrics': (
+            "Comma separated metrics, only sum, count, min and max metrics "
+            "can be rolled up"),
+        'dttm_col': (
+            "The time column, defaults to the main datetime column of the "
+            "table"),
+        'time_grain': "The time grain of the buckets, like 'hour' or 'day'",
+    }
+
+    def post_add(self, rollup):
+        try:
+            rollup.validate()
+        except Exception as e:
+            flash(str(e), "danger")
+            return
+        flash(
+            "Build the rollup with `caravel refresh_rollups`, queries get "
+            "routed to it once it's built", "info")
+
+    def post_update(self, rollup):
+        self.post_add(rollup)
+
+appbuilder.add_view(
+    RollupModelView,
+    _("Rollups"),
+    category=_("Sources"),
+    icon='fa-compress',)
+
+
 appbuilder.add_separator("Sources")
 
 
@@ -284,9 +393,16 @@ class DruidClusterModelView(CaravelModelView, DeleteMixin):  # noqa
         'cluster_name',
         'coordinator_host', 'coordinator_port', 'coordinator_endpoint',
         'broker_host', 'broker_port', 'broker_endpoint',
+        'max_concurrent_queries',
     ]
     edit_columns = add_columns
     list_columns = ['cluster_name', 'metadata_last_refreshed']
+    description_columns = {
+        'max_concurrent_queries': (
+            "Maximum number of queries running at once on this cluster, "
+            "across all the web server processes, the others wait in line. "
+            "Defaults to the DRUID_MAX_CONCURRENT_QUERIES setting"),
+    }
 
 
 if config['DRUID_IS_ACTIVE']:
@@ -415,12 +531,16 @@ class DruidDatasourceModelView(CaravelModelView, DeleteMixin):  # noqa
     edit_columns = [
         'datasource_name', 'cluster', 'description', 'owner',
         'is_featured', 'is_hidden', 'default_endpoint', 'offset',
-        'cache_timeout']
+        'cache_timeout', 'time_snap']
     add_columns = edit_columns
     page_size = 500
     base_order = ('datasource_name', 'asc')
     description_columns = {
         'offset': "Timezone offset (in hours) for this datasource",
+        'time_snap': (
+            "Rounds the time range of queries down to a boundary, like "
+            "'5 minutes' or 'granularity', so that relative time ranges "
+            "hit the cache. Can be overridden per slice"),
         'description': Markup(
             "Supports <a href='"
             "https://daringfireball.net/projects/markdown/'>markdown</a>"),
@@ -550,7 +670,24 @@ class Caravel(BaseView):
         except Exception as e:
             flash(str(e), "danger")
             return redirect(error_redirect)
-        if request.args.get("json") == "true":
+        if (
+                request.args.get("json") == "true" and
+                request.args.get("async") == "true" and
+                jobs.is_enabled()):
+            job_id = jobs.submit(
+                get_viz_json, datasource_type, datasource.id,
+                request.args, slc.id if slc else None,
+                user_id=g.user.get_id())
+            payload = {
+                'job_id': job_id,
+                'status': jobs.PENDING,
+                'job_endpoint': '/caravel/job/{}/'.format(job_id),
+            }
+            return Response(
+                json.dumps(payload),
+                status=202,
+                mimetype="application/json")
+        elif request.args.get("json") == "true":
             status = 200
             if config.get("DEBUG"):
                 # Allows for nice debugger stack traces in debug mode
@@ -558,6 +695,9 @@ class Caravel(BaseView):
             else:
                 try:
                     payload = obj.get_json()
+                except admission.QueryQueueTimeout as e:
+                    payload = str(e)
+                    status = 503
                 except Exception as e:
                     logging.exception(e)
                     payload = str(e)
@@ -570,12 +710,25 @@ class Caravel(BaseView):
             return resp
         elif request.args.get("csv") == "true":
             status = 200
-            payload = obj.get_csv()
+            payload = stream_with_context(obj.iter_csv())
             return Response(
                 payload,
                 status=status,
                 headers=generate_download_headers("csv"),
                 mimetype="application/csv")
+        elif request.args.get("format") in viz.EXPORT_FORMATS:
+            export_format = request.args.get("format")
+            extension, mimetype = viz.EXPORT_FORMATS[export_format]
+            try:
+                payload = obj.get_export(export_format)
+            except Exception as e:
+                logging.exception(e)
+                return Response(str(e), status=500, mimetype="text/plain")
+            return Response(
+                payload,
+                status=200,
+                headers=generate_download_headers(extension),
+                mimetype=mimetype)
         else:
             if request.args.get("standalone") == "true":
                 template = "caravel/standalone.html"
@@ -716,14 +869,100 @@ class Caravel(BaseView):
             uri = request.json.get('uri')
             connect_args = request.json.get('extras', {}).get('engine_params', {}).get('connect_args', {})
             engine = create_engine(uri, connect_args=connect_args)
-            engine.connect()
-            return json.dumps(engine.table_names(), indent=4)
+            engine.connect().close()
+            # Listing the tables can take a long time on large databases,
+            # they are browsed through the catalog once the database is saved
+            return json.dumps([])
         except Exception:
             return Response(
                 traceback.format_exc(),
                 status=500,
                 mimetype="application/json")
 
+    @has_access
+    @expose("/job/<job_id>/")
+    def job(self, job_id):
+        """Returns the status of a background job, and its payload once done"""
+        job = jobs.get_status(job_id)
+        if not job or job.get('user_id') != g.user.get_id():
+            return Response(
+                json.dumps({'job_id': job_id, 'status': 'unknown'}),
+                status=404,
+                mimetype="application/json")
+        payload = job.pop('payload', None)
+        body = json.dumps(job)
+        if payload is not None:
+            # The payload is serialized json already, splicing it in as is
+            body = '{{"payload": {}, {}'.format(payload, body[1:])
+        return Response(body, mimetype="application/json")
+
+    @has_access
+    @expose("/pool_stats/")
+    def pool_stats(self):
+        """Connection pool statistics per database, for this process"""
+        payload = {
+            mydb.database_name: mydb.pool_stats()
+            for mydb in db.session.query(models.Database).all()}
+        return Response(
+            json.dumps(payload, indent=4), mimetype="application/json")
+
+    @has_access
+    @expose("/queue_stats/")
+    def queue_stats(self):
+        """Queue depth and wait times per database and Druid cluster
+
+        For this process, only the ones queried since it started.
+        """
+        payload = {
+            'databases': {
+                mydb.database_name: mydb.queue_stats()
+                for mydb in db.session.query(models.Database).all()},
+            'druid_clusters': {
+                cluster.cluster_name: cluster.queue_stats()
+                for cluster in db.session.query(models.DruidCluster).all()},
+        }
+        return Response(
+            json.dumps(payload, indent=4), mimetype="application/json")
+
+    @has_access
+    @expose("/queries/")
+    def queries(self):
+        """The queries running in this process, all of them for admins"""
+        is_admin = any(r.name == 'Admin' for r in get_user_roles())
+        payload = [
+            q for q in inflight.registry.list()
+            if is_admin or q['user_id'] == g.user.get_id()]
+        return Response(
+            json.dumps(payload, indent=4), mimetype="application/json")
+
+    @has_access
+    @expose("/queries/<query_id>/cancel/", methods=['POST'])
+    def cancel_query(self, query_id):
+        """Cancels a running query, admins only
+
+        Queries running in other processes are flagged through the cache
+        and cancelled within a second.
+        """
+        if not any(r.name == 'Admin' for r in get_user_roles()):
+            return json_error_response(
+                "This view requires the Admin role", status=403)
+        local = inflight.registry.cancel(
+            query_id, "Cancelled by {}".format(g.user.username))
+        return Response(
+            json.dumps({'id': query_id, 'in_process': local}),
+            mimetype="application/json")
+
+    @has_access
+    @expose("/cube_stats/")
+    def cube_stats(self):
+        """Size and freshness of the in-memory cubes of this process"""
+        payload = {
+            table.full_name: cubes.registry.stats(table.id)
+            for table in db.session.query(models.SqlaTable).all()
+            if table.cube_grain}
+        return Response(
+            json.dumps(payload, indent=4), mimetype="application/json")
+
     @expose("/favstar/<class_name>/<obj_id>/<action>/")
     def favstar(self, class_name, obj_id, action):
         session = db.session()
@@ -793,16 +1032,66 @@ class Caravel(BaseView):
             return redirect("/tablemodelview/list/")
         mydb = db.session.query(
             models.Database).filter_by(id=database_id).first()
-        engine = mydb.get_sqla_engine()
-        tables = engine.table_names()
+        # The tables are searched in the catalog as the user types
+        reflection.registry.refresh_catalog(mydb)
 
         table_name = request.args.get('table_name')
+        # The tables people are likely to look at, reflected in one go while
+        # the page loads
+        prefetch = {
+            tbl.table_name for tbl in mydb.tables if not tbl.schema}
+        if table_name:
+            prefetch.add(table_name)
+        if prefetch:
+            reflection.registry.prefetch(mydb, prefetch)
         return self.render_template(
             "caravel/sql.html",
-            tables=tables,
             table_name=table_name,
             db=mydb)
 
+    @has_access
+    @expose("/catalog/<database_id>/")
+    def catalog(self, database_id):
+        """Searches the tables of a database by prefix, as JSON
+
+        ``q`` is the prefix, ``schema`` restricts the search to a schema,
+        the default one when empty, and ``limit`` caps the number of tables
+        returned, at most CATALOG_SEARCH_LIMIT. Until the catalog is first
+        built in the background, no table is returned.
+        """
+        if (
+                not self.appbuilder.sm.has_access(
+                    'all_datasource_access', 'all_datasource_access')):
+            return json_error_response(
+                "This view requires the `all_datasource_access` permission",
+                status=403)
+        mydb = db.session.query(
+            models.Database).filter_by(id=database_id).first()
+        if not mydb:
+            return json_error_response("Database not found", status=404)
+        refreshing = reflection.registry.refresh_catalog(mydb)
+        if not mydb.catalog_last_refreshed:
+            # Nothing to search yet
+            payload = {
+                'tables': [],
+                'last_refreshed': None,
+                'refreshing': True,
+            }
+            return Response(json.dumps(payload), mimetype="application/json")
+        max_limit = config.get('CATALOG_SEARCH_LIMIT')
+        limit = max(1, min(
+            request.args.get('limit', max_limit, type=int), max_limit))
+        tables = mydb.search_catalog(
+            request.args.get('q', ''),
+            schema=request.args.get('schema', False),
+            limit=limit)
+        payload = {
+            'tables': [tbl.data for tbl in tables],
+            'last_refreshed': mydb.catalog_last_refreshed.isoformat(),
+            'refreshing': refreshing,
+        }
+        return Response(json.dumps(payload), mimetype="application/json")
+
     @has_access
     @expose("/table/<database_id>/<table_name>/")
     @log_this
@@ -843,7 +1132,6 @@ class Caravel(BaseView):
     def runsql(self):
         """Runs arbitrary sql and returns and html table"""
         session = db.session()
-        limit = 1000
         data = json.loads(request.form.get('data'))
         sql = data.get('sql')
         database_id = data.get('database_id')
@@ -857,16 +1145,10 @@ class Caravel(BaseView):
         content = ""
         if mydb:
             eng = mydb.get_sqla_engine()
-            if limit:
-                sql = sql.strip().strip(';')
-                qry = (
-                    select('*')
-                    .select_from(TextAsFrom(text(sql), ['*']).alias('inner_qry'))
-                    .limit(limit)
-                )
-                sql = str(qry.compile(eng, compile_kwargs={"literal_binds": True}))
+            sql = sql_editor.limit_sql(sql, mydb.get_sql_editor_row_limit(), eng)
             try:
-                df = pd.read_sql_query(sql=sql, con=eng)
+                with mydb.admit():
+                    df = pd.read_sql_query(sql=sql, con=eng)
                 content = df.to_html(
                     index=False,
                     na_rep='',
@@ -881,6 +1163,77 @@ class Caravel(BaseView):
         session.commit()
         return content
 
+    @has_access
+    @expose("/sql_json/", methods=['POST'])
+    @log_this
+    def sql_json(self):
+        """Runs a query from the SQL editor, in the background if possible
+
+        Background queries answer with their id, their status is polled at
+        the job endpoint, and their results fetched a page at a time.
+        """
+        if (
+                not self.appbuilder.sm.has_access(
+                    'all_datasource_access', 'all_datasource_access')):
+            return json_error_response(
+                "This view requires the `all_datasource_access` permission",
+                status=403)
+        data = json.loads(request.form.get('data'))
+        mydb = db.session.query(models.Database).filter_by(
+            id=data.get('database_id')).first()
+        if not mydb:
+            return json_error_response("Database not found", status=404)
+        if jobs.is_enabled():
+            query_id = sql_editor.submit(
+                mydb, data.get('sql'), user_id=g.user.get_id())
+            payload = {
+                'query_id': query_id,
+                'status': jobs.PENDING,
+                'job_endpoint': '/caravel/job/{}/'.format(query_id),
+                'cancel_endpoint': '/caravel/sql_json/{}/cancel/'.format(
+                    query_id),
+            }
+            return Response(
+                json.dumps(payload),
+                status=202,
+                mimetype="application/json")
+        try:
+            payload = sql_editor.execute(
+                models.Database, mydb.id, data.get('sql'))
+        except admission.QueryQueueTimeout as e:
+            return json_error_response(str(e), status=503)
+        except Exception as e:
+            logging.exception(e)
+            return json_error_response(str(e))
+        return Response(payload, mimetype="application/json")
+
+    @has_access
+    @expose("/sql_json/<query_id>/page/<int:page>/")
+    def sql_json_page(self, query_id, page):
+        """Returns a page of the results of a background query"""
+        job = jobs.get_status(query_id)
+        data = sql_editor.get_page(query_id, page)
+        if (
+                not job or job.get('user_id') != g.user.get_id() or
+                data is None):
+            return json_error_response("Results not found", status=404)
+        # The page is serialized json already, splicing it in as is
+        body = '{{"query_id": {}, "page": {}, "data": {}}}'.format(
+            json.dumps(query_id), page, data)
+        return Response(body, mimetype="application/json")
+
+    @has_access
+    @expose("/sql_json/<query_id>/cancel/", methods=['POST'])
+    def sql_json_cancel(self, query_id):
+        """Cancels a background query"""
+        job = jobs.get_status(query_id)
+        if not job or job.get('user_id') != g.user.get_id():
+            return json_error_response("Query not found", status=404)
+        jobs.cancel(query_id)
+        return Response(
+            json.dumps(jobs.get_status(query_id)),
+            mimetype="application/json")
+
     @has_access
     @expose("/refresh_datasources/")
     def refresh_datasources(self):
@@ -9,7 +9,9 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import copy
+import functools
 import hashlib
+import io
 import json
 import logging
 import uuid
@@ -19,18 +21,26 @@ import pandas as pd
 import numpy as np
 from flask import request, Markup
 from markdown import markdown
-from pandas.io.json import dumps
 from six import string_types
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.urls import Href
 from dateutil import relativedelta as rdelta
 
-from caravel import app, utils, cache
+from caravel import app, jobs, json_encoders, utils, cache
+from caravel.caching import single_flight
 from caravel.forms import FormFactory
+from caravel.query_object import QueryObject
 from caravel.utils import flasher
 
 config = app.config
 
+# Binary export formats, served with ``format=<name>`` on the explore
+# endpoint: name -> (file extension, mimetype)
+EXPORT_FORMATS = OrderedDict([
+    ('parquet', ('parquet', 'application/octet-stream')),
+    ('arrow', ('arrow', 'application/vnd.apache.arrow.file')),
+])
+
 
 class BaseViz(object):
 
@@ -40,6 +50,12 @@ class BaseViz(object):
     verbose_name = "Base Viz"
     credits = ""
     is_timeseries = False
+    # Whether the result set can be cached per time bucket, see
+    # QueryObject.get_partitioned_result
+    cache_time_buckets = False
+    # Whether the CSV export is the raw query results, which can then be
+    # streamed. Visualizations that reshape them in get_df can't be
+    csv_streamable = True
     fieldsets = ({
         'label': None,
         'fields': (
@@ -56,6 +72,7 @@ class BaseViz(object):
         self.request = request
         self.viz_type = form_data.get("viz_type")
         self.slice = slice_
+        self._prefetched = {}
 
         # TODO refactor all form related logic out of here and into forms.py
         ff = FormFactory(self)
@@ -120,6 +137,8 @@ class BaseViz(object):
             del d['json']
         if 'action' in d:
             del d['action']
+        if 'async' in d:
+            del d['async']
         d.update(kwargs)
         # Remove unchecked checkboxes because HTML is weird like that
         od = OrderedDict()
@@ -142,18 +161,52 @@ class BaseViz(object):
         self.results = None
 
         # The datasource here can be different backend but the interface is common
-        self.results = self.datasource.query(**query_obj)
+        query = QueryObject(self.datasource, **query_obj)
+        self.results = self._prefetched.pop(query.cache_key, None)
+        if self.results is None:
+            self.results = self.run_query(query, self.cache_timeout)
         self.query = self.results.query
         df = self.results.df
         if df is None or df.empty:
             raise Exception("No data, review your incantations!")
-        else:
-            if 'timestamp' in df.columns:
-                df.timestamp = pd.to_datetime(df.timestamp, utc=False)
-                if self.datasource.offset:
-                    df.timestamp += timedelta(hours=self.datasource.offset)
-        df = df.fillna(0)
-        return df
+        return self.process_df(df)
+
+    def run_query(self, query, cache_timeout):
+        """Returns the results of a QueryObject, going through the caches"""
+        force = self.form_data.get('force') == 'true'
+        grain = None
+        if self.cache_time_buckets and config.get('CACHE_TIME_BUCKETS'):
+            grain = query.partition_grain()
+        if grain:
+            return query.get_partitioned_result(
+                grain, cache_timeout=cache_timeout, force=force)
+        return query.get_result(cache_timeout=cache_timeout, force=force)
+
+    def prefetch(self, query_objs):
+        """Runs several query objects concurrently, ahead of ``get_df``
+
+        ``get_df`` then picks up the results rather than running the
+        queries one after the other.
+        """
+        # The queries run in other threads, which can't lazy load from the
+        # session of this one
+        for attr in ('columns', 'metrics', 'database', 'cluster', 'rollups'):
+            getattr(self.datasource, attr, None)
+        cache_timeout = self.cache_timeout
+        queries = [QueryObject(self.datasource, **q) for q in query_objs]
+        results = jobs.run_concurrently([
+            functools.partial(self.run_query, query, cache_timeout)
+            for query in queries])
+        for query, result in zip(queries, results):
+            self._prefetched[query.cache_key] = result
+
+    def process_df(self, df):
+        """Parses timestamps and fills the blanks of raw query results"""
+        if 'timestamp' in df.columns:
+            df.timestamp = pd.to_datetime(df.timestamp, utc=False)
+            if self.datasource.offset:
+                df.timestamp += timedelta(hours=self.datasource.offset)
+        return df.fillna(0)
 
     @property
     def form(self):
@@ -195,15 +248,7 @@ class BaseViz(object):
         limit = int(form_data.get("limit", 0))
         row_limit = int(
             form_data.get("row_limit", config.get("ROW_LIMIT")))
-        since = form_data.get("since", "1 year ago")
-        from_dttm = utils.parse_human_datetime(since)
-        if from_dttm > datetime.now():
-            from_dttm = datetime.now() - (from_dttm-datetime.now())
-        until = form_data.get("until", "now")
-        to_dttm = utils.parse_human_datetime(until)
-        if from_dttm > to_dttm:
-            flasher("The date range doesn't seem right.", "danger")
-            from_dttm = to_dttm  # Making them identical to not raise
+        from_dttm, to_dttm = self.time_bounds()
 
         # extras are used to query elements specific to a datasource type
         # for instance the extra where clause that applies only to Tables
@@ -227,6 +272,34 @@ class BaseViz(object):
         }
         return d
 
+    @property
+    def time_snap(self):
+        """Time snapping policy, from the slice, datasource or config"""
+        return (
+            self.form_data.get('time_snap') or
+            getattr(self.datasource, 'time_snap', None) or
+            config.get('DEFAULT_TIME_SNAP'))
+
+    def time_bounds(self):
+        """Resolves the [since, until] time range and snaps it if needed"""
+        form_data = self.form_data
+        since = form_data.get("since", "1 year ago")
+        from_dttm = utils.parse_human_datetime(since)
+        if from_dttm > datetime.now():
+            from_dttm = datetime.now() - (from_dttm-datetime.now())
+        until = form_data.get("until", "now")
+        to_dttm = utils.parse_human_datetime(until)
+        grain = utils.parse_time_snap(
+            self.time_snap,
+            form_data.get("time_grain_sqla") or form_data.get("granularity"))
+        if grain:
+            from_dttm = utils.floor_datetime(from_dttm, grain)
+            to_dttm = utils.floor_datetime(to_dttm, grain)
+        if from_dttm > to_dttm:
+            flasher("The date range doesn't seem right.", "danger")
+            from_dttm = to_dttm  # Making them identical to not raise
+        return from_dttm, to_dttm
+
     @property
     def cache_timeout(self):
 
@@ -244,34 +317,43 @@ class BaseViz(object):
         """Handles caching around the json payload retrieval"""
         cache_key = self.cache_key
         payload = None
-        if self.form_data.get('force') != 'true':
+        force = self.form_data.get('force') == 'true'
+        if not force:
             payload = cache.get(cache_key)
         if payload:
             is_cached = True
             logging.info("Serving from cache")
-        else:
+        elif force:
             is_cached = False
-            cache_timeout = self.cache_timeout
-            payload = {
-                'cache_timeout': cache_timeout,
-                'cache_key': cache_key,
-                'csv_endpoint': self.csv_endpoint,
-                'data': self.get_data(),
-                'form_data': self.form_data,
-                'json_endpoint': self.json_endpoint,
-                'query': self.query,
-                'standalone_endpoint': self.standalone_endpoint,
-            }
-            payload['cached_dttm'] = datetime.now().isoformat().split('.')[0]
-            logging.info("Caching for the next {} seconds".format(
-                cache_timeout))
-            cache.set(cache_key, payload, timeout=cache_timeout)
-        payload['is_cached'] = is_cached
+            payload = self.get_payload()
+        else:
+            # Concurrent requests for the same payload wait on the first one
+            payload, is_cached = single_flight.do(cache_key, self.get_payload)
+        payload = dict(payload, is_cached=is_cached)
         return self.json_dumps(payload)
 
+    def get_payload(self):
+        """Runs the query and caches the resulting payload"""
+        cache_key = self.cache_key
+        cache_timeout = self.cache_timeout
+        payload = {
+            'cache_timeout': cache_timeout,
+            'cache_key': cache_key,
+            'csv_endpoint': self.csv_endpoint,
+            'data': self.get_data(),
+            'form_data': self.form_data,
+            'json_endpoint': self.json_endpoint,
+            'query': self.query,
+            'standalone_endpoint': self.standalone_endpoint,
+        }
+        payload['cached_dttm'] = datetime.now().isoformat().split('.')[0]
+        logging.info("Caching for the next {} seconds".format(cache_timeout))
+        cache.set(cache_key, payload, timeout=cache_timeout)
+        return payload
+
     def json_dumps(self, obj):
         """Used by get_json, can be overridden to use specific switches"""
-        return dumps(obj)
+        return json_encoders.dumps(obj)
 
     @property
     def data(self):
@@ -285,11 +367,97 @@ class BaseViz(object):
         }
         return content
 
+    @property
+    def columnar(self):
+        """Whether the client asked for columnar payloads"""
+        return self.orig_form_data.get('columnar') == 'true'
+
+    def df_to_records(self, df):
+        """Returns the rows for the payload, see utils.df_to_columnar"""
+        if self.columnar:
+            return utils.df_to_columnar(df)
+        return df.to_dict(orient="records")
+
     def get_csv(self):
         df = self.get_df()
         include_index = not isinstance(df.index, pd.RangeIndex)
         return df.to_csv(index=include_index, encoding="utf-8")
 
+    def get_export(self, export_format):
+        """Returns the results as bytes in one of the EXPORT_FORMATS
+
+        Unlike CSV, Parquet and Arrow IPC files carry the column types.
+        Both are written by pyarrow, an optional dependency.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception(
+                "Exporting to [{}] requires pyarrow, "
+                "`pip install caravel[arrow]`".format(export_format))
+        df = self.get_df()
+        # Pivoted results have tuples as column names
+        df.columns = [
+            ", ".join("{}".format(s) for s in col)
+            if isinstance(col, tuple) else "{}".format(col)
+            for col in df.columns]
+        table = pa.Table.from_pandas(
+            df, preserve_index=not isinstance(df.index, pd.RangeIndex))
+        buf = io.BytesIO()
+        if export_format == 'parquet':
+            pq.write_table(table, buf)
+        elif export_format == 'arrow':
+            writer = pa.RecordBatchFileWriter(buf, table.schema)
+            writer.write_table(table)
+            writer.close()
+        else:
+            raise Exception(
+                "Unknown export format [{}]".format(export_format))
+        return buf.getvalue()
+
+    def iter_csv(self):
+        """Yields the CSV export in chunks
+
+        When the visualization exports its query results as is and the
+        datasource can fetch them in chunks, rows are streamed from the
+        database so that the export is never held in memory as a whole.
+        """
+        if not (
+                self.csv_streamable and
+                hasattr(self.datasource, 'iter_query')):
+            yield self.get_csv()
+            return
+
+        query_obj = self.query_obj()
+        if config.get('CSV_EXPORT_ROW_LIMIT'):
+            query_obj['row_limit'] = config.get('CSV_EXPORT_ROW_LIMIT')
+        chunks = self.datasource.iter_query(
+            chunk_size=config.get('CSV_EXPORT_CHUNK_SIZE'), **query_obj)
+        columns = next(chunks)
+        dtypes = None
+        for rows in chunks:
+            df = self.process_df(
+                pd.DataFrame.from_records(rows, columns=columns))
+            header = dtypes is None
+            if header:
+                # The blanks of a chunk can turn an int column into floats,
+                # the others are cast like the first one so that numbers
+                # are formatted the same way throughout the export
+                dtypes = list(df.dtypes)
+            else:
+                for col, dtype in zip(columns, dtypes):
+                    if df[col].dtype != dtype:
+                        try:
+                            df[col] = df[col].astype(dtype)
+                        except (TypeError, ValueError):
+                            pass
+            yield df.to_csv(
+                index=False, header=header, encoding="utf-8")
+        if dtypes is None:
+            yield pd.DataFrame(columns=columns).to_csv(
+                index=False, encoding="utf-8")
+
     def get_data(self):
         return []
 
@@ -300,19 +468,27 @@ class BaseViz(object):
     @property
     def cache_key(self):
         url = self.get_url(json="true", force="false")
+        if self.time_snap:
+            # Relative time ranges resolve to new bounds as time goes by,
+            # keying on the snapped bounds rolls the cache over with them
+            url += "&time_bounds=" + "/".join(
+                dttm.isoformat() for dttm in self.time_bounds())
         return hashlib.md5(url.encode('utf-8')).hexdigest()
 
     @property
     def csv_endpoint(self):
         return self.get_url(csv="true")
 
+    def get_export_endpoint(self, export_format):
+        return self.get_url(format=export_format)
+
     @property
     def standalone_endpoint(self):
         return self.get_url(standalone="true")
 
     @property
     def json_data(self):
-        return dumps(self.data)
+        return json_encoders.dumps(self.data)
 
 
 class TableViz(BaseViz):
@@ -367,13 +543,15 @@ class TableViz(BaseViz):
 
     def get_data(self):
         df = self.get_df()
+        if self.columnar:
+            return utils.df_to_columnar(df)
         return dict(
             records=df.to_dict(orient="records"),
             columns=list(df.columns),
         )
 
     def json_dumps(self, obj):
-        return json.dumps(obj, default=utils.json_iso_dttm_ser)
+        return json_encoders.dumps(obj, dttm_format=json_encoders.ISO)
 
 
 class PivotTableViz(BaseViz):
@@ -384,6 +562,7 @@ class PivotTableViz(BaseViz):
     verbose_name = "Pivot Table"
     credits = 'a <a href="https://github.com/airbnb/caravel">Caravel</a> original'
     is_timeseries = False
+    csv_streamable = False
     fieldsets = ({
         'label': None,
         'fields': (
@@ -495,7 +674,7 @@ class WordCloudViz(BaseViz):
         df = df[[self.form_data.get('series'), self.form_data.get('metric')]]
         # Labeling the columns for uniform json schema
         df.columns = ['text', 'size']
-        return df.to_dict(orient="records")
+        return self.df_to_records(df)
 
 
 class TreemapViz(BaseViz):
@@ -506,6 +685,7 @@ class TreemapViz(BaseViz):
     verbose_name = "Treemap"
     credits = '<a href="https://d3js.org">d3.js</a>'
     is_timeseries = False
+    csv_streamable = False
     fieldsets = ({
         'label': None,
         'fields': (
@@ -551,6 +731,7 @@ class CalHeatmapViz(BaseViz):
     credits = (
         '<a href=https://github.com/wa0x6e/cal-heatmap>cal-heatmap</a>')
     is_timeseries = True
+    cache_time_buckets = True
     fieldsets = ({
         'label': None,
         'fields': (
@@ -572,8 +753,7 @@ class CalHeatmapViz(BaseViz):
         timestamps = {str(obj["timestamp"].value / 10**9):
                       obj.get("metric") for obj in df.to_dict("records")}
 
-        start = utils.parse_human_datetime(form_data.get("since"))
-        end = utils.parse_human_datetime(form_data.get("until"))
+        start, end = self.time_bounds()
         domain = form_data.get("domain_granularity")
         diff_delta = rdelta.relativedelta(end, start)
         diff_secs = (end - start).total_seconds()
@@ -621,6 +801,7 @@ class BoxPlotViz(NVD3Viz):
     verbose_name = "Box Plot"
     sort_series = False
     is_timeseries = True
+    csv_streamable = False
     fieldsets = ({
         'label': None,
         'fields': (
@@ -630,66 +811,73 @@ class BoxPlotViz(NVD3Viz):
     }, {
         'label': 'Chart Options',
         'fields': (
-            'whisker_options',
+            ('whisker_options', 'percentiles_in_sql'),
         )
     },)
 
-    def get_df(self, query_obj=None):
-        form_data = self.form_data
-        df = super(BoxPlotViz, self).get_df(query_obj)
-
-        df = df.fillna(0)
-
-        # conform to NVD3 names
-        def Q1(series):  # need to be named functions - can't use lambdas
-            return np.percentile(series, 25)
-
-        def Q3(series):
-            return np.percentile(series, 75)
-
-        whisker_type = form_data.get('whisker_options')
-        if whisker_type == "Tukey":
-
-            def whisker_high(series):
-                upper_outer_lim = Q3(series) + 1.5 * (Q3(series) - Q1(series))
-                series = series[series <= upper_outer_lim]
-                return series[np.abs(series - upper_outer_lim).argmin()]
-
-            def whisker_low(series):
-                lower_outer_lim = Q1(series) - 1.5 * (Q3(series) - Q1(series))
-                # find the closest value above the lower outer limit
-                series = series[series >= lower_outer_lim]
-                return series[np.abs(series - lower_outer_lim).argmin()]
-
-        elif whisker_type == "Min/max (no outliers)":
-
-            def whisker_high(series):
-                return series.max()
-
-            def whisker_low(series):
-                return series.min()
-
-        elif " percentiles" in whisker_type:
-            low, high = whisker_type.replace(" percentiles", "").split("/")
+    @property
+    def percentiles_in_sql(self):
+        """Whether the box statistics can be computed by the database
+
+        Only min/max whiskers qualify, the others need every value to tell
+        the outliers apart.
+        """
+        database = getattr(self.datasource, 'database', None)
+        return bool(
+            self.form_data.get('percentiles_in_sql') and
+            self.form_data.get('whisker_options') == "Min/max (no outliers)" and
+            database and database.supports_percentile_cont)
 
-            def whisker_high(series):
-                return np.percentile(series, int(high))
+    def get_df(self, query_obj=None):
+        if not query_obj:
+            query_obj = self.query_obj()
+        groupby = query_obj['groupby']
+        metrics = query_obj['metrics']
+        if not groupby:
+            raise Exception("Pick at least one field for [Series]")
 
-            def whisker_low(series):
-                return np.percentile(series, int(low))
+        if self.percentiles_in_sql:
+            query_obj = dict(query_obj, percentiles=[25, 50, 75])
+            df = super(BoxPlotViz, self).get_df(query_obj)
+            return self.percentiles_to_stats(df, groupby, metrics)
 
+        df = super(BoxPlotViz, self).get_df(query_obj)
+        return self.box_plot_stats(df.fillna(0), groupby, metrics)
+
+    def percentiles_to_stats(self, df, groupby, metrics):
+        """Lays out the percentiles computed by the database as box stats"""
+        df = df.set_index(groupby).sort_index()
+        stats = OrderedDict()
+        for metric in metrics:
+            for stat, suffix in zip(
+                    utils.BOX_PLOT_STATS, ('p25', 'p50', 'p75', 'max', 'min')):
+                stats[(metric, stat)] = df[metric + '__' + suffix].values
+            stats[(metric, 'outliers')] = [set()] * len(df.index)
+        return pd.DataFrame(stats, index=df.index, columns=list(stats))
+
+    def box_plot_stats(self, df, groupby, metrics):
+        """Returns the box statistics of the metrics, by groupby"""
+        # Numbers the groups in the order groupby would sort them
+        codes, uniques = zip(*[
+            pd.factorize(df[col].values, sort=True) for col in groupby])
+        dims = [len(u) for u in uniques]
+        group_ids, keys = pd.factorize(
+            np.ravel_multi_index(codes, dims), sort=True)
+        levels = [
+            u[i] for u, i in zip(uniques, np.unravel_index(keys, dims))]
+        if len(groupby) == 1:
+            index = pd.Index(levels[0], name=groupby[0])
         else:
-            raise ValueError("Unknown whisker type: {}".format(whisker_type))
+            index = pd.MultiIndex.from_arrays(levels, names=groupby)
 
-        def outliers(series):
-            above = series[series > whisker_high(series)]
-            below = series[series < whisker_low(series)]
-            # pandas sometimes doesn't like getting lists back here
-            return set(above.tolist() + below.tolist())
-
-        aggregate = [Q1, np.median, Q3, whisker_high, whisker_low, outliers]
-        df = df.groupby(form_data.get('groupby')).agg(aggregate)
-        return df
+        stats = OrderedDict()
+        whisker_type = self.form_data.get('whisker_options')
+        for metric in metrics:
+            box = utils.box_plot_stats(
+                group_ids, df[metric].values, whisker_type)
+            for stat in utils.BOX_PLOT_STATS:
+                stats[(metric, stat)] = box[stat]
+        return pd.DataFrame(stats, index=index, columns=list(stats))
 
     def to_series(self, df, classed='', title_suffix=''):
         label_sep = " - "
@@ -727,6 +915,7 @@ class BubbleViz(NVD3Viz):
     viz_type = "bubble"
     verbose_name = "Bubble Chart"
     is_timeseries = False
+    csv_streamable = False
     fieldsets = ({
         'label': None,
         'fields': (
@@ -796,6 +985,7 @@ class BigNumberViz(BaseViz):
     verbose_name = "Big Number with Trendline"
     credits = 'a <a href="https://github.com/airbnb/caravel">Caravel</a> original'
     is_timeseries = True
+    cache_time_buckets = True
     fieldsets = ({
         'label': None,
         'fields': (
@@ -892,6 +1082,16 @@ class NVD3TimeSeriesViz(NVD3Viz):
     verbose_name = "Time Series - Line Chart"
     sort_series = False
     is_timeseries = True
+    csv_streamable = False
+    cache_time_buckets = True
+    # Pandas resample rules and the time grains that bucket alike
+    resample_grains = {
+        '1T': 'minute',
+        '1H': 'hour',
+        '1D': 'day',
+        '1M': 'month',
+        '1AS': 'year',
+    }
     fieldsets = ({
         'label': None,
         'fields': (
@@ -917,15 +1117,111 @@ class NVD3TimeSeriesViz(NVD3Viz):
             ('rolling_type', 'rolling_periods'),
             'time_compare',
             'num_period_compare',
+            'analytics_in_sql',
             None,
-            ('resample_how', 'resample_rule',), 'resample_fillmethod'
+            ('resample_how', 'resample_rule',), 'resample_fillmethod',
+            ('max_points', 'downsampling'),
         ),
     },)
 
-    def get_df(self, query_obj=None):
+    def window_transforms(self):
+        """Returns the analytics the database can compute, if any
+
+        When the option is on and the database has window functions, the
+        contribution, period ratio and rolling windows are computed in SQL,
+        over each series ordered by time. They're only equivalent to pandas
+        when every series has a row for each timestamp. Resampling happens
+        before these, and the charts sorting their series rank them on the
+        values before these, so both keep them all in pandas.
+        """
         form_data = self.form_data
+        database = getattr(self.datasource, 'database', None)
+        rolling_type = form_data.get("rolling_type")
+        window = {
+            'contribution': bool(form_data.get("contribution")),
+            'num_period_compare': int(
+                form_data.get("num_period_compare") or 0),
+            'rolling_type': rolling_type,
+            'rolling_periods': int(form_data.get("rolling_periods") or 0),
+        }
+        if (
+                not form_data.get('analytics_in_sql') or
+                self.sort_series or
+                not database or
+                not database.supports_window_functions or
+                (form_data.get("resample_how") and
+                    form_data.get("resample_rule")) or
+                # SQLite has no STDDEV_SAMP
+                (rolling_type == 'std' and
+                    database.sqlalchemy_uri.startswith('sqlite'))):
+            return None
+        if (
+                window['contribution'] or window['num_period_compare'] or
+                rolling_type == 'cumsum' or
+                (rolling_type in ('mean', 'std', 'sum') and
+                    window['rolling_periods'])):
+            return window
+
+    def resample_grain(self):
+        """Returns the database time grain matching the resample rule, if any
+
+        Summing additive metrics at a coarser grain in the database gives
+        the same series as resampling them with a sum, so the rows can come
+        out of the database already aggregated. Pandas still resamples
+        them, which is then cheap, to fill the gaps and label the buckets.
+        """
+        form_data = self.form_data
+        database = getattr(self.datasource, 'database', None)
+        grain = self.resample_grains.get(form_data.get('resample_rule'))
+        if (
+                not grain or not database or
+                form_data.get('resample_how') != 'sum' or
+                # The database would truncate the timestamps before they
+                # get shifted by the offset
+                self.datasource.offset):
+            return None
+        grains = {g.name: g for g in database.grains() or ()}
+        current = grains.get(form_data.get('time_grain_sqla'))
+        if current and current.function != '{col}':
+            return None
+        metric_types = {
+            m.metric_name: m.metric_type for m in self.datasource.metrics}
+        if any(
+                metric_types.get(m) not in ('sum', 'count')
+                for m in form_data.get('metrics') or []):
+            return None
+        if (
+                grain == 'month' and
+                database.sqlalchemy_uri.startswith('sqlite')):
+            # Its month grain lands on the last day of the previous month,
+            # which pandas would bucket in the wrong month
+            return None
+        if grain in grains:
+            return grain
+
+    def query_obj(self):
+        d = super(NVD3TimeSeriesViz, self).query_obj()
+        grain = self.resample_grain()
+        if grain:
+            d['extras']['time_grain_sqla'] = grain
+        window = self.window_transforms()
+        if window:
+            d['window'] = window
+        return d
+
+    def get_df(self, query_obj=None):
+        if not query_obj:
+            query_obj = self.query_obj()
         df = super(NVD3TimeSeriesViz, self).get_df(query_obj)
+        return self.process_timeseries(
+            df, window_in_sql=bool(query_obj.get('window')))
+
+    def process_timeseries(self, df, window_in_sql=False):
+        """Pivots the query results into series and post processes them
 
+        ``window_in_sql`` skips the analytics the query already computed.
+        """
+        form_data = self.form_data
         df = df.fillna(0)
         if form_data.get("granularity") == "all":
             raise Exception("Pick a time granularity for your time series")
@@ -950,6 +1246,15 @@ class NVD3TimeSeriesViz(NVD3Viz):
             dfs.sort(ascending=False)
             df = df[dfs.index]
 
+        if window_in_sql:
+            if (
+                    form_data.get("rolling_type") == 'std' and
+                    form_data.get("rolling_periods")):
+                # A single value has no standard deviation, which comes out
+                # of the database as a blank filled with 0
+                df.iloc[:1] = np.nan
+            return df
+
         if form_data.get("contribution"):
             dft = df.T
             df = (dft / dft.sum()).T
@@ -984,14 +1289,33 @@ class NVD3TimeSeriesViz(NVD3Viz):
             else:
                 cols.append(col)
         df.columns = cols
-        series = df.to_dict('series')
+
+        # Timestamps as epoch milliseconds, the way the json encoders write
+        # them, computed once for all the series
+        timestamps = pd.to_datetime(df.index, utc=False).values
+        x_ms = timestamps.astype('datetime64[ns]').view('int64') // 10 ** 6
+        xs = x_ms.tolist()
+
+        numeric = [
+            i for i, dtype in enumerate(df.dtypes) if dtype.kind in "biufc"]
+        max_points = int(self.form_data.get('max_points') or 0)
+        keep = None
+        if max_points and len(xs) > max_points and numeric:
+            downsample = utils.DOWNSAMPLING_METHODS.get(
+                self.form_data.get('downsampling'), utils.lttb_indices)
+            # Stacked and bar charts need all the series on the same
+            # timestamps: each series picks its share of the points, and
+            # they all keep the union of the picks
+            share = max(max_points // len(numeric), 3)
+            keep = np.unique(np.concatenate([
+                downsample(x_ms, df.iloc[:, i].values, share)
+                for i in numeric]))
+            xs = x_ms[keep].tolist()
 
         chart_data = []
-        for name in df.T.index.tolist():
-            ys = series[name]
-            if df[name].dtype.kind not in "biufc":
-                continue
-            df['timestamp'] = pd.to_datetime(df.index, utc=False)
+        for i in numeric:
+            name = df.columns[i]
+            column = df.iloc[:, i]
             if isinstance(name, string_types):
                 series_title = name
             else:
@@ -1003,34 +1327,59 @@ class NVD3TimeSeriesViz(NVD3Viz):
             if title_suffix:
                 series_title += title_suffix
 
+            ys = column.values
+            if keep is not None:
+                ys = ys[keep]
             d = {
                 "key": series_title,
                 "classed": classed,
                 "values": [
-                    {'x': ds, 'y': ys[ds] if ds in ys else None}
-                    for ds in df.timestamp
+                    {'x': x, 'y': y}
+                    for x, y in zip(xs, ys.tolist())
                 ],
             }
             chart_data.append(d)
         return chart_data
 
-    def get_data(self):
-        df = self.get_df()
-        chart_data = self.to_series(df)
+    def time_compare_offsets(self):
+        """Returns the ``(offset, delta)`` pairs of the time shift field
 
-        time_compare = self.form_data.get('time_compare')
-        if time_compare:
-            query_object = self.query_obj()
-            delta = utils.parse_human_timedelta(time_compare)
-            query_object['inner_from_dttm'] = query_object['from_dttm']
-            query_object['inner_to_dttm'] = query_object['to_dttm']
-            query_object['from_dttm'] -= delta
-            query_object['to_dttm'] -= delta
+        Offsets are comma separated, "24 hours" and "24 hours ago" both
+        shift the comparison to the past.
+        """
+        time_compare = self.form_data.get('time_compare') or ''
+        offsets = [o.strip() for o in time_compare.split(',') if o.strip()]
+        return [
+            (offset, abs(utils.parse_human_timedelta(offset)))
+            for offset in offsets]
 
-            df2 = self.get_df(query_object)
+    def get_data(self):
+        query_obj = self.query_obj()
+        compare_objs = []
+        for offset, delta in self.time_compare_offsets():
+            compare_obj = dict(query_obj)
+            compare_obj['inner_from_dttm'] = query_obj['from_dttm']
+            compare_obj['inner_to_dttm'] = query_obj['to_dttm']
+            compare_obj['from_dttm'] = query_obj['from_dttm'] - delta
+            compare_obj['to_dttm'] = query_obj['to_dttm'] - delta
+            compare_objs.append((offset, delta, compare_obj))
+        if compare_objs:
+            self.prefetch([query_obj] + [q for _, _, q in compare_objs])
+
+        df = self.get_df(query_obj)
+        chart_data = self.to_series(df)
+        queries = [self.query]
+        for offset, delta, compare_obj in compare_objs:
+            title_suffix = "---"
+            if len(compare_objs) > 1:
+                title_suffix = " ({})".format(offset)
+            df2 = self.get_df(compare_obj)
             df2.index += delta
             chart_data += self.to_series(
-                df2, classed='caravel', title_suffix="---")
+                df2, classed='caravel', title_suffix=title_suffix)
+            queries.append(self.query)
+        if compare_objs:
+            self.query = "\n\n".join(queries)
             chart_data = sorted(chart_data, key=lambda x: x['key'])
         return chart_data
 
@@ -1088,6 +1437,7 @@ class DistributionPieViz(NVD3Viz):
     viz_type = "pie"
     verbose_name = "Distribution - NVD3 - Pie Chart"
     is_timeseries = False
+    csv_streamable = False
     fieldsets = ({
         'label': None,
         'fields': (
@@ -1124,6 +1474,7 @@ class DistributionBarViz(DistributionPieViz):
     viz_type = "dist_bar"
     verbose_name = "Distribution - Bar Chart"
     is_timeseries = False
+    csv_streamable = False
     fieldsets = ({
         'label': 'Chart Options',
         'fields': (
@@ -1204,6 +1555,7 @@ class SunburstViz(BaseViz):
     viz_type = "sunburst"
     verbose_name = "Sunburst"
     is_timeseries = False
+    csv_streamable = False
     credits = (
         'Kerry Rodden '
         '@<a href="https://bl.ocks.org/kerryrodden/7090426">bl.ocks.org</a>')
@@ -1297,11 +1649,10 @@ class SankeyViz(BaseViz):
     def get_data(self):
         df = self.get_df()
         df.columns = ['source', 'target', 'value']
-        recs = df.to_dict(orient='records')
 
         hierarchy = defaultdict(set)
-        for row in recs:
-            hierarchy[row['source']].add(row['target'])
+        for source, target in zip(df.source, df.target):
+            hierarchy[source].add(target)
 
         def find_cycle(g):
             """Whether there's a cycle in a directed graph"""
@@ -1324,7 +1675,7 @@ class SankeyViz(BaseViz):
             raise Exception(
                 "There's a loop in your Sankey, please provide a tree. "
                 "Here's a faulty link: {}".format(cycle))
-        return recs
+        return self.df_to_records(df)
 
 
 class DirectedForceViz(BaseViz):
@@ -1366,7 +1717,7 @@ class DirectedForceViz(BaseViz):
     def get_data(self):
         df = self.get_df()
         df.columns = ['source', 'target', 'value']
-        return df.to_dict(orient='records')
+        return self.df_to_records(df)
 
 
 class WorldMapViz(BaseViz):
@@ -1474,13 +1825,30 @@ class FilterBoxViz(BaseViz):
             self.form_data['metric']]
         return qry
 
-    def get_data(self):
-        qry = self.query_obj()
+    def get_dfs(self, qry):
+        """Returns a dataframe of values and metric for each filter field
+
+        Tables aggregate all the fields in a single query, Druid gets
+        one query per field, run concurrently.
+        """
         filters = [g for g in qry['groupby']]
+        metric = qry['metrics'][0]
+        if self.datasource.type == 'table':
+            df = self.get_df(dict(qry, grouping_sets=True))
+            return {
+                flt: (
+                    df[df['__grouping'] == flt][[flt, metric]]
+                    .sort_values(metric, ascending=False))
+                for flt in filters}
+        query_objs = [dict(qry, groupby=[flt]) for flt in filters]
+        self.prefetch(query_objs)
+        return {
+            flt: self.get_df(query_obj)
+            for flt, query_obj in zip(filters, query_objs)}
+
+    def get_data(self):
         d = {}
-        for flt in filters:
-            qry['groupby'] = [flt]
-            df = super(FilterBoxViz, self).get_df(qry)
+        for flt, df in self.get_dfs(self.query_obj()).items():
             d[flt] = [{
                 'id': row[0],
                 'text': row[0],
@@ -1542,7 +1910,7 @@ class ParallelCoordinatesViz(BaseViz):
 
     def get_data(self):
         df = self.get_df()
-        return df.to_dict(orient="records")
+        return self.df_to_records(df)
 
 
 class HeatmapViz(BaseViz):
@@ -1607,7 +1975,7 @@ class HeatmapViz(BaseViz):
             v = df.v
             min_ = v.min()
             df['perc'] = (v - min_) / (v.max() - min_)
-        return df.to_dict(orient="records")
+        return self.df_to_records(df)
 
 
 class HorizonViz(NVD3TimeSeriesViz):
@@ -39,6 +39,9 @@ setup(
         'sqlparse>=0.1.16, <0.2.0',
         'werkzeug>=0.11.2, <0.12.0',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     tests_require=['coverage'],
     author='Maxime Beauchemin',
     author_email='maximebeauchemin@gmail.com',
@@ -0,0 +1,195 @@
+"""Parity of the time series post processing done in pandas and in SQL"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from mock import Mock
+
+from caravel.models import Database
+from caravel.viz import NVD3TimeSeriesBarViz, NVD3TimeSeriesViz
+from tests.fixtures import SqliteTable, query_obj
+
+
+@unittest.skipIf(
+    sqlite3.sqlite_version_info < (3, 25), "SQLite has no window functions")
+class PostProcessingParityTests(unittest.TestCase):
+
+    """Runs the post processing options both ways over dense series"""
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        days = [datetime(2016, 1, 1) + timedelta(days=i) for i in range(60)]
+        cls.fixture = SqliteTable(pd.DataFrame({
+            'ds': [
+                day + timedelta(hours=hour)
+                for name in 'abc' for day in days for hour in (6, 18)],
+            'name': [name for name in 'abc' for _ in days for _ in range(2)],
+            'num': rng.randint(1, 100, 3 * len(days) * 2),
+        }), table_name='series')
+        cls.table = cls.fixture.table
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def query(self, viz, time_grain_sqla=None, **kwargs):
+        df = self.table.query(**query_obj(
+            from_dttm=datetime(2015, 1, 1),
+            to_dttm=datetime(2017, 1, 1),
+            groupby=viz.form_data['groupby'],
+            metrics=viz.form_data['metrics'],
+            extras={'time_grain_sqla': time_grain_sqla},
+            **kwargs)).df
+        df.timestamp = pd.to_datetime(df.timestamp)
+        return df.fillna(0)
+
+    def assert_parity(self, **form_data):
+        for groupby in (['name'], []):
+            for metrics in (['sum__num'], ['sum__num', 'count']):
+                viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+                viz.datasource = self.table
+                viz.form_data = dict(
+                    form_data, analytics_in_sql=True,
+                    groupby=groupby, metrics=metrics, granularity='ds')
+                window = viz.window_transforms()
+                assert window
+
+                expected = viz.process_timeseries(self.query(viz))
+                df = viz.process_timeseries(
+                    self.query(viz, window=window), window_in_sql=True)
+                # Missing values are filled with zeros on the way out of
+                # the database
+                expected = expected.fillna(0)
+                assert list(df.index) == list(expected.index)
+                np.testing.assert_allclose(
+                    df[expected.columns].values, expected.values)
+
+    def test_contribution(self):
+        self.assert_parity(contribution=True)
+
+    def test_num_period_compare(self):
+        self.assert_parity(num_period_compare='7')
+
+    def test_rolling_mean(self):
+        self.assert_parity(rolling_type='mean', rolling_periods='5')
+
+    def test_rolling_sum(self):
+        self.assert_parity(rolling_type='sum', rolling_periods='3')
+
+    def test_cumsum(self):
+        self.assert_parity(rolling_type='cumsum')
+
+    def test_combined(self):
+        self.assert_parity(
+            contribution=True, num_period_compare='2',
+            rolling_type='mean', rolling_periods='4')
+
+    def test_resample_grain(self):
+        viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+        viz.datasource = self.table
+        viz.form_data = {
+            'groupby': ['name'],
+            'metrics': ['sum__num', 'count'],
+            'granularity': 'ds',
+            'resample_rule': '1D',
+            'resample_how': 'sum',
+        }
+        assert viz.resample_grain() == 'day'
+        expected = viz.process_timeseries(self.query(viz))
+        df = viz.process_timeseries(self.query(viz, time_grain_sqla='day'))
+        pd.util.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+        viz.form_data['resample_how'] = 'mean'
+        assert viz.resample_grain() is None
+        viz.form_data.update(resample_how='sum', resample_rule='7D')
+        assert viz.resample_grain() is None
+        viz.form_data.update(resample_rule='1D', time_grain_sqla='week')
+        assert viz.resample_grain() is None
+
+    def test_resample_grain_offset(self):
+        viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+        viz.datasource = self.table
+        viz.form_data = {
+            'groupby': ['name'],
+            'metrics': ['sum__num', 'count'],
+            'granularity': 'ds',
+            'resample_rule': '1D',
+            'resample_how': 'sum',
+        }
+        self.table.offset = 8
+        try:
+            # Shifted by 8 hours, the 18:00 rows land on the next day
+            assert viz.resample_grain() is None
+            expected = viz.process_timeseries(
+                viz.process_df(self.query(viz)))
+            truncated = viz.process_timeseries(
+                viz.process_df(self.query(viz, time_grain_sqla='day')))
+        finally:
+            self.table.offset = 0
+        assert not expected.equals(truncated)
+        assert expected.sum().sum() == truncated.sum().sum()
+
+    def test_fallbacks(self):
+        viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+        viz.datasource = self.table
+        viz.form_data = {'rolling_type': 'mean', 'rolling_periods': '5'}
+        assert viz.window_transforms() is None
+        viz.form_data['analytics_in_sql'] = True
+        assert viz.window_transforms()
+        viz.form_data.update(resample_how='sum', resample_rule='1D')
+        assert viz.window_transforms() is None
+        viz.form_data = {'analytics_in_sql': True, 'rolling_type': 'std',
+                         'rolling_periods': '5'}
+        assert viz.window_transforms() is None
+        # The bar charts rank their series before the analytics
+        viz = NVD3TimeSeriesBarViz.__new__(NVD3TimeSeriesBarViz)
+        viz.datasource = self.table
+        viz.form_data = {'analytics_in_sql': True, 'rolling_type': 'mean',
+                         'rolling_periods': '5'}
+        assert viz.window_transforms() is None
+
+    def test_rolling_std_first_row(self):
+        viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+        viz.datasource = self.table
+        viz.form_data = {
+            'groupby': ['name'], 'metrics': ['sum__num'], 'granularity': 'ds',
+            'rolling_type': 'std', 'rolling_periods': '3'}
+        expected = viz.process_timeseries(self.query(viz))
+        assert expected.iloc[0].isnull().all()
+        assert expected.iloc[1:].notnull().all().all()
+        # The rows the database returns, blanks filled with zeros
+        rows = expected.fillna(0).stack().reset_index()
+        df = viz.process_timeseries(rows, window_in_sql=True)
+        pd.util.testing.assert_frame_equal(df, expected)
+
+
+class WindowFunctionsSupportTests(unittest.TestCase):
+
+    def supports(self, version_info):
+        database = Database(sqlalchemy_uri='mysql://localhost/db')
+        engine = Mock()
+        engine.dialect.server_version_info = version_info
+        database.get_sqla_engine = lambda: engine
+        return database.supports_window_functions
+
+    def test_mysql(self):
+        assert self.supports((8, 0, 11))
+        assert not self.supports((5, 7, 22))
+
+    def test_mariadb(self):
+        assert self.supports((10, 2, 14, 'MariaDB'))
+        assert self.supports((5, 5, 5, 10, 3, 7, 'MariaDB'))
+        assert not self.supports((10, 1, 9, 'MariaDB'))
+        assert not self.supports((5, 5, 5, 10, 0, 38, 'MariaDB'))
+
+
+if __name__ == '__main__':
+    unittest.main()
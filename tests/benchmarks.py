@@ -0,0 +1,210 @@
+"""Micro benchmarks for Caravel's hot paths
+
+Run with ``python tests/benchmarks.py``, these aren't collected by the
+test runner. The implementations they compare against are checked for
+equivalence in viz_tests.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import timeit
+
+import numpy as np
+import pandas as pd
+from pandas.io.json import dumps as pandas_dumps
+from six import string_types
+
+from caravel import json_encoders, utils
+from caravel.viz import BoxPlotViz, NVD3TimeSeriesViz
+
+
+def report(name, func, number=5):
+    secs = min(timeit.repeat(func, number=1, repeat=number))
+    print("{:<45} {:>10.1f} ms".format(name, secs * 1000))
+
+
+def table_df(rows=50000):
+    """A dataframe as returned by a TableViz query"""
+    return pd.DataFrame({
+        'timestamp': pd.date_range('2010-01-01', periods=rows, freq='D'),
+        'name': np.random.choice(['Aaron', 'Amy', 'Bob', 'Cathy'], rows),
+        'state': np.random.choice(['CA', 'NY', 'TX'], rows),
+        'num': np.random.randint(0, 10000, rows),
+        'sum__num': np.random.rand(rows),
+    })
+
+
+def bench_json_encoders():
+    df = table_df()
+    records = {'data': {
+        'records': df.to_dict(orient='records'),
+        'columns': list(df.columns),
+    }}
+    columnar = {'data': utils.df_to_columnar(df)}
+    encoders = sorted(json_encoders.ENCODERS)
+
+    print("Table payload, ISO dates ({} rows)".format(len(df.index)))
+    report("json.dumps + json_iso_dttm_ser (previous)", lambda: json.dumps(
+        records, default=utils.json_iso_dttm_ser))
+    for name in encoders:
+        encoder = json_encoders.get_encoder(name)
+        for label, payload in (('records', records), ('columnar', columnar)):
+            try:
+                report("{} encoder, {}".format(name, label), lambda: encoder(
+                    payload, dttm_format=json_encoders.ISO))
+            except ImportError:
+                print("{} encoder isn't installed".format(name))
+                break
+
+    print("\nTime series payload, epoch dates")
+    series = {'data': [{
+        'key': name,
+        'values': [
+            {'x': ts, 'y': y} for ts, y in zip(grp.timestamp, grp.num)],
+    } for name, grp in df.groupby('name')]}
+    report("pandas dumps (previous)", lambda: pandas_dumps(series))
+    for name in encoders:
+        encoder = json_encoders.get_encoder(name)
+        try:
+            report("{} encoder".format(name), lambda: encoder(series))
+        except ImportError:
+            print("{} encoder isn't installed".format(name))
+
+
+def legacy_to_series(form_data, df, classed='', title_suffix=''):
+    """NVD3TimeSeriesViz.to_series, before it got vectorized"""
+    cols = []
+    for col in df.columns:
+        if col == '':
+            cols.append('N/A')
+        elif col is None:
+            cols.append('NULL')
+        else:
+            cols.append(col)
+    df.columns = cols
+    series = df.to_dict('series')
+
+    chart_data = []
+    for name in df.T.index.tolist():
+        ys = series[name]
+        if df[name].dtype.kind not in "biufc":
+            continue
+        df['timestamp'] = pd.to_datetime(df.index, utc=False)
+        if isinstance(name, string_types):
+            series_title = name
+        else:
+            name = ["{}".format(s) for s in name]
+            if len(form_data.get('metrics')) > 1:
+                series_title = ", ".join(name)
+            else:
+                series_title = ", ".join(name[1:])
+        if title_suffix:
+            series_title += title_suffix
+
+        d = {
+            "key": series_title,
+            "classed": classed,
+            "values": [
+                {'x': ds, 'y': ys[ds] if ds in ys else None}
+                for ds in df.timestamp
+            ],
+        }
+        chart_data.append(d)
+    return chart_data
+
+
+def bench_to_series(n_series=25, n_timestamps=10000):
+    form_data = {'metrics': ['sum__num']}
+    index = pd.date_range('2000-01-01', periods=n_timestamps, freq='D')
+    columns = pd.MultiIndex.from_tuples(
+        [('sum__num', 'name_{}'.format(i)) for i in range(n_series)])
+    df = pd.DataFrame(
+        np.random.rand(n_timestamps, n_series), index=index, columns=columns)
+
+    viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+    viz.form_data = form_data
+
+    print("\nNVD3TimeSeriesViz.to_series, {} series x {} timestamps".format(
+        n_series, n_timestamps))
+    report("previous", lambda: legacy_to_series(form_data, df.copy()), 1)
+    report("vectorized", lambda: viz.to_series(df.copy()))
+
+
+def legacy_box_plot_stats(form_data, df):
+    """BoxPlotViz.get_df aggregations, before they got vectorized"""
+    def Q1(series):
+        return np.percentile(series, 25)
+
+    def Q3(series):
+        return np.percentile(series, 75)
+
+    whisker_type = form_data.get('whisker_options')
+    if whisker_type == "Tukey":
+
+        def whisker_high(series):
+            upper_outer_lim = Q3(series) + 1.5 * (Q3(series) - Q1(series))
+            return series[series <= upper_outer_lim].max()
+
+        def whisker_low(series):
+            lower_outer_lim = Q1(series) - 1.5 * (Q3(series) - Q1(series))
+            return series[series >= lower_outer_lim].min()
+
+    elif whisker_type == "Min/max (no outliers)":
+
+        def whisker_high(series):
+            return series.max()
+
+        def whisker_low(series):
+            return series.min()
+
+    else:
+        low, high = whisker_type.replace(" percentiles", "").split("/")
+
+        def whisker_high(series):
+            return np.percentile(series, int(high))
+
+        def whisker_low(series):
+            return np.percentile(series, int(low))
+
+    def outliers(series):
+        above = series[series > whisker_high(series)]
+        below = series[series < whisker_low(series)]
+        return set(above.tolist() + below.tolist())
+
+    aggregate = [Q1, np.median, Q3, whisker_high, whisker_low, outliers]
+    return df.groupby(form_data.get('groupby')).agg(
+        {m: aggregate for m in form_data.get('metrics')})
+
+
+def bench_box_plot(n_groups=500, n_timestamps=365):
+    metrics = ['sum__num', 'count']
+    rows = n_groups * n_timestamps
+    df = pd.DataFrame({
+        'name': np.repeat(
+            ['name_{}'.format(i) for i in range(n_groups)], n_timestamps),
+        'sum__num': np.random.rand(rows),
+        'count': np.random.randint(0, 100, rows),
+    })
+    viz = BoxPlotViz.__new__(BoxPlotViz)
+    for whisker_type in ('Tukey', '2/98 percentiles'):
+        form_data = {
+            'groupby': ['name'],
+            'metrics': metrics,
+            'whisker_options': whisker_type,
+        }
+        viz.form_data = form_data
+
+        print("\nBoxPlotViz stats, {}, {} groups x {} values".format(
+            whisker_type, n_groups, n_timestamps))
+        report("previous", lambda: legacy_box_plot_stats(form_data, df), 1)
+        report("vectorized", lambda: viz.box_plot_stats(
+            df, ['name'], metrics))
+
+
+if __name__ == '__main__':
+    bench_json_encoders()
+    bench_to_series()
+    bench_box_plot()
@@ -0,0 +1,254 @@
+"""Unit tests for Caravel's caching helpers"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from caravel import query_object
+from caravel.caching import SingleFlight
+from caravel.query_object import QueryObject, QueryResult
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_computation(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'value': 42}
+
+        def caller():
+            results.append(single_flight.do('some_key', compute))
+
+        threads = [threading.Thread(target=caller) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert all(value == {'value': 42} for value, shared in results)
+        assert sorted(shared for value, shared in results) == [False] + [True] * 7
+
+    def test_errors_propagate_to_waiting_callers(self):
+        single_flight = SingleFlight()
+        errors = []
+
+        def compute():
+            time.sleep(0.2)
+            raise ValueError("boom")
+
+        def caller():
+            try:
+                single_flight.do('failing_key', compute)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(errors) == 3
+
+    def test_sequential_calls_recompute(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert single_flight.do('key', compute) == (1, False)
+        assert single_flight.do('key', compute) == (2, False)
+
+
+class FakeDatasource(object):
+    type = 'table'
+    id = 1
+
+
+class QueryObjectTests(unittest.TestCase):
+
+    def query_object(self, **kwargs):
+        params = {
+            'groupby': ['gender'],
+            'metrics': ['count'],
+            'granularity': 'ds',
+            'from_dttm': datetime(2016, 1, 1),
+            'to_dttm': datetime(2016, 2, 1),
+            'filter': [('name', 'in', 'Aaron'), ('state', 'in', 'CA')],
+            'extras': {'where': '', 'having': '', 'time_grain_sqla': ''},
+        }
+        params.update(kwargs)
+        return QueryObject(FakeDatasource(), **params)
+
+    def test_equivalent_queries_share_a_key(self):
+        qry = self.query_object()
+        same = self.query_object(
+            filter=[('state', 'in', 'CA'), ('name', 'in', 'Aaron')],
+            extras={})
+        assert qry == same
+        assert qry.cache_key == same.cache_key
+
+    def test_sets_are_order_independent(self):
+        qry = self.query_object(groupby={'gender', 'state'})
+        same = self.query_object(groupby={'state', 'gender'})
+        assert qry.cache_key == same.cache_key
+
+    def test_different_queries_get_different_keys(self):
+        qry = self.query_object()
+        keys = {
+            qry.cache_key,
+            self.query_object(groupby=['state']).cache_key,
+            self.query_object(metrics=['count', 'sum__num']).cache_key,
+            self.query_object(to_dttm=datetime(2016, 3, 1)).cache_key,
+            self.query_object(extras={'where': 'num > 1'}).cache_key,
+        }
+        assert len(keys) == 5
+
+        other = QueryObject(FakeDatasource(), **qry.to_dict())
+        other.datasource.type = 'druid'
+        assert other.cache_key != qry.cache_key
+
+
+class DictCache(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_many(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def add(self, key, value, timeout=None):
+        return self.data.setdefault(key, value) is value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeDatabase(object):
+
+    def grains_dict(self):
+        Grain = namedtuple('Grain', 'name function')
+        return {
+            'Time Column': Grain('Time Column', '{col}'),
+            'day': Grain('day', 'DATE({col})'),
+            'week': Grain('week', 'WEEK({col})'),
+        }
+
+
+class FakeTable(object):
+
+    """Sums ``num`` by day over an hourly dataset, recording the queries"""
+
+    type = 'table'
+    id = 2
+    dttm_cols = ['ds']
+    database = FakeDatabase()
+
+    def __init__(self):
+        self.queries = []
+        self.rows = pd.DataFrame({
+            'ds': pd.date_range(
+                '2016-01-01', '2016-01-31', freq=timedelta(hours=1)),
+            'num': 1,
+        })
+
+    def query(self, from_dttm, to_dttm, **kwargs):
+        self.queries.append((from_dttm, to_dttm))
+        rows = self.rows[
+            (self.rows.ds >= from_dttm) & (self.rows.ds <= to_dttm)]
+        df = rows.groupby(rows.ds.dt.floor('D')).num.sum().reset_index()
+        df.columns = ['timestamp', 'sum__num']
+        return QueryResult(df=df, query='SELECT', duration=timedelta(0))
+
+
+class PartitionedResultTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = query_object.cache
+        query_object.cache = DictCache()
+
+    def tearDown(self):
+        query_object.cache = self.cache
+
+    def query_object(self, datasource, **kwargs):
+        params = {
+            'groupby': [],
+            'metrics': ['sum__num'],
+            'granularity': 'ds',
+            'from_dttm': datetime(2016, 1, 3, 12),
+            'to_dttm': datetime(2016, 1, 10),
+            'is_timeseries': True,
+            'row_limit': 1000,
+            'extras': {'time_grain_sqla': 'day'},
+        }
+        params.update(kwargs)
+        return QueryObject(datasource, **params)
+
+    def test_partition_grain(self):
+        table = FakeTable()
+        assert self.query_object(table).partition_grain() == 'day'
+        raw = self.query_object(table, extras={'time_grain_sqla': ''})
+        assert raw.partition_grain() == 'day'
+        week = self.query_object(table, extras={'time_grain_sqla': 'week'})
+        assert week.partition_grain() is None
+        limited = self.query_object(
+            table, groupby=['gender'], timeseries_limit=10)
+        assert limited.partition_grain() is None
+
+    def test_time_partitions(self):
+        parts = self.query_object(FakeTable()).time_partitions('day')
+        assert len(parts) == 8
+        assert parts[0] == (
+            datetime(2016, 1, 3, 12), datetime(2016, 1, 3, 23, 59, 59, 999999))
+        assert parts[-1] == (datetime(2016, 1, 10), datetime(2016, 1, 10))
+        assert self.query_object(FakeTable()).time_partitions(
+            'hour', max_parts=10) is None
+
+    def test_only_missing_buckets_are_queried(self):
+        table = FakeTable()
+        qry = self.query_object(table)
+        expected = qry.run().df
+
+        df = qry.get_partitioned_result('day').df
+        pd.util.testing.assert_frame_equal(df, expected)
+
+        table.queries = []
+        longer = self.query_object(table, to_dttm=datetime(2016, 1, 12))
+        df = longer.get_partitioned_result('day').df
+        assert table.queries == [
+            (datetime(2016, 1, 10), datetime(2016, 1, 12))]
+        pd.util.testing.assert_frame_equal(df, longer.run().df)
+
+    def test_truncated_results_are_not_split(self):
+        table = FakeTable()
+        qry = self.query_object(table, row_limit=5)
+        qry.get_partitioned_result('day')
+        assert len(table.queries) == 2
+        assert not [
+            key for key in query_object.cache.data
+            if key.startswith('bucket_')]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 from datetime import datetime
 import doctest
 import imp
+import json
 import os
 import unittest
 from mock import Mock, patch
@@ -15,7 +16,9 @@ from flask import escape
 from flask_appbuilder.security.sqla import models as ab_models
 
 import caravel
-from caravel import app, db, models, utils, appbuilder
+from caravel import (
+    admission, app, db, engines, inflight, jobs, models, reflection, utils,
+    appbuilder)
 from caravel.models import DruidCluster
 
 os.environ['CARAVEL_CONFIG'] = 'tests.caravel_test_config'
@@ -133,6 +136,88 @@ class CoreTests(CaravelTestCase):
             print("Slice: " + name)
             self.client.get(url)
 
+    def test_csv_export(self):
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Energy Sankey")
+            .first()
+        )
+        expected = slc.viz.get_csv()
+        app.config['CSV_EXPORT_CHUNK_SIZE'] = 7
+        try:
+            resp = self.client.get(slc.viz.csv_endpoint)
+        finally:
+            app.config['CSV_EXPORT_CHUNK_SIZE'] = 10000
+        assert resp.data.decode('utf-8') == expected
+
+    def test_export_formats(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            self.skipTest("pyarrow isn't installed")
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Energy Sankey")
+            .first()
+        )
+        resp = self.client.get(slc.viz.get_export_endpoint('arrow'))
+        df = pa.ipc.open_file(pa.py_buffer(resp.data)).read_pandas()
+        assert len(df.index) == len(slc.viz.get_df().index)
+        resp = self.client.get(slc.viz.get_export_endpoint('parquet'))
+        assert resp.status_code == 200
+        assert 'parquet' in resp.headers['Content-Disposition']
+
+    def test_columnar_payload(self):
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Energy Sankey")
+            .first()
+        )
+        url = slc.viz.json_endpoint
+        records = json.loads(self.client.get(url).data.decode('utf-8'))
+        resp = self.client.get(url + '&columnar=true')
+        columnar = json.loads(resp.data.decode('utf-8'))['data']
+        assert columnar['columns'] == ['source', 'target', 'value']
+        assert [
+            dict(zip(columnar['columns'], row))
+            for row in zip(*[columnar['data'][c] for c in columnar['columns']])
+        ] == records['data']
+
+    def test_time_compare(self):
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Trends")
+            .first()
+        )
+        url = slc.viz.get_url(json="true", time_compare="1 year ago, 10 years")
+        data = json.loads(self.client.get(url).data.decode('utf-8'))['data']
+        keys = [series['key'] for series in data]
+        names = [k for k in keys if not k.endswith(')')]
+        assert names
+        for name in names:
+            assert name + " (1 year ago)" in keys
+            assert name + " (10 years)" in keys
+
+    def test_filter_box_single_query(self):
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Region Filter")
+            .first()
+        )
+        resp = self.client.get(slc.viz.json_endpoint)
+        payload = json.loads(resp.data.decode('utf-8'))
+        assert payload['query'].count('UNION ALL') == 1
+        for flt in ('region', 'country_name'):
+            metrics = [row['metric'] for row in payload['data'][flt]]
+            assert metrics
+            assert metrics == sorted(metrics, reverse=True)
+            assert all(row['filter'] == flt for row in payload['data'][flt])
+
     def test_dashboard(self):
         self.login_admin()
         urls = {}
@@ -152,6 +237,287 @@ class CoreTests(CaravelTestCase):
         assert self.client.get('/health').data.decode('utf-8') == "OK"
         assert self.client.get('/ping').data.decode('utf-8') == "OK"
 
+    def test_engine_registry(self):
+        self.login_admin()
+        dbobj = (
+            db.session.query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+        engine = dbobj.get_sqla_engine()
+        assert engine is dbobj.get_sqla_engine()
+        engines.registry.invalidate(dbobj.id)
+        assert engine is not dbobj.get_sqla_engine()
+        resp = self.client.get('/caravel/pool_stats/')
+        assert 'main' in json.loads(resp.data.decode('utf-8'))
+
+    def test_fetch_metadata(self):
+        tbl = db.session.query(models.SqlaTable).get(
+            self.table_ids['birth_names'])
+        columns = sorted(col.column_name for col in tbl.columns)
+        metrics = sorted(m.metric_name for m in tbl.metrics)
+        tbl.fetch_metadata()
+        tbl = db.session.query(models.SqlaTable).get(
+            self.table_ids['birth_names'])
+        assert sorted(col.column_name for col in tbl.columns) == columns
+        assert sorted(m.metric_name for m in tbl.metrics) == metrics
+        cli.refresh_tables(database='main')
+
+    def test_fetch_new_metadata(self):
+        dbobj = (
+            db.session.query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+        engine = dbobj.get_sqla_engine()
+        engine.execute("CREATE TABLE metadata_test (ds DATETIME, num INTEGER)")
+        tbl = models.SqlaTable(table_name='metadata_test', database=dbobj)
+        missing = models.SqlaTable(table_name='no_such_table', database=dbobj)
+        db.session.add(tbl)
+        db.session.add(missing)
+        db.session.commit()
+        try:
+            assert tbl.fetch_metadata()
+            engine.execute("ALTER TABLE metadata_test ADD COLUMN num2 BIGINT")
+            reflection.registry.invalidate(dbobj.id, 'metadata_test')
+            assert cli.refresh_table_metadata([tbl.id, missing.id]) == 1
+            tbl = db.session.query(models.SqlaTable).get(tbl.id)
+            assert sorted(c.column_name for c in tbl.columns) == [
+                'ds', 'num', 'num2']
+            assert sorted(m.metric_name for m in tbl.metrics) == [
+                'count', 'sum__num', 'sum__num2']
+            assert tbl.main_dttm_col == 'ds'
+        finally:
+            for obj in (tbl, missing):
+                db.session.delete(
+                    db.session.query(models.SqlaTable).get(obj.id))
+            db.session.commit()
+            engine.execute("DROP TABLE metadata_test")
+
+    def test_reflection_cache(self):
+        dbobj = (
+            db.session.query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+        tbl = dbobj.get_table('birth_names')
+        assert tbl is dbobj.get_table('birth_names')
+        assert 'name' in [col['name'] for col in dbobj.get_columns(
+            'birth_names')]
+        reflection.registry.invalidate(dbobj.id, 'birth_names')
+        assert tbl is not dbobj.get_table('birth_names')
+        reflection.registry.invalidate(dbobj.id)
+        tables = dbobj.get_tables(['birth_names', 'energy_usage', 'nope'])
+        assert set(tables) == {'birth_names', 'energy_usage'}
+        assert tables['birth_names'] is dbobj.get_table('birth_names')
+
+    def test_catalog(self):
+        self.login_admin()
+        dbobj = (
+            db.session.query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+        dbobj.refresh_catalog()
+        url = '/caravel/catalog/{}/'.format(dbobj.id)
+        resp = json.loads(self.client.get(url + '?q=birth').data.decode('utf-8'))
+        assert 'birth_names' in [tbl['name'] for tbl in resp['tables']]
+        assert all(tbl['name'].startswith('birth') for tbl in resp['tables'])
+        resp = json.loads(self.client.get(url + '?limit=1').data.decode('utf-8'))
+        assert len(resp['tables']) == 1
+        resp = json.loads(self.client.get(url + '?limit=0').data.decode('utf-8'))
+        assert len(resp['tables']) == 1
+        # Wildcards are matched literally
+        assert not dbobj.search_catalog('%')
+        assert dbobj.refresh_catalog(columns=True)
+        tbl = dbobj.search_catalog('birth_names', schema=None)[0]
+        assert 'name' in [col[0] for col in tbl.data['columns']]
+
+        # Another process lists the same new table first
+        db.session.query(models.CatalogTable).filter_by(
+            database_id=dbobj.id, schema=None,
+            table_name='birth_names').delete()
+        db.session.commit()
+        commit = db.session.commit
+        inserts = []
+
+        def concurrent_commit():
+            if not inserts:
+                inserts.append(db.engine.execute(
+                    models.CatalogTable.__table__.insert().values(
+                        database_id=dbobj.id, schema=None,
+                        table_name='birth_names')))
+            commit()
+        with patch.object(db.session, 'commit', concurrent_commit):
+            assert dbobj.refresh_catalog()
+        assert len(dbobj.search_catalog('birth_names', schema=None)) == 1
+
+        # Never listed, the catalog is built in the background
+        newdb = models.Database(database_name='uncataloged', sqlalchemy_uri='sqlite://')
+        db.session.add(newdb)
+        db.session.commit()
+        try:
+            url = '/caravel/catalog/{}/'.format(newdb.id)
+            resp = json.loads(self.client.get(url).data.decode('utf-8'))
+            assert resp == {
+                'tables': [], 'last_refreshed': None, 'refreshing': True}
+        finally:
+            db.session.delete(newdb)
+            db.session.commit()
+
+    def test_async_explore_json(self):
+        self.login_admin()
+        slc = (
+            db.session.query(models.Slice)
+            .filter_by(slice_name="Energy Sankey")
+            .first()
+        )
+        # No shared cache is configured for the tests, async requests are
+        # served synchronously
+        resp = self.client.get(slc.viz.json_endpoint + '&async=true')
+        assert 'job_id' not in json.loads(resp.data.decode('utf-8'))
+        resp = self.client.get('/caravel/job/doesnotexist/')
+        assert resp.status_code == 404
+
+    def test_job_cancelled_while_finishing(self):
+        from werkzeug.contrib.cache import SimpleCache
+        job_id = jobs.new_job_id()
+
+        def func():
+            # Cancelled after the job's last check
+            jobs.cancel(job_id)
+            return {'data': []}
+
+        with patch.object(jobs, 'cache', SimpleCache()):
+            jobs.set_status(job_id, jobs.PENDING)
+            jobs._run(job_id, func, (), {})
+            job = jobs.get_status(job_id)
+        assert job['status'] == jobs.CANCELLED
+        assert 'payload' not in job
+
+    def test_sql_json(self):
+        self.login_admin()
+        dbobj = (
+            db.session.query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+
+        def run(sql):
+            data = json.dumps({'database_id': dbobj.id, 'sql': sql})
+            resp = self.client.post('/caravel/sql_json/', data={'data': data})
+            return resp.status_code, json.loads(resp.data.decode('utf-8'))
+
+        # No shared cache is configured for the tests, queries are run
+        # in the request
+        status, payload = run("SELECT name, num FROM birth_names;")
+        assert status == 200
+        assert payload['columns'] == ['name', 'num']
+        assert len(payload['data']) == payload['rows']
+        dbobj.sql_editor_row_limit = 7
+        db.session.commit()
+        try:
+            status, payload = run("SELECT name, num FROM birth_names")
+        finally:
+            dbobj.sql_editor_row_limit = None
+            db.session.commit()
+        assert payload['rows'] == 7
+        assert payload['limit_reached']
+        status, payload = run("SELECT nope FROM birth_names")
+        assert status == 500
+        assert payload['error']
+        resp = self.client.get('/caravel/sql_json/doesnotexist/page/0/')
+        assert resp.status_code == 404
+
+    def test_statement_timeout(self):
+        self.login_admin()
+        dbobj = models.Database(
+            database_name='timeout', sqlalchemy_uri='sqlite://',
+            statement_timeout=1)
+        db.session.add(dbobj)
+        db.session.commit()
+        endless = (
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+            "SELECT COUNT(*) FROM c")
+        try:
+            engine = dbobj.get_sqla_engine()
+            with self.assertRaises(inflight.QueryCancelled):
+                engine.execute(endless)
+            assert engine.execute("SELECT 1").scalar() == 1
+            resp = self.client.get('/caravel/queries/')
+            assert json.loads(resp.data.decode('utf-8')) == []
+            # Streamed results are tracked until their connection is closed
+            sql = "SELECT 1 UNION ALL SELECT 2"
+            conn = engine.connect().execution_options(stream_results=True)
+            assert conn.execute(sql).fetchone()[0] == 1
+            queries = inflight.registry.list(dbobj.id)
+            assert [q['sql'] for q in queries] == [sql]
+            # The timeout doesn't cover the download of the results
+            assert inflight.registry.get(queries[0]['id']).deadline is None
+            conn.close()
+            assert inflight.registry.list(dbobj.id) == []
+        finally:
+            db.session.delete(dbobj)
+            db.session.commit()
+
+    def test_statement_timeout_unsupported(self):
+        dbapi_connection = Mock()
+        cursor = dbapi_connection.cursor.return_value
+        cursor.fetchone.return_value = ('5.7.5-log',)
+        cursor.execute.side_effect = [
+            None, Exception("Unknown system variable 'max_execution_time'")]
+        # Logged, the timeout is left to the inflight registry
+        engines.set_statement_timeout(dbapi_connection, 'mysql', 10)
+        cursor.execute.assert_called_with(
+            'SET SESSION max_execution_time = 10000')
+        assert dbapi_connection.rollback.called
+        assert cursor.close.called
+
+    def test_concurrency_limit(self):
+        self.login_admin()
+        dbobj = models.Database(
+            database_name='busy', sqlalchemy_uri='sqlite://',
+            max_concurrent_queries=1)
+        db.session.add(dbobj)
+        db.session.commit()
+        budget = app.config['QUERY_QUEUE_WAIT_BUDGET']
+        app.config['QUERY_QUEUE_WAIT_BUDGET'] = 0.5
+        try:
+            with dbobj.admit():
+                with self.assertRaises(admission.QueryQueueTimeout):
+                    with dbobj.admit():
+                        pass
+            with dbobj.admit():
+                pass
+            stats = dbobj.queue_stats()
+            assert stats['admitted'] == 2
+            assert stats['rejected'] == 1
+            assert stats['queued'] == 0
+            assert stats['running'] == 0
+            resp = self.client.get('/caravel/queue_stats/')
+            payload = json.loads(resp.data.decode('utf-8'))
+            assert payload['databases']['busy']['rejected'] == 1
+        finally:
+            app.config['QUERY_QUEUE_WAIT_BUDGET'] = budget
+            db.session.delete(dbobj)
+            db.session.commit()
+
+    def test_concurrency_limit_expired_slot(self):
+        from werkzeug.contrib.cache import SimpleCache
+        controller = admission.AdmissionController()
+        scope = ('database', 'expired')
+        key = controller.slot_key(scope, 0)
+        with patch.object(admission, 'cache', SimpleCache()):
+            with controller.admit(scope, 1):
+                assert admission.cache.get(key)
+                # The slot expired and another query took it
+                admission.cache.set(key, 'another')
+            assert admission.cache.get(key) == 'another'
+            admission.cache.delete(key)
+            with controller.admit(scope, 1):
+                pass
+            assert admission.cache.get(key) is None
+
     def test_shortner(self):
         self.login_admin()
         data = "//caravel/explore/table/1/?viz_type=sankey&groupby=source&groupby=target&metric=sum__value&row_limit=5000&where=&having=&flt_col_0=source&flt_op_0=in&flt_eq_0=&slice_id=78&slice_name=Energy+Sankey&collapsed_fieldsets=&action=&datasource_name=energy_usage&datasource_id=1&datasource_type=table&previous_viz_type=sankey"
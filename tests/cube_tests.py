@@ -0,0 +1,167 @@
+"""In-memory cubes, against the queries they answer"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from caravel import cubes
+from tests.fixtures import SqliteTable, query_obj
+
+
+class CubeTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        rows = 5000
+        minutes = np.sort(rng.randint(0, 60 * 24 * 90, rows))
+        cls.fixture = SqliteTable(
+            pd.DataFrame({
+                'ds': [
+                    datetime(2016, 1, 1) + timedelta(minutes=int(m))
+                    for m in minutes],
+                'name': rng.choice(['a', 'b', 'c', 'd', None], rows),
+                'state': rng.choice(['CA', 'NY', 'TX'], rows),
+                'num': rng.randint(0, 10, rows),
+                'x': np.where(rng.rand(rows) < 0.3, np.nan, rng.rand(rows)),
+            }),
+            columns=[
+                {'column_name': 'ds', 'is_dttm': True},
+                {'column_name': 'name', 'groupby': True},
+                {'column_name': 'state', 'filterable': True},
+                {'column_name': 'num'},
+            ],
+            metrics=['sum__num', 'count', 'min__num', 'max__x', 'avg__num'],
+            id=1, cube_grain='day')
+        cls.table = cls.fixture.table
+
+    @classmethod
+    def tearDownClass(cls):
+        cubes.registry.drop(cls.table.id)
+        cls.fixture.close()
+
+    def query_obj(self, **kwargs):
+        d = dict(
+            metrics=['sum__num', 'count', 'min__num', 'max__x'],
+            from_dttm=datetime(2016, 1, 3),
+            to_dttm=datetime(2016, 2, 9, 23, 59, 59, 999999),
+        )
+        d.update(kwargs)
+        return query_obj(**d)
+
+    def setUp(self):
+        self.cube = cubes.Cube.load(self.table)
+
+    def assert_same_results(self, **kwargs):
+        query_obj = self.query_obj(**kwargs)
+        assert self.cube.can_serve(**query_obj)
+        keys = list(query_obj['groupby'])
+        if query_obj['is_timeseries']:
+            keys.append('timestamp')
+
+        def ordered(df):
+            if 'timestamp' in df.columns:
+                df.timestamp = pd.to_datetime(df.timestamp)
+            if keys:
+                df = df.sort_values(keys).reset_index(drop=True)
+            return df.fillna(-1)
+
+        sql = self.table.get_query_str(**query_obj)
+        expected = pd.read_sql_query(
+            sql, self.table.database.get_sqla_engine())
+        pd.util.testing.assert_frame_equal(
+            ordered(self.cube.query(**query_obj)), ordered(expected),
+            check_dtype=False)
+
+    def test_group_by(self):
+        self.assert_same_results()
+        self.assert_same_results(groupby=['name', 'state'])
+        self.assert_same_results(groupby=[])
+
+    def test_not_a_time_series(self):
+        self.assert_same_results(is_timeseries=False)
+        self.assert_same_results(is_timeseries=False, groupby=[])
+
+    def test_filters(self):
+        self.assert_same_results(filter=[('state', 'in', 'CA,NY')])
+        self.assert_same_results(
+            filter=[('state', 'in', 'TX'), ('name', 'not in', 'a,b')])
+
+    def test_raw_timestamps(self):
+        self.table.cube_grain = 'Time Column'
+        try:
+            self.cube = cubes.Cube.load(self.table)
+        finally:
+            self.table.cube_grain = 'day'
+        # Any time range, at any grain the cube derives
+        bounds = dict(
+            from_dttm=datetime(2016, 1, 3, 5, 7),
+            to_dttm=datetime(2016, 2, 9, 3))
+        self.assert_same_results(**bounds)
+        self.assert_same_results(
+            extras={'time_grain_sqla': 'Time Column'}, **bounds)
+        assert not self.cube.can_serve(
+            **self.query_obj(extras={'time_grain_sqla': 'week'}))
+
+    def test_timeseries_limit(self):
+        self.assert_same_results(
+            timeseries_limit=2, inner_from_dttm=datetime(2016, 2, 1))
+        # Ranked by a min, over a range leaving most groups out
+        self.assert_same_results(
+            metrics=['min__num', 'sum__num', 'count'],
+            groupby=['name', 'state'], timeseries_limit=3,
+            inner_from_dttm=datetime(2016, 2, 9, 20))
+
+    def test_aggregate_empty_groups(self):
+        groups = np.array([0, 0, 1])
+        np.testing.assert_array_equal(
+            cubes.aggregate(np.array([3, 1, 2]), 'min', groups, 4),
+            [1, 2, np.nan, np.nan])
+        np.testing.assert_array_equal(
+            cubes.aggregate(np.array([3, 1, 2]), 'max', groups[::-1], 3),
+            [2, 3, np.nan])
+
+    def test_not_served(self):
+        not_covered = [
+            {'groupby': ['num']},
+            {'metrics': ['avg__num']},
+            {'filter': [('num', 'in', '1')]},
+            {'from_dttm': datetime(2016, 1, 3, 1)},
+            {'extras': {'time_grain_sqla': 'week'}},
+            {'extras': {'time_grain_sqla': 'day', 'where': 'num > 1'}},
+            {'columns': ['name'], 'groupby': []},
+            {'grouping_sets': True},
+        ]
+        for kwargs in not_covered:
+            assert not self.cube.can_serve(**self.query_obj(**kwargs))
+        # The last bucket can be open ended
+        assert self.cube.can_serve(**self.query_obj(to_dttm=datetime.now()))
+
+    def test_memory_usage(self):
+        usage = self.cube.memory_usage()
+        assert set(usage) == {'ds', 'name', 'state', 'sum__num', 'count',
+                              'min__num', 'max__x'}
+        # Dictionary encoded, with a byte per code
+        assert self.cube.dimensions['name'][0].dtype == np.int8
+        assert usage['name'] < self.cube.row_count * 2
+
+    def test_routing(self):
+        query_obj = self.query_obj()
+        cubes.registry.load(self.table)
+        assert self.table.find_cube(**query_obj) is not None
+        result = self.table.query(**query_obj)
+        assert result.query.startswith('-- Answered by the in-memory cube')
+        assert len(result.df.index)
+        assert self.table.find_cube(**self.query_obj(groupby=['num'])) is None
+        stats = cubes.registry.stats(self.table.id)
+        assert stats['rows'] == self.cube.row_count
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tables of their own in throwaway SQLite databases, for the model tests"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+from sqlalchemy import create_engine
+
+from caravel.models import Database, SqlaTable, SqlMetric, TableColumn
+
+# The metrics the test tables pick from, by name
+METRICS = {
+    'sum__num': ('sum', 'SUM(num)'),
+    'count': ('count', 'COUNT(*)'),
+    'count_distinct__name': ('count_distinct', 'COUNT(DISTINCT name)'),
+    'min__num': ('min', 'MIN(num)'),
+    'max__x': ('max', 'MAX(x)'),
+    'avg__num': ('avg', 'AVG(num)'),
+}
+
+COLUMNS = [
+    {'column_name': 'ds', 'is_dttm': True},
+    {'column_name': 'name', 'groupby': True},
+    {'column_name': 'num'},
+]
+
+
+def query_obj(**kwargs):
+    """A query object for the test tables, with ``kwargs`` on top"""
+    d = dict(
+        groupby=['name'],
+        metrics=['sum__num', 'count'],
+        granularity='ds',
+        filter=[],
+        is_timeseries=True,
+        timeseries_limit=None,
+        row_limit=10000,
+        extras={'time_grain_sqla': 'day'},
+    )
+    d.update(kwargs)
+    return d
+
+
+class SqliteTable(object):
+
+    """A SqlaTable over the rows of ``df``, in a database of its own
+
+    ``columns`` are the attributes of its columns, ``metrics`` the names of
+    its metrics, from ``METRICS``. The database file is removed by
+    ``close``.
+    """
+
+    def __init__(
+            self, df, table_name='events', columns=None,
+            metrics=('sum__num', 'count'), **attrs):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        uri = 'sqlite:///' + self.path
+        self.engine = create_engine(uri)
+        df.to_sql(table_name, self.engine, index=False)
+
+        self.table = SqlaTable(
+            table_name=table_name, main_dttm_col='ds',
+            database=Database(database_name=table_name, sqlalchemy_uri=uri),
+            **attrs)
+        self.table.columns = [
+            TableColumn(**column) for column in (columns or COLUMNS)]
+        self.table.metrics = [
+            SqlMetric(
+                metric_name=name, metric_type=METRICS[name][0],
+                expression=METRICS[name][1])
+            for name in metrics]
+
+    def close(self):
+        self.engine.dispose()
+        os.remove(self.path)
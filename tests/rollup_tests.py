@@ -0,0 +1,168 @@
+"""Rollup tables and the routing of queries to them"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from caravel import app
+from caravel.models import Rollup
+from tests.fixtures import SqliteTable, query_obj
+
+
+def events(start, hours, rng):
+    """Three events an hour, starting at start"""
+    rows = 3 * hours
+    return pd.DataFrame({
+        'ds': [start + timedelta(minutes=20 * i) for i in range(rows)],
+        'name': rng.choice(['a', 'b', 'c'], rows),
+        'state': rng.choice(['CA', 'NY'], rows),
+        'num': rng.randint(0, 10, rows),
+    })
+
+
+class RollupTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.rng = np.random.RandomState(0)
+        cls.fixture = SqliteTable(
+            events(datetime(2016, 1, 1), 24 * 10, cls.rng),
+            columns=[
+                {'column_name': 'ds', 'is_dttm': True},
+                {'column_name': 'name', 'groupby': True},
+                {'column_name': 'state', 'groupby': True},
+                {'column_name': 'num'},
+            ],
+            metrics=['sum__num', 'count', 'count_distinct__name'])
+        cls.table = cls.fixture.table
+        cls.engine = cls.fixture.engine
+        cls.rollup = Rollup(
+            rollup_name='events_daily', table=cls.table,
+            dimensions='name, state', metrics='sum__num, count',
+            time_grain='day')
+        cls.rollup.refresh()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def query_obj(self, **kwargs):
+        d = dict(
+            from_dttm=datetime(2016, 1, 2),
+            to_dttm=datetime(2016, 1, 5, 23, 59, 59, 999999),
+            filter=[('state', 'in', 'CA')],
+            row_limit=1000,
+            extras={'time_grain_sqla': 'day', 'where': '', 'having': ''},
+        )
+        d.update(kwargs)
+        return query_obj(**d)
+
+    def rollup_df(self):
+        return pd.read_sql_query(
+            'SELECT * FROM events_daily ORDER BY ds, name, state',
+            self.engine)
+
+    def test_validate(self):
+        self.rollup.validate()
+        invalid = [
+            {'time_grain': '5 minute'},
+            {'dimensions': 'name, num_name'},
+            {'metrics': 'count_distinct__name'},
+            {'rollup_name': 'events'},
+            {'rollup_name': ''},
+        ]
+        for kwargs in invalid:
+            attrs = dict(
+                rollup_name='invalid', dimensions='name', metrics='count',
+                time_grain='day')
+            attrs.update(kwargs)
+            rollup = Rollup(table=self.table, **attrs)
+            try:
+                self.assertRaises(Exception, rollup.validate)
+            finally:
+                self.table.rollups.remove(rollup)
+
+    def test_existing_table(self):
+        pd.DataFrame({'a': [1, 2]}).to_sql('other', self.engine, index=False)
+        rollup = Rollup(
+            rollup_name='other', table=self.table, dimensions='name',
+            metrics='count', time_grain='day')
+        try:
+            for full in (False, True):
+                self.assertRaises(Exception, rollup.refresh, full=full)
+            assert pd.read_sql_table('other', self.engine)['a'].tolist() == [
+                1, 2]
+        finally:
+            self.table.rollups.remove(rollup)
+
+    def test_rename(self):
+        rollup = Rollup(
+            rollup_name='events_by_name', table=self.table, dimensions='name',
+            metrics='count', time_grain='day')
+        try:
+            rollup.refresh()
+            assert rollup.last_refreshed
+            # Built under another name, the table isn't the rollup's
+            rollup.rollup_name = 'events'
+            assert rollup.last_refreshed is None
+            assert rollup.row_count is None
+        finally:
+            self.table.rollups.remove(rollup)
+
+    def test_routing(self):
+        query_obj = self.query_obj()
+        assert self.table.find_rollup(**query_obj) is self.rollup
+        routed = self.table.query(**query_obj)
+        assert routed.query.startswith(
+            '-- Routed to the rollup events_daily')
+        assert 'FROM events_daily' in routed.query
+
+        app.config['ROLLUP_ROUTING'] = False
+        try:
+            assert self.table.find_rollup(**query_obj) is None
+            direct = self.table.query(**query_obj)
+        finally:
+            app.config['ROLLUP_ROUTING'] = True
+        assert 'events_daily' not in direct.query
+
+        def ordered(df):
+            return df.sort_values(['timestamp', 'name']).reset_index(
+                drop=True)
+        pd.util.testing.assert_frame_equal(
+            ordered(routed.df), ordered(direct.df), check_dtype=False)
+
+    def test_not_routed(self):
+        not_covered = [
+            {'groupby': ['num']},
+            {'metrics': ['count_distinct__name']},
+            {'filter': [('num', 'in', '1')]},
+            {'from_dttm': datetime(2016, 1, 2, 1)},
+            {'to_dttm': datetime(2016, 1, 5, 12)},
+            {'extras': {'time_grain_sqla': 'Time Column'}},
+            {'extras': {'time_grain_sqla': 'day', 'where': 'num > 1'}},
+        ]
+        for kwargs in not_covered:
+            assert self.table.find_rollup(**self.query_obj(**kwargs)) is None
+        # The last bucket can be open ended
+        assert self.table.find_rollup(
+            **self.query_obj(to_dttm=datetime.now())) is self.rollup
+
+    def test_incremental_refresh(self):
+        events(datetime(2016, 1, 10, 12), 36, self.rng).to_sql(
+            'events', self.engine, index=False, if_exists='append')
+        # Only the latest stored bucket, and the ones after it, are rebuilt
+        assert self.rollup.refresh() == 12
+        incremental = self.rollup_df()
+        self.rollup.refresh(full=True)
+        pd.util.testing.assert_frame_equal(incremental, self.rollup_df())
+        assert self.rollup.row_count == len(incremental.index) == 66
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""Unit tests for the post processing done by the visualizations"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from pandas.io.json import dumps as pandas_dumps
+
+from caravel import app
+from caravel.viz import BoxPlotViz, NVD3TimeSeriesViz, TableViz
+from tests.benchmarks import legacy_box_plot_stats, legacy_to_series
+from tests.fixtures import SqliteTable, query_obj
+
+
+class CsvExportTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixture = SqliteTable(pd.DataFrame({
+            'ds': [datetime(2016, 1, 1) + timedelta(days=i) for i in range(6)],
+            'name': list('abcdef'),
+            'num': [1, 2, 3, 4, 5, 6],
+        }))
+        cls.table = cls.fixture.table
+        # A blank in the second chunk only
+        cls.fixture.engine.execute(
+            "UPDATE events SET num = NULL WHERE name = 'e'")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def test_chunks_keep_their_dtypes(self):
+        viz = TableViz.__new__(TableViz)
+        viz.datasource = self.table
+        viz.query_obj = lambda: query_obj(
+            columns=['name', 'num'], groupby=[], metrics=[],
+            is_timeseries=False, from_dttm=datetime(2015, 1, 1),
+            to_dttm=datetime(2017, 1, 1))
+        app.config['CSV_EXPORT_CHUNK_SIZE'] = 3
+        try:
+            csv = ''.join(viz.iter_csv())
+        finally:
+            app.config['CSV_EXPORT_CHUNK_SIZE'] = 10000
+        assert csv.splitlines() == [
+            'name,num', 'a,1', 'b,2', 'c,3', 'd,4', 'e,0', 'f,6']
+
+
+class TimeSeriesTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        index = pd.date_range('2016-01-01', periods=1000, freq='H')
+        self.df = pd.DataFrame({
+            'a': rng.randn(1000).cumsum(),
+            'b': rng.randn(1000).cumsum(),
+            'c': rng.randint(0, 100, 1000),
+        }, index=index)
+        self.viz = NVD3TimeSeriesViz.__new__(NVD3TimeSeriesViz)
+        self.viz.form_data = {'metrics': ['sum__num']}
+
+    def test_downsampling(self):
+        for method in ('lttb', 'minmax'):
+            self.viz.form_data.update(max_points=60, downsampling=method)
+            chart_data = self.viz.to_series(self.df.copy())
+            assert [s['key'] for s in chart_data] == ['a', 'b', 'c']
+            xs = [[v['x'] for v in s['values']] for s in chart_data]
+            # All the series on the same timestamps, the first and last
+            # ones included
+            assert xs[0] == xs[1] == xs[2] == sorted(set(xs[0]))
+            assert len(xs[0]) <= 60 + 2
+            first, last = self.df.index[0], self.df.index[-1]
+            assert xs[0][0] == first.value // 10 ** 6
+            assert xs[0][-1] == last.value // 10 ** 6
+
+    def test_to_series(self):
+        columns = pd.MultiIndex.from_tuples(
+            [('sum__num', 'name_{}'.format(i)) for i in range(5)])
+        df = pd.DataFrame(
+            np.random.RandomState(0).rand(100, 5),
+            index=pd.date_range('2000-01-01', periods=100, freq='D'),
+            columns=columns)
+        for metrics in (['sum__num'], ['sum__num', 'count']):
+            self.viz.form_data = {'metrics': metrics}
+            assert (
+                pandas_dumps(self.viz.to_series(df.copy())) ==
+                pandas_dumps(legacy_to_series(self.viz.form_data, df.copy())))
+
+    def test_no_downsampling(self):
+        self.viz.form_data.update(max_points=5000)
+        chart_data = self.viz.to_series(self.df.copy())
+        assert [len(s['values']) for s in chart_data] == [1000] * 3
+
+
+class BoxPlotTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        rows = 60 * 4
+        cls.fixture = SqliteTable(pd.DataFrame({
+            'ds': np.tile(pd.date_range('2016-01-01', periods=60), 4),
+            'name': np.repeat(['a', 'b', 'c', 'd'], 60),
+            'num': rng.randint(0, 100, rows),
+        }))
+        cls.table = cls.fixture.table
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fixture.close()
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        rows = 40 * 50
+        self.df = pd.DataFrame({
+            'name': np.repeat(['name_{}'.format(i) for i in range(40)], 50),
+            'state': rng.choice(['CA', 'NY'], rows),
+            'sum__num': rng.rand(rows),
+            'count': rng.randint(0, 100, rows),
+        })
+        self.viz = BoxPlotViz.__new__(BoxPlotViz)
+        self.viz.datasource = self.table
+
+    def test_stats(self):
+        for whisker_type in (
+                'Tukey', 'Min/max (no outliers)', '2/98 percentiles'):
+            for groupby in (['name'], ['name', 'state']):
+                form_data = {
+                    'groupby': groupby,
+                    'metrics': ['sum__num', 'count'],
+                    'whisker_options': whisker_type,
+                }
+                self.viz.form_data = form_data
+                expected = legacy_box_plot_stats(form_data, self.df)
+                stats = self.viz.box_plot_stats(
+                    self.df, groupby, form_data['metrics'])
+                assert list(stats.index) == list(expected.index)
+                for col in stats.columns:
+                    if col[1] == 'outliers':
+                        assert (
+                            stats[col].tolist() == expected[col].tolist())
+                    else:
+                        np.testing.assert_allclose(
+                            stats[col].values, expected[col].values)
+
+    def test_percentiles_in_sql(self):
+        self.viz.form_data = {'whisker_options': 'Min/max (no outliers)'}
+        metrics = ['sum__num', 'count']
+        expected = self.viz.box_plot_stats(self.df, ['name'], metrics)
+        # What PERCENTILE_CONT, which interpolates linearly, returns
+        grouped = self.df.groupby('name')
+        percentiles = pd.DataFrame(OrderedDict(
+            ('{}__{}'.format(metric, suffix), agg(grouped[metric]))
+            for metric in metrics
+            for suffix, agg in (
+                ('p25', lambda s: s.quantile(.25)),
+                ('p50', lambda s: s.quantile(.5)),
+                ('p75', lambda s: s.quantile(.75)),
+                ('min', lambda s: s.min()),
+                ('max', lambda s: s.max())))).reset_index()
+        stats = self.viz.percentiles_to_stats(percentiles, ['name'], metrics)
+        assert list(stats.columns) == list(expected.columns)
+        assert list(stats.index) == list(expected.index)
+        for col in stats.columns:
+            if col[1] != 'outliers':
+                np.testing.assert_allclose(
+                    stats[col].values, expected[col].values)
+
+    def test_percentiles_query_str(self):
+        sql = self.table.get_query_str(**query_obj(
+            percentiles=[25, 50, 75], metrics=['sum__num'],
+            from_dttm=datetime(2016, 1, 1), to_dttm=datetime(2016, 3, 1)))
+        assert (
+            'PERCENTILE_CONT(0.25) WITHIN GROUP '
+            '(ORDER BY coalesce(box_values.sum__num, 0)) AS sum__num__p25'
+            in sql)
+        assert 'PERCENTILE_CONT(0.75)' in sql
+        assert 'min(coalesce(box_values.sum__num, 0)) AS sum__num__min' in sql
+        assert 'GROUP BY box_values.name' in sql
+
+
+if __name__ == '__main__':
+    unittest.main()